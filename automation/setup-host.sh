@@ -60,7 +60,7 @@ set -x
 
 apt-get -y update
 apt-get -y upgrade
-apt-get -y install fdisk git python3-pip libpq-dev lld libclang-dev
+apt-get -y install fdisk git python3-pip libpq-dev lld libclang-dev zstd
 
 grep -q ^nayduck: /etc/passwd ||
 	adduser --disabled-login --gecos NayDuck nayduck
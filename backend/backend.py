@@ -1,3 +1,4 @@
+import argparse
 import collections
 import datetime
 import gzip
@@ -178,6 +179,33 @@ def schedule_nightly_run_check(delta: datetime.timedelta) -> None:
                   run_date=(datetime.datetime.now() + delta))
 
 
+def schedule_prebuild() -> None:
+    sched.add_job(func=scheduler.prebuild_master,
+                  trigger='interval',
+                  id='prebuild_master',
+                  minutes=10,
+                  coalesce=True,
+                  next_run_time=datetime.datetime.now())
+
+
+def schedule_lease_sweep() -> None:
+    sched.add_job(func=scheduler.reclaim_expired_leases,
+                  trigger='interval',
+                  id='reclaim_expired_leases',
+                  seconds=5,
+                  coalesce=True,
+                  next_run_time=datetime.datetime.now())
+
+
+def schedule_test_durations_update() -> None:
+    sched.add_job(func=scheduler.update_test_durations,
+                  trigger='interval',
+                  id='update_test_durations',
+                  hours=1,
+                  coalesce=True,
+                  next_run_time=datetime.datetime.now())
+
+
 @app.route('/api/nightly-events', methods=['GET'])
 def get_nightly_events() -> flask.Response:  # pylint: disable=too-many-locals
     with backend_db.BackendDB() as server:
@@ -231,6 +259,33 @@ def get_system_stats() -> flask.Response:
     return response
 
 
+# Maximum number of bytes of output returned by a single tail request.  Clients
+# wanting more have to come back for the rest.
+_TAIL_LIMIT = 64 * 1024
+
+
+@app.route(
+    '/api/<any("test","build"):kind>/<int:obj_id>/tail/'
+    '<any("stdout","stderr"):log_type>',
+    methods=['GET'])
+def get_tail(kind: str, obj_id: int, log_type: str) -> flask.Response:
+    """Returns output of a running test or build starting at given offset.
+
+    The offset is given in the ‘offset’ query argument and defaults to zero.
+    See BackendDB.get_live_log for description of the response.  Clients
+    should poll with offset set to ‘next’ from the previous response until
+    test’s or build’s status is no longer RUNNING or BUILDING respectively and
+    then fetch the full log.
+    """
+    offset = flask.request.args.get('offset', 0, type=int)
+    with backend_db.BackendDB() as server:
+        tail = server.get_live_log(kind, obj_id, log_type, max(0, offset),
+                                   _TAIL_LIMIT)
+    response = jsonify(tail)
+    response.cache_control.no_store = True
+    return response
+
+
 @app.route('/logs/<any("test","build"):kind>/<int:obj_id>/<log_type>')
 def get_test_log(kind: str, obj_id: int,
                  log_type: str) -> werkzeug.wrappers.Response:
@@ -253,7 +308,11 @@ def get_test_log(kind: str, obj_id: int,
     else:
         response.content_type = 'text/plain; charset=utf-8'
 
-    response.headers['cache-control'] = f'max-age={365 * 24 * 3600}'
+    if ctime:
+        response.headers['cache-control'] = f'max-age={365 * 24 * 3600}'
+    else:
+        # Log of a build which is still running.
+        response.cache_control.no_store = True
     etag = (zlib.adler32(blob).to_bytes(4, 'little') +
             (len(blob) & 0xffffffff).to_bytes(4, 'little'))
     if ctime:
@@ -372,7 +431,22 @@ def serve_static(path: str) -> werkzeug.wrappers.Response:
                        res.make_conditional(flask.request))
 
 
-if __name__ == '__main__':
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Runs NayDuck UI server.')
+    parser.add_argument('--prebuild',
+                        action='store_true',
+                        help='speculatively build master commits ahead of '
+                        'the nightly run')
+    args = parser.parse_args()
+
     metrics.initialise(app)
     schedule_nightly_run_check(datetime.timedelta(seconds=10))
+    schedule_lease_sweep()
+    schedule_test_durations_update()
+    if args.prebuild:
+        schedule_prebuild()
     app.run(debug=False, host='0.0.0.0', port=5005)
+
+
+if __name__ == '__main__':
+    main()
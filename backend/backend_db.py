@@ -1,3 +1,5 @@
+# pylint: disable=too-many-lines
+import codecs
 import collections
 import datetime
 import gzip
@@ -12,6 +14,13 @@ _Row = typing.Any
 _Dict = dict[str, typing.Any]
 _BuildKey = tuple[bool, str]
 
+# How far back to look at finished tests when estimating test durations.
+_DURATION_HISTORY = datetime.timedelta(days=30)
+
+# Maximum size of build logs returned by get_build_info.  Longer logs are
+# shortened to their beginning and end.
+_BUILD_SHORT_LOG_SIZE = 64 * 1024
+
 
 def _pop_falsy(dictionary: _Dict, *keys: str) -> None:
     """Remove keys from a dictionary if their values are falsy."""
@@ -88,11 +97,14 @@ class BackendDB(common_db.DB):
                                       finished = NULL,
                                       stderr = ''::bytea,
                                       stdout = ''::bytea,
-                                      status = 'PENDING'
+                                      status = 'PENDING',
+                                      artifact_id = NULL
                                 WHERE build_id IN ({','.join(build_ids)})
                                   AND (status = 'BUILD FAILED' OR
                                        (status = 'BUILD DONE' AND
                                         builder_ip = 0))''')
+                self._reuse_artifacts([int(bid) for bid in build_ids])
+            self._notify(common_db.PENDING_TESTS_CHANNEL)
             return len(rows)
 
         return self._in_transaction(execute)
@@ -274,17 +286,78 @@ class BackendDB(common_db.DB):
     def get_build_info(self, build_id: int) -> typing.Optional[_Dict]:
         sql = '''SELECT run_id, status, started, finished, stderr, stdout,
                         features, is_release, branch, encode(sha, 'hex') AS sha,
-                        title, requester
+                        title, requester, artifact_id, expensive,
+                        expensive_packages
                    FROM builds JOIN runs USING (run_id)
                   WHERE build_id = :id
                   LIMIT 1'''
         build = self._fetch_one(sql, id=build_id)
         if build:
-            build['stdout'] = self._str_from_blob(build['stdout'])
-            build['stderr'] = self._str_from_blob(build['stderr'])
-            _pop_falsy(build, 'stdout', 'stderr')
+            for log_type in ('stdout', 'stderr'):
+                data, size = self.__get_build_short_log(build_id, log_type)
+                if size is None:
+                    data = self._str_from_blob(build[log_type])
+                    size = len(data)
+                build[log_type] = data
+                build[log_type + '_size'] = size
+            sql = '''SELECT phase, wall_time, cpu_time, peak_rss
+                       FROM build_phases
+                      WHERE build_id = :id
+                      ORDER BY phase'''
+            build['phases'] = self._fetch_all(sql, id=build_id)
+            _pop_falsy(build, 'stdout', 'stderr', 'artifact_id', 'phases',
+                       'expensive_packages')
         return build
 
+    def __get_build_short_log(
+            self, build_id: int,
+            log_type: str) -> tuple[str, typing.Optional[int]]:
+        """Returns beginning and end of a build log stored in chunks.
+
+        Args:
+            build_id: Build id to return log for.
+            log_type: Name of the log to return.
+        Returns:
+            A (short_log, size) tuple where the first element is the log or, if
+            it’s longer than _BUILD_SHORT_LOG_SIZE, its beginning and end
+            separated by a line with three dots.  The second element is size of
+            the log or None if the log isn’t stored in chunks (i.e. it’s an old
+            build whose logs are stored in the builds table or build hasn’t
+            started yet).
+        """
+        # Chunks are picked by their offsets since they may be of any size;
+        # builders flush whatever output there is every few seconds.
+        sql = '''WITH chunks AS (SELECT start, data FROM build_logs
+                                 WHERE build_id = :id AND type = :type),
+                       total AS (SELECT MAX(start + LENGTH(data)) AS size
+                                   FROM chunks)
+                  SELECT size,
+                         (SELECT STRING_AGG(data, ''::bytea ORDER BY start)
+                            FROM chunks
+                           WHERE start < :half OR size <= :limit) AS head,
+                         (SELECT STRING_AGG(data, ''::bytea ORDER BY start)
+                            FROM chunks
+                           WHERE start + LENGTH(data) > size - :half
+                             AND size > :limit) AS tail
+                    FROM total'''
+        half = _BUILD_SHORT_LOG_SIZE // 2
+        row = self._exec(sql,
+                         id=build_id,
+                         type=log_type,
+                         half=half,
+                         limit=_BUILD_SHORT_LOG_SIZE).one()
+        if row.size is None:
+            return '', None
+        size = int(row.size)
+        if size <= _BUILD_SHORT_LOG_SIZE:
+            return str(row.head, 'utf-8', 'replace'), size
+        head = str(row.head[:half], 'utf-8', 'ignore')
+        tail = str(row.tail[-half:], 'utf-8', 'ignore')
+        # Don’t show partial lines.
+        head = head[:head.rfind('\n') + 1]
+        tail = tail[tail.find('\n') + 1:]
+        return f'{head}...\n{tail}', size
+
     def get_history_for_branch(self, test_id: int,
                                branch: str) -> typing.Optional[_Row]:
         sql = 'SELECT name FROM tests WHERE test_id = :id LIMIT 1'
@@ -411,46 +484,221 @@ class BackendDB(common_db.DB):
             'builds',
             ('run_id', 'status', 'is_release', 'features', 'low_priority'),
             [builds_row(itm) for itm in build_items],
-            returning=('build_id', 'is_release', 'features'))
+            returning=('build_id', 'is_release', 'features')).fetchall()
 
         # Into Tests
+        durations = self.__get_test_durations(
+            test for tests in builds.values() for test in tests)
         columns = ('run_id', 'build_id', 'name', 'category', 'timeout',
-                   'skip_build', 'branch', 'is_nightly')
-        new_rows = sorted((run_id, build_id, test.short_name, test.category,
-                           test.timeout, test.skip_build, branch, is_nightly)
-                          for build_id, is_release, features in rows
-                          for test in builds[(is_release, features)])
+                   'skip_build', 'branch', 'is_nightly', 'expected_duration')
+        new_rows = sorted(
+            (run_id, build_id, test.short_name, test.category, test.timeout,
+             test.skip_build, branch, is_nightly,
+             durations.get(test.normalised_identifier, test.timeout))
+            for build_id, is_release, features in rows
+            for test in builds[(is_release, features)])
         self._multi_insert('tests', columns, new_rows)
 
+        # Builds identical to ones whose artifacts are still around (e.g. of an
+        # earlier run on the same commit) don’t need to be built again.
+        self._reuse_artifacts([build_id for build_id, _, _ in rows])
+        self._notify(common_db.PENDING_TESTS_CHANNEL)
+
         return run_id
 
-    def get_tests_by_status(self, status) -> typing.Optional[_Dict]:
-        sql = '''SELECT test_id, status, name, started, timeout
-                   FROM tests
-                  WHERE status = :status
-                  ORDER BY status'''
-        tests = self._fetch_all(sql, status=status)
+    def schedule_speculative_builds(
+            self, *, sha: str, title: str,
+            tests: typing.Iterable[testspec.TestSpec]) -> typing.Optional[int]:
+        """Schedules speculative builds needed by given tests.
 
-        return tests
+        Adds a run without any tests holding low priority speculative builds for
+        all builds the tests depend on.  The builds compile expensive tests of
+        the whole workspace if any of their tests is expensive.  A run scheduled
+        later on the same commit reuses their artifacts; see
+        DB._reuse_artifacts.  Does nothing if speculative builds for the commit
+        have already been scheduled.
 
-    def clear_stale_tests(self, test_ids) -> int:
-        """Clears RUNNING tests status for given test_ids
         Args:
-            test_ids: List of test_id's.
+            sha: Commit sha to build.
+            title: Subject of the commit.
+            tests: Tests whose builds to schedule.  Tests which skip the build
+                are ignored.
         Returns:
-            Number of affected tests.
+            Id of the scheduled run or None if the commit already has one.
         """
+        builds: dict[_BuildKey, bool] = {}
+        for test in tests:
+            if not test.skip_build:
+                key = (test.is_release, test.features)
+                builds[key] = builds.get(key, False) or (test.category
+                                                         == 'expensive')
+        return self._in_transaction(self.__do_schedule_speculative,
+                                    sha=sha,
+                                    title=title,
+                                    builds=builds)
+
+    def __do_schedule_speculative(
+            self, *, sha: str, title: str,
+            builds: typing.Mapping[_BuildKey, bool]) -> typing.Optional[int]:
+        """Implementation of schedule_speculative_builds."""
+        sql = '''SELECT 1 FROM runs
+                  WHERE requester = :requester AND sha = :sha'''
+        if self._exec(sql,
+                      requester=common_db.PREBUILD_REQUESTER,
+                      sha=bytes.fromhex(sha)).first():
+            return None
+        run_id = self._insert('runs',
+                              'run_id',
+                              branch='master',
+                              sha=bytes.fromhex(sha),
+                              title=title,
+                              requester=common_db.PREBUILD_REQUESTER)
+        if not builds:
+            return run_id
+        rows = self._multi_insert(
+            'builds', ('run_id', 'status', 'is_release', 'features',
+                       'low_priority', 'speculative', 'expensive'),
+            [(run_id, 'PENDING', is_release, features, True, True, expensive)
+             for (is_release, features), expensive in sorted(builds.items())],
+            returning=('build_id',)).scalars().all()
+        self._reuse_artifacts(rows)
+        return run_id
 
-        def execute() -> int:
-            sql = '''UPDATE tests
-                        SET status = 'PENDING',
-                            tries = tries - 1
-                      WHERE test_id IN :ids
-                        AND status = 'RUNNING'
-                      '''
+    def collect_speculative_builds(self) -> int:
+        """Deletes speculative builds which are not going to be used.
 
-            rowcount = int(self._exec(sql, ids=tuple(test_ids)).rowcount or 0)
-            return rowcount
+        Pending speculative builds are deleted once a newer speculative build is
+        scheduled.  Finished unused ones (see common_db.UNUSED_SPECULATIVE_SQL)
+        are deleted once their builder releases them and deletes their
+        artifacts; see BuilderDB.get_stored_builds.  Runs left without builds
+        are deleted as well.
+
+        Returns:
+            Number of deleted builds.
+        """
+        sql = f'''DELETE FROM builds AS source
+                  WHERE (status = 'PENDING' AND speculative AND
+                         EXISTS (SELECT 1 FROM builds
+                                  WHERE builds.speculative
+                                    AND builds.run_id > source.run_id))
+                     OR (builder_ip = 0 AND
+                         {common_db.UNUSED_SPECULATIVE_SQL})'''
+        count = int(
+            self._exec(sql, ttl=common_db.SPECULATIVE_BUILD_TTL).rowcount or 0)
+        sql = '''DELETE FROM runs
+                  WHERE requester = :requester
+                    AND NOT EXISTS (SELECT 1 FROM builds
+                                     WHERE builds.run_id = runs.run_id)
+                    AND run_id < (SELECT MAX(run_id) FROM runs
+                                   WHERE requester = :requester)'''
+        self._exec(sql, requester=common_db.PREBUILD_REQUESTER)
+        return count
+
+    def __get_test_durations(
+            self, tests: typing.Iterable[testspec.TestSpec]) -> dict[str, int]:
+        """Returns expected durations of given tests.
+
+        Args:
+            tests: Tests to look up.
+        Returns:
+            A dictionary mapping normalised identifiers of the tests to their
+            expected duration in seconds.  Tests without known duration are
+            missing from the dictionary.
+        """
+        identifiers = tuple({test.normalised_identifier for test in tests})
+        if not identifiers:
+            return {}
+        sql = '''SELECT identifier, duration
+                   FROM test_durations
+                  WHERE identifier IN :ids'''
+        return {
+            row.identifier: int(row.duration)
+            for row in self._exec(sql, ids=identifiers)
+        }
+
+    def update_test_durations(self) -> int:
+        """Recomputes expected test durations from recently finished tests.
+
+        Durations are averaged per test’s normalised identifier (so that history
+        survives test renames) and saved in the test_durations table.  New runs
+        look up the estimates when they’re scheduled so that workers can order
+        pending tests by expected duration without computing anything when
+        claiming them.
+
+        Returns:
+            Number of tests whose duration is now known.
+        """
+        sql = '''SELECT name,
+                        COUNT(*),
+                        AVG(EXTRACT(EPOCH FROM finished - started))
+                   FROM tests
+                  WHERE finished >= NOW() - :history
+                    AND started IS NOT NULL
+                    AND status IN ('PASSED', 'FAILED', 'TIMEOUT')
+                  GROUP BY name'''
+        totals: dict[str, tuple[float, int]] = {}
+        for name, samples, duration in self._exec(sql,
+                                                  history=_DURATION_HISTORY):
+            try:
+                identifier = testspec.TestSpec(name).normalised_identifier
+            except ValueError:
+                continue
+            total, count = totals.get(identifier, (0.0, 0))
+            totals[identifier] = (total + float(duration) * samples,
+                                  count + samples)
+        rows = [(identifier, round(total / count), count)
+                for identifier, (total, count) in totals.items()]
+
+        def execute() -> None:
+            self._exec('DELETE FROM test_durations')
+            for start in range(0, len(rows), 1000):
+                self._multi_insert('test_durations',
+                                   ('identifier', 'duration', 'samples'),
+                                   rows[start:start + 1000])
+
+        self._in_transaction(execute)
+        return len(rows)
+
+    def reclaim_expired_leases(self) -> list[float]:
+        """Puts RUNNING tests whose leases have expired back to PENDING.
+
+        Workers renew leases of tests they own every few seconds.  A test whose
+        lease expired belongs to a worker which crashed or lost connection to
+        the database and is given back so another worker can run it.  Tests
+        without a lease (claimed by workers which predate leases) expire once
+        they’ve been running longer than their timeout.
+
+        Returns:
+            For each reclaimed test, number of seconds between its lease
+            expiring and it being reclaimed.
+        """
+
+        def execute() -> list[float]:
+            sql = '''WITH expired AS (
+                         SELECT test_id,
+                                COALESCE(lease_expires,
+                                         started + timeout * INTERVAL '1 second')
+                                  AS expires
+                           FROM tests
+                          WHERE status = 'RUNNING'
+                            AND COALESCE(lease_expires,
+                                         started + timeout * INTERVAL '1 second')
+                                < NOW()
+                            FOR UPDATE SKIP LOCKED)
+                     UPDATE tests
+                        SET status = 'PENDING',
+                            started = NULL,
+                            lease_expires = NULL,
+                            worker_ip = 0,
+                            worker_hostname = NULL,
+                            tries = GREATEST(tries - 1, 0)
+                       FROM expired
+                      WHERE tests.test_id = expired.test_id
+                  RETURNING EXTRACT(EPOCH FROM NOW() - expired.expires)'''
+            latencies = [float(row[0]) for row in self._exec(sql)]
+            if latencies:
+                self._notify(common_db.PENDING_TESTS_CHANNEL)
+            return latencies
 
         return self._in_transaction(execute)
 
@@ -663,6 +911,11 @@ class BackendDB(common_db.DB):
     ) -> tuple[bytes, typing.Optional[datetime.datetime], bool]:
         """Returns given build log.
 
+        Output of builds is stored in chunks in the build_logs table as the
+        build runs so this returns partial log if the build hasn’t finished
+        yet.  Logs of builds from before that was the case are stored in the
+        builds table.
+
         Args:
             build_id: Build id to return log for.
             log_type: Name of the log to return.  Can be either 'stderr' or
@@ -672,16 +925,106 @@ class BackendDB(common_db.DB):
                 decompressed log.
         Returns:
             A (contents, ctime, is_compressed) tuple where the first element is
-            contents of the log, second is time the file was created and third
-            says whether the contents is compressed or not.  Third element is
-            always False if gzip_ok argument is False.
+            contents of the log, second is time the build finished (or None if
+            it hasn’t finished yet) and third says whether the contents is
+            compressed or not.  Third element is always False if gzip_ok
+            argument is False.
         Raises:
             KeyError: if given log does not exist.
             AssertionError: if log_type is not 'stderr' or 'stdout'.
         """
         assert log_type in ('stderr', 'stdout')
-        sql = f'SELECT finished, {log_type} FROM builds WHERE build_id = :id'
-        return self._get_log_impl(sql, id=build_id, gzip_ok=gzip_ok)
+        chunks_sql = '''SELECT STRING_AGG(data, ''::bytea ORDER BY start)
+                          FROM build_logs
+                         WHERE build_id = :id AND type = :type'''
+        sql = f'''SELECT finished, COALESCE(({chunks_sql}), {log_type})
+                    FROM builds
+                   WHERE build_id = :id'''
+        return self._get_log_impl(sql,
+                                  id=build_id,
+                                  type=log_type,
+                                  gzip_ok=gzip_ok)
+
+    def get_live_log(self, kind: str, obj_id: int, log_type: str, offset: int,
+                     limit: int) -> typing.Optional[_Dict]:
+        """Returns part of output of a running test or build.
+
+        Workers store output of running tests in the live_logs table in
+        chunks, keeping only the end of the output.  Builders store all output
+        of builds in the build_logs table.  This method returns up to `limit`
+        bytes of the output starting at `offset`.  If the output at that offset
+        is no longer (or not yet) available, returns data starting at the first
+        available offset after it.
+
+        Args:
+            kind: Either 'test' or 'build'.
+            obj_id: Test or build id to return log for.
+            log_type: Name of the log to return.  Can be either 'stderr' or
+                'stdout'.
+            offset: Offset in the output to start at; i.e. value of ‘next’
+                field returned by previous call or zero.
+            limit: Maximum number of bytes of output to return.
+        Returns:
+            None if test or build doesn’t exist or a dictionary with the
+            following keys: ‘offset’ — offset in the output the returned data
+            starts at, ‘next’ — offset to request next, ‘size’ — number of bytes
+            of output available in the database, ‘status’ — status of the test
+            or build and ‘data’ — the output.  Once test’s status is no longer
+            RUNNING, its full logs should be fetched instead.
+        Raises:
+            AssertionError: if kind is not 'test' or 'build' or log_type is not
+                'stderr' or 'stdout'.
+        """
+        assert log_type in ('stderr', 'stdout')
+        chunks_table = {'test': 'live_logs', 'build': 'build_logs'}[kind]
+        sql = f'''SELECT status,
+                         (SELECT MAX(start + LENGTH(data))
+                            FROM {chunks_table}
+                           WHERE {kind}_id = :id AND type = :type) AS size
+                    FROM {kind}s
+                   WHERE {kind}_id = :id'''
+        obj = self._fetch_one(sql, id=obj_id, type=log_type)
+        if not obj:
+            return None
+        # Fetch chunks which end after offset and start less than `limit`
+        # bytes after the first one of them; that’s at most what’s needed to
+        # return `limit` bytes.
+        sql = f'''WITH chunks AS (
+                     SELECT start, data
+                       FROM {chunks_table}
+                      WHERE {kind}_id = :id
+                        AND type = :type
+                        AND start + LENGTH(data) > :offset)
+                  SELECT start, data
+                    FROM chunks
+                   WHERE start < GREATEST(:offset,
+                                          (SELECT MIN(start) FROM chunks)) +
+                                 :limit
+                   ORDER BY start'''
+        data = bytearray()
+        start = offset
+        for row in self._exec(sql,
+                              id=obj_id,
+                              type=log_type,
+                              offset=offset,
+                              limit=limit):
+            if not data:
+                start = max(offset, row.start)
+            elif row.start > start + len(data):
+                break  # Worker dropped some output; resume after the gap.
+            data += row.data[start + len(data) - row.start:]
+        del data[limit:]
+        # Don’t split UTF-8 sequences between responses.
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        text = decoder.decode(bytes(data))
+        end = start + len(data) - len(decoder.getstate()[0])
+        return {
+            'offset': start,
+            'next': end,
+            'size': obj['size'] or 0,
+            'status': obj['status'],
+            'data': text,
+        }
 
     def _get_log_impl(
         self, sql: str, gzip_ok: bool, **kw: typing.Any
@@ -0,0 +1,89 @@
+import os
+import typing
+
+import pytest
+
+# The tests write to the database configured in ~/.nayduck/database.json so
+# they only run when it’s explicitly marked as a scratch database.  This is
+# checked before importing the database module so that collecting the tests
+# doesn’t need database configuration.
+if not os.environ.get('NAYDUCK_SCRATCH_DB'):
+    pytest.skip('set NAYDUCK_SCRATCH_DB=1 to run against a scratch database',
+                allow_module_level=True)
+
+# pylint: disable=wrong-import-position
+from sqlalchemy import exc
+
+from . import backend_db
+
+_LIMIT = backend_db._BUILD_SHORT_LOG_SIZE  # pylint: disable=protected-access
+
+
+class _TestDB(backend_db.BackendDB):
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.run_ids: list[int] = []
+
+    def create_build(self) -> int:
+        """Creates a run with a single build; returns id of the build."""
+        run_id = self._insert('runs',
+                              'run_id',
+                              branch='test',
+                              sha=os.urandom(20),
+                              title='Backend database test',
+                              requester='backend-db-test')
+        self.run_ids.append(run_id)
+        return self._insert('builds',
+                            'build_id',
+                            run_id=run_id,
+                            status='BUILDING')
+
+    def add_chunks(self, build_id: int, data: bytes, chunk_size: int) -> None:
+        """Stores build’s stdout split into chunks of given size."""
+        self._multi_insert(
+            'build_logs', ('build_id', 'type', 'start', 'data'),
+            [(build_id, 'stdout', start, data[start:start + chunk_size])
+             for start in range(0, len(data), chunk_size)])
+
+    def delete_runs(self) -> None:
+        for run_id in self.run_ids:
+            self._exec('DELETE FROM runs WHERE run_id = :id', id=run_id)
+
+
+@pytest.fixture(name='db')
+def _db() -> typing.Iterator[_TestDB]:
+    try:
+        db = _TestDB()
+        db.create_build()
+    except exc.OperationalError as ex:
+        pytest.skip(f'database unavailable: {ex}')
+    with db:
+        try:
+            yield db
+        finally:
+            db.delete_runs()
+
+
+def test_build_short_log(db: _TestDB):
+    # Builders flush output every few seconds so chunks are often small.
+    data = b''.join(f'line {index}\n'.encode() for index in range(20000))
+    assert len(data) > 2 * _LIMIT
+
+    build_id = db.create_build()
+    db.add_chunks(build_id, data[:_LIMIT], 100)
+    build = db.get_build_info(build_id)
+    assert build
+    assert build['stdout'] == data[:_LIMIT].decode()
+    assert build['stdout_size'] == _LIMIT
+
+    build_id = db.create_build()
+    db.add_chunks(build_id, data, 100)
+    build = db.get_build_info(build_id)
+    assert build
+    assert build['stdout_size'] == len(data)
+    head, tail = build['stdout'].split('...\n')
+    assert data.startswith(head.encode())
+    assert data.endswith(tail.encode())
+    assert _LIMIT // 2 - 100 < len(head) <= _LIMIT // 2
+    assert _LIMIT // 2 - 100 < len(tail) <= _LIMIT // 2
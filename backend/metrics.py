@@ -9,6 +9,20 @@ from . import backend_db
 _Sample = prometheus_client.samples.Sample
 _Samples = typing.Iterable[prometheus_client.samples.Sample]
 
+RECLAIMED_TESTS = prometheus_client.Counter(
+    'nayduck_reclaimed_tests',
+    'Number of orphaned tests put back to PENDING after their worker stopped '
+    'renewing their leases')
+RECLAIM_LATENCY = prometheus_client.Histogram(
+    'nayduck_test_reclaim_latency_seconds',
+    'Time between lease of an orphaned test expiring and the test being put '
+    'back to PENDING',
+    buckets=(1, 2, 5, 10, 30, 60, 300, 3600))
+SPECULATIVE_BUILDS = prometheus_client.Counter(
+    'nayduck_speculative_builds',
+    'Number of speculative builds of master commits by event: scheduled or '
+    'collected without being used', ['event'])
+
 
 class StatusMetric(prometheus_client.metrics.MetricWrapperBase):
     _type = prometheus_client.Enum._type  # pylint: disable=protected-access
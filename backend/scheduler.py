@@ -12,7 +12,7 @@ import typing
 import pytz
 
 from lib import testspec
-from . import backend_db
+from . import backend_db, metrics
 
 
 class Failure(Exception):
@@ -134,6 +134,10 @@ class CommitInfo(typing.NamedTuple):
         return title[:150 - len(suffix)] + suffix
 
 
+# How long before the next nightly run is due speculative builds of master
+# start being scheduled; see prebuild_master.
+PREBUILD_LEAD = datetime.timedelta(hours=4)
+
 _VALID_FEATURE = re.compile(r'^[a-zA-Z0-9_][-a-zA-Z0-9_]*$')
 _TEST_COUNT_LIMIT = 1024
 _SENTINEL = object()
@@ -232,26 +236,80 @@ def schedule_nightly_run() -> datetime.timedelta:
     """Schedules a new nightly run if last one was over 24 hours ago."""
     with backend_db.BackendDB() as server:
         try:
-            _handle_stale_tests(server)
             return _schedule_nightly_impl(server)
         except Exception:
             traceback.print_exc()
             return datetime.timedelta(hours=1)
 
 
-def _handle_stale_tests(server: backend_db.BackendDB) -> None:
-    stale_tests = []
-    running_tests = server.get_tests_by_status('RUNNING')
+def prebuild_master() -> None:
+    """Schedules speculative builds of master for the next nightly run.
+
+    Once the next nightly run is due within PREBUILD_LEAD, low priority builds
+    of the current master commit are scheduled for all builds its nightly tests
+    need.  When the nightly run is scheduled, its builds reuse artifacts of the
+    speculative builds rather than waiting for builders.  Whenever master
+    advances the builds are scheduled again for the new commit and old ones
+    are garbage-collected; see BackendDB.collect_speculative_builds.
+    """
+    with backend_db.BackendDB() as server:
+        try:
+            _prebuild_master_impl(server)
+            count = server.collect_speculative_builds()
+        except Exception:
+            traceback.print_exc()
+            return
+    if count:
+        print(f'Collected {count} unused speculative builds', file=sys.stderr)
+        metrics.SPECULATIVE_BUILDS.labels('collected').inc(count)
+
+
+def _prebuild_master_impl(server: backend_db.BackendDB) -> None:
+    """Implementation of prebuild_master."""
+    last = server.last_nightly_run()
+    if last:
+        now = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)
+        if now - last.timestamp < datetime.timedelta(hours=24) - PREBUILD_LEAD:
+            return
+    repo_dir = _update_repo()
+    commit = CommitInfo.for_commit(repo_dir, 'master')
+    if last and last.sha == commit.sha:
+        # Nightly is not going to run on the same commit again.
+        return
+    tests = _read_tests(repo_dir, commit.sha)
+    run_id = server.schedule_speculative_builds(sha=commit.sha,
+                                                title=commit.title,
+                                                tests=tests)
+    if run_id:
+        print(f'Scheduled speculative builds of {commit.sha}: /#/run/{run_id}',
+              file=sys.stderr)
+        metrics.SPECULATIVE_BUILDS.labels('scheduled').inc()
+
+
+def reclaim_expired_leases() -> None:
+    """Puts tests whose workers stopped renewing their leases back to PENDING."""
+    with backend_db.BackendDB() as server:
+        try:
+            latencies = server.reclaim_expired_leases()
+        except Exception:
+            traceback.print_exc()
+            return
+    if latencies:
+        print(f'Reclaimed {len(latencies)} orphaned tests', file=sys.stderr)
+        metrics.RECLAIMED_TESTS.inc(len(latencies))
+        for latency in latencies:
+            metrics.RECLAIM_LATENCY.observe(latency)
 
-    for test in running_tests:
-        # check if test is in RUNNING state for longer than timeout allows
-        if test['started'] < datetime.datetime.utcnow().replace(
-                tzinfo=pytz.UTC) - datetime.timedelta(seconds=test['timeout']):
-            stale_tests.append(test['test_id'])
 
-    if stale_tests:
-        result = server.clear_stale_tests(stale_tests)
-        print(f"Cleared {result} stale tests")
+def update_test_durations() -> None:
+    """Refreshes expected test durations used to order pending tests."""
+    with backend_db.BackendDB() as server:
+        try:
+            count = server.update_test_durations()
+            print(f'Updated expected durations of {count} tests',
+                  file=sys.stderr)
+        except Exception:
+            traceback.print_exc()
 
 
 def _read_tests(repo_dir: pathlib.Path, sha: str) -> list[testspec.TestSpec]:
@@ -0,0 +1,244 @@
+import argparse
+import multiprocessing
+import multiprocessing.synchronize
+import os
+import pathlib
+import socket
+import statistics
+import struct
+import tempfile
+import time
+import typing
+
+import prometheus_client
+
+from lib import common_db
+from lib import testspec
+from workers import artifact_server
+from workers import artifacts
+from workers import builder_db
+from workers import utils
+from workers import worker_db
+
+_BENCH_REQUESTER = 'fanout-benchmark'
+# All of 127.0.0.0/8 is routed to the loopback interface on Linux so every
+# worker can have an address of its own and serve its cache on the same port
+# as real workers.
+_BUILDER_IP = '127.0.0.2'
+_WORKER_NET = '127.0.1.'
+
+# Files of the simulated build with their sizes as fractions of neard’s.
+_BUILD_FILES = (
+    ('target/neard', 1),
+    ('target/genesis-populate', 4),
+    ('target/restaked', 4),
+    ('near-test-contracts/contract_rs.wasm', 100),
+)
+
+
+class _Config(typing.NamedTuple):
+    """Parameters of a single benchmark run shared by all processes."""
+    root: pathlib.Path
+    build_id: int
+    files: typing.Sequence[common_db.ArtifactFile]
+    peers: bool
+    rate: float
+
+
+class _Sync(typing.NamedTuple):
+    """Synchronisation of processes of a single benchmark run."""
+    # All processes are ready to start fetching or serving the build.
+    ready: multiprocessing.synchronize.Barrier
+    # All workers have fetched the build and servers can be stopped.
+    stop: multiprocessing.synchronize.Event
+
+
+class _WorkerResult(typing.NamedTuple):
+    elapsed: float
+    source: str
+
+
+class BenchDB(common_db.DB):
+
+    def create_run(self) -> tuple[int, int]:
+        """Creates a run with a single build; returns their ids."""
+        run_id = self._insert('runs',
+                              'run_id',
+                              branch='bench',
+                              sha=os.urandom(20),
+                              title='Artifact fan-out benchmark',
+                              requester=_BENCH_REQUESTER)
+        build_id = self._insert('builds',
+                                'build_id',
+                                run_id=run_id,
+                                status='BUILDING',
+                                builder_ip=_ip_to_int(_BUILDER_IP))
+        return run_id, build_id
+
+    def delete_run(self, run_id: int) -> None:
+        self._exec('DELETE FROM runs WHERE run_id = :id', id=run_id)
+
+
+def _ip_to_int(addr: str) -> int:
+    return typing.cast(int, struct.unpack('!I', socket.inet_aton(addr))[0])
+
+
+def _make_build(build_dir: pathlib.Path,
+                size: int) -> list[common_db.ArtifactFile]:
+    """Creates a build directory resembling a real one with random contents."""
+    for name, fraction in _BUILD_FILES:
+        path = build_dir / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'wb') as wr:
+            for _ in range(size // fraction // (1 << 20)):
+                wr.write(os.urandom(1 << 20))
+        path.chmod(0o755 if name.startswith('target/') else 0o644)
+    return artifacts.scan_build_dir(build_dir)
+
+
+def _run_builder(config: _Config, sync: _Sync,
+                 results: 'multiprocessing.Queue[float]') -> None:
+    """Serves the build until told to stop; reports number of bytes sent."""
+    server = artifact_server.ArtifactServer(config.root / 'builds',
+                                            host=_BUILDER_IP,
+                                            max_rate=config.rate)
+    server.start()
+    sync.ready.wait()
+    sync.stop.wait()
+    server.shutdown()
+    results.put(
+        prometheus_client.REGISTRY.get_sample_value(
+            'nayduck_artifact_served_bytes_total') or 0.0)
+
+
+def _run_worker(index: int, config: _Config, sync: _Sync,
+                results: 'multiprocessing.Queue[_WorkerResult]') -> None:
+    """Fetches the build and then serves it to others until told to stop."""
+    addr = _ip_to_int(f'{_WORKER_NET}{index + 1}')
+    root = config.root / f'worker-{index}'
+    (root / 'repo/runtime/near-test-contracts/res').mkdir(parents=True)
+    cache = artifacts.BuildCache(1, root / 'cache')
+    server = artifact_server.ArtifactServer(root / 'cache',
+                                            utils.PEER_ARTIFACT_PORT,
+                                            host=utils.int_to_ip(addr),
+                                            max_rate=config.rate)
+    server.start()
+    with worker_db.WorkerDB(addr, f'fanout-{index}') as db, \
+         utils.Runner() as runner:
+        sync.ready.wait()
+        start = time.monotonic()
+        cache.prepare(config.build_id,
+                      _ip_to_int(_BUILDER_IP),
+                      testspec.TestSpec('pytest sanity/bench.py'),
+                      runner,
+                      root / 'repo',
+                      files=config.files,
+                      peers=db if config.peers else None)
+        elapsed = time.monotonic() - start
+        source = next(
+            source for source in ('peer', 'builder', 'scp')
+            if prometheus_client.REGISTRY.get_sample_value(
+                'nayduck_worker_artifact_sources_total', {'source': source}))
+        results.put(_WorkerResult(elapsed, source))
+        sync.stop.wait()
+        db.withdraw_builds([config.build_id])
+    server.shutdown()
+
+
+def run_benchmark(*, peers: bool, workers: int, size: int, rate: float) -> None:
+    """Runs a single benchmark and prints its results to standard output."""
+    with tempfile.TemporaryDirectory() as tmp, BenchDB() as db:
+        run_id, build_id = db.create_run()
+        try:
+            root = pathlib.Path(tmp)
+            files = _make_build(root / 'builds' / str(build_id), size)
+            with builder_db.BuilderDB(_ip_to_int(_BUILDER_IP)) as builder:
+                builder.update_build_status(build_id, True, files=files)
+            outcomes, elapsed, served = _run_processes(
+                _Config(root, build_id, files, peers, rate), workers)
+        finally:
+            db.delete_run(run_id)
+    total = sum(file.size for file in files)
+    print(f'{"peers" if peers else "builder only"}: {workers} workers, '
+          f'{total / 1e6:.0f} MB build, '
+          f'{rate / 1e6:.0f} MB/s per host')
+    _report(outcomes, elapsed, served / total)
+
+
+def _run_processes(config: _Config,
+                   workers: int) -> tuple[list[_WorkerResult], float, float]:
+    """Runs builder and worker processes until all workers fetch the build.
+
+    Returns:
+        A (outcomes, elapsed, served) tuple where first element are results
+        reported by each worker, second is wall time it took for all of them to
+        fetch the build and third is number of bytes the builder sent.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    sync = _Sync(ctx.Barrier(workers + 2), ctx.Event())
+    served: 'multiprocessing.Queue[float]' = ctx.Queue()
+    results: 'multiprocessing.Queue[_WorkerResult]' = ctx.Queue()
+    procs = [ctx.Process(target=_run_builder, args=(config, sync, served))]
+    procs.extend(
+        ctx.Process(target=_run_worker, args=(index, config, sync, results))
+        for index in range(workers))
+    for proc in procs:
+        proc.start()
+    sync.ready.wait()
+    start = time.monotonic()
+    outcomes = [results.get() for _ in range(workers)]
+    elapsed = time.monotonic() - start
+    sync.stop.set()
+    builder_served = served.get()
+    for proc in procs:
+        proc.join()
+    return outcomes, elapsed, builder_served
+
+
+def _report(outcomes: typing.Sequence[_WorkerResult], elapsed: float,
+            copies: float) -> None:
+    """Prints summary of a single benchmark run."""
+    times = sorted(outcome.elapsed for outcome in outcomes)
+    sources = {
+        source: sum(outcome.source == source for outcome in outcomes)
+        for source in ('peer', 'builder', 'scp')
+    }
+    print(f'  fan-out:     all workers done in {elapsed:.1f} s')
+    print(f'  per worker:  p50={statistics.median(times):.1f} s '
+          f'p90={times[len(times) * 9 // 10]:.1f} s max={times[-1]:.1f} s')
+    print('  sources:     ' + ', '.join(
+        f'{count} from {source}' for source, count in sources.items() if count))
+    print(f'  builder:     sent {copies:.1f} copies of the build')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Benchmarks distributing build artifacts to many workers '
+        'at once with and without fetching from peers.  Builder and workers '
+        'run as local processes with bandwidth of each of them limited to '
+        'simulate network links.  Must be run on Linux against a scratch '
+        'database.')
+    parser.add_argument('--workers', type=int, default=50)
+    parser.add_argument('--size',
+                        type=int,
+                        default=256,
+                        help='size of neard in MB; other files are smaller')
+    parser.add_argument('--rate',
+                        type=float,
+                        default=100,
+                        help='bandwidth of each host in MB/s')
+    parser.add_argument('--mode',
+                        choices=('builder', 'peers', 'both'),
+                        default='both')
+    args = parser.parse_args()
+
+    for peers in (False, True):
+        if args.mode in ('both', 'peers' if peers else 'builder'):
+            run_benchmark(peers=peers,
+                          workers=args.workers,
+                          size=args.size << 20,
+                          rate=args.rate * 1e6)
+
+
+if __name__ == '__main__':
+    main()
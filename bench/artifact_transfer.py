@@ -0,0 +1,236 @@
+import argparse
+import collections
+import functools
+import os
+import pathlib
+import resource
+import statistics
+import subprocess
+import tempfile
+import time
+import typing
+
+from lib import common_db
+from workers import artifact_server
+from workers import artifacts
+from workers import utils
+from workers import worker_db
+
+
+class _Sample(typing.NamedTuple):
+    wall_time: float
+    local_cpu: float
+    builder_cpu: float
+
+
+class TransferDB(common_db.DB):
+
+    def get_builder_ip(self, build_id: int) -> int:
+        """Returns IP address of the builder given build is stored on."""
+        sql = 'SELECT builder_ip FROM builds WHERE build_id = :id'
+        return int(self._exec(sql, id=build_id).scalar_one())
+
+
+def _builder_cpu(host: str) -> float:
+    """Returns CPU time in seconds the builder has spent on all its cores.
+
+    This covers all processes running on the builder (e.g. sshd for scp
+    transfers) and the kernel (e.g. sendfile(2) for HTTP transfers).
+    """
+    line = subprocess.check_output(
+        ('ssh', '-oBatchMode=yes', host, 'head', '-n1', '/proc/stat'),
+        text=True)
+    # user nice system idle iowait irq softirq steal ...
+    fields = [int(field) for field in line.split()[1:]]
+    busy = sum(fields[:3]) + sum(fields[5:8])
+    return busy / os.sysconf('SC_CLK_TCK')
+
+
+def _local_cpu() -> float:
+    """Returns CPU time used by this process and its finished children."""
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def _scp(host: str, build_id: int,
+         files: typing.Sequence[common_db.ArtifactFile],
+         dst_dir: pathlib.Path) -> None:
+    """Copies files with one scp per directory like workers fall back to."""
+    by_dir: dict[str, list[str]] = collections.defaultdict(list)
+    for file in files:
+        by_dir[os.path.dirname(file.path)].append(
+            f'{host}:{utils.BUILDS_DIR}/{build_id}/{file.path}')
+    for parent, srcs in by_dir.items():
+        (dst_dir / parent).mkdir(parents=True, exist_ok=True)
+        subprocess.check_call(
+            ('scp', '-q', '-oBatchMode=yes', *srcs, dst_dir / parent))
+
+
+def _measure(host: str, transfer: typing.Callable[[pathlib.Path],
+                                                  None]) -> _Sample:
+    """Runs a single transfer into a scratch directory and measures it."""
+    with tempfile.TemporaryDirectory(dir=utils.WORKDIR) as tmp:
+        builder_start = _builder_cpu(host)
+        local_start = _local_cpu()
+        start = time.monotonic()
+        transfer(pathlib.Path(tmp))
+        wall_time = time.monotonic() - start
+        local_cpu = _local_cpu() - local_start
+        builder_cpu = _builder_cpu(host) - builder_start
+    return _Sample(wall_time, local_cpu, builder_cpu)
+
+
+def _report(label: str, size: int, samples: typing.Sequence[_Sample]) -> None:
+    """Prints medians of given samples."""
+    wall_time = statistics.median(sample.wall_time for sample in samples)
+    local_cpu = statistics.median(sample.local_cpu for sample in samples)
+    builder_cpu = statistics.median(sample.builder_cpu for sample in samples)
+    print(
+        f'{label:<10} {wall_time:7.2f} s  {size / wall_time / 1e6:8.1f} MB/s  '
+        f'worker CPU {local_cpu:6.2f} s  builder CPU {builder_cpu:6.2f} s')
+
+
+def _compression_levels(src_dir: pathlib.Path,
+                        files: typing.Sequence[common_db.ArtifactFile],
+                        levels: typing.Sequence[int], threads: int,
+                        link: float) -> None:
+    """Prints cost and benefit of compressing the build at given levels.
+
+    Files are compressed and decompressed locally with the same commands the
+    artifact server and workers use.  Download time over a link of given
+    bandwidth is estimated assuming decompression keeps up with the transfer
+    unless it’s slower than the link.
+    """
+    large = [
+        file for file in files
+        if file.size >= artifact_server.MIN_COMPRESSED_SIZE
+    ]
+    size = sum(file.size for file in large)
+    print(f'{len(large)} files of at least '
+          f'{artifact_server.MIN_COMPRESSED_SIZE >> 20} MiB, '
+          f'{size / 1e6:.1f} MB; raw download over {link / 1e6:.0f} MB/s link '
+          f'takes {size / link:.2f} s')
+    for level in levels:
+        with tempfile.TemporaryDirectory(dir=utils.WORKDIR) as tmp:
+            dsts = [
+                pathlib.Path(tmp, f'{index}.zst') for index in range(len(large))
+            ]
+            compress = _measure_locally(
+                functools.partial(_compress_all, src_dir, large, dsts,
+                                  artifact_server.Compression(level, threads)))
+            compressed = sum(dst.stat().st_size for dst in dsts)
+            decompress = _measure_locally(
+                functools.partial(_decompress_all, dsts))
+        download = max(compressed / link, decompress.wall_time)
+        print(f'zstd -{level:<3} ratio {size / compressed:5.2f}  '
+              f'compress {compress.wall_time:6.2f} s '
+              f'(CPU {compress.local_cpu:6.2f} s)  '
+              f'decompress {decompress.wall_time:6.2f} s '
+              f'(CPU {decompress.local_cpu:6.2f} s)  '
+              f'download ~{download:.2f} s')
+
+
+def _compress_all(src_dir: pathlib.Path,
+                  files: typing.Sequence[common_db.ArtifactFile],
+                  dsts: typing.Sequence[pathlib.Path],
+                  compression: artifact_server.Compression) -> None:
+    for file, dst in zip(files, dsts):
+        artifact_server.compress_file(src_dir / file.path, dst, compression)
+
+
+def _decompress_all(srcs: typing.Sequence[pathlib.Path]) -> None:
+    for src in srcs:
+        subprocess.check_call(('zstd', '-d', '-q', '-f', '-o', os.devnull, src))
+
+
+def _measure_locally(func: typing.Callable[[], None]) -> _Sample:
+    """Runs given function and measures its wall and local CPU time."""
+    local_start = _local_cpu()
+    start = time.monotonic()
+    func()
+    return _Sample(time.monotonic() - start, _local_cpu() - local_start, 0)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Compares copying build artifacts with scp and '
+        'downloading them from builder’s artifact server with and without '
+        'compression, and reports cost and ratio of compression at different '
+        'levels.  Run it on a worker '
+        'against an otherwise idle builder since builder’s CPU use is measured '
+        'for the whole machine.')
+    parser.add_argument('build_id',
+                        type=int,
+                        help='build whose artifacts to transfer; it must have '
+                        'a manifest')
+    parser.add_argument(
+        '--streams',
+        type=int,
+        action='append',
+        help='number of parallel HTTP streams to test; may be '
+        f'given multiple times (default: {artifacts.HTTP_STREAMS})')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=3,
+                        help='number of transfers to run with each method')
+    parser.add_argument('--level',
+                        type=int,
+                        action='append',
+                        help='zstd compression level to report cost of; may '
+                        'be given multiple times (default: 1, 3, 9 and 19)')
+    parser.add_argument('--threads',
+                        type=int,
+                        default=artifact_server.Compression().threads,
+                        help='number of threads to compress with; 0 uses all '
+                        'cores')
+    parser.add_argument('--link',
+                        type=float,
+                        default=125,
+                        help='network bandwidth in MB/s to estimate download '
+                        'times of compressed build for (default: 1 Gb/s)')
+    args = parser.parse_args()
+
+    with TransferDB() as server:
+        host = utils.int_to_ip(server.get_builder_ip(args.build_id))
+    with worker_db.WorkerDB(0, 'bench') as server:
+        files = server.get_build_files(args.build_id)
+    if not files:
+        raise SystemExit(f'Build #{args.build_id} has no manifest')
+    size = sum(file.size for file in files)
+    url = f'http://{host}:{utils.ARTIFACT_PORT}/{args.build_id}'
+    print(f'Build #{args.build_id} on {host}: {len(files)} files, '
+          f'{size / 1e6:.1f} MB')
+
+    # The first transfers warm up builder’s page cache and make sure it has
+    # compressed copies of the files so they’re not counted.
+    with tempfile.TemporaryDirectory(dir=utils.WORKDIR) as tmp:
+        artifacts.download_files(url, files, pathlib.Path(tmp), compressed=True)
+        artifacts.download_files(url, files, pathlib.Path(tmp))
+        _compression_levels(pathlib.Path(tmp), files, args.level or
+                            (1, 3, 9, 19), args.threads, args.link * 1e6)
+    _report('scp', size, [
+        _measure(host, functools.partial(_scp, host, args.build_id, files))
+        for _ in range(args.repeat)
+    ])
+    for streams in args.streams or [artifacts.HTTP_STREAMS]:
+        _report(f'http x{streams}', size, [
+            _measure(
+                host,
+                functools.partial(
+                    artifacts.download_files, url, files, streams=streams))
+            for _ in range(args.repeat)
+        ])
+    _report('zstd', size, [
+        _measure(
+            host,
+            functools.partial(
+                artifacts.download_files, url, files, compressed=True))
+        for _ in range(args.repeat)
+    ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import datetime
+import statistics
+import typing
+
+from lib import common_db
+
+
+class _Build(typing.NamedTuple):
+    is_release: bool
+    duration: float
+    same_commit: bool
+    same_features: bool
+
+
+class BuildTimesDB(common_db.DB):
+
+    def get_builds(self, since: datetime.datetime,
+                   until: datetime.datetime) -> typing.Sequence[_Build]:
+        """Returns successful builds which started in given time range.
+
+        Builds which reused artifacts of another build are skipped.  For each
+        build, also returns whether the previous build started by the same
+        builder was of the same commit and whether it had the same features.
+        """
+        sql = '''SELECT is_release,
+                        EXTRACT(EPOCH FROM finished - started) AS duration,
+                        COALESCE(sha = LAG(sha) OVER w, FALSE) AS same_commit,
+                        COALESCE((features, is_release) =
+                                 LAG((features, is_release)) OVER w,
+                                 FALSE) AS same_features,
+                        status, artifact_id, started
+                   FROM builds JOIN runs USING (run_id)
+                  WHERE started >= :since - INTERVAL '1 day'
+                    AND started < :until
+                    AND finished IS NOT NULL
+                 WINDOW w AS (PARTITION BY builder_ip ORDER BY started)'''
+        sql = f'''SELECT is_release, duration, same_commit, same_features
+                    FROM ({sql}) AS builds
+                   WHERE status = 'BUILD DONE'
+                     AND artifact_id IS NULL
+                     AND started >= :since'''
+        return tuple(
+            _Build(bool(row[0]), float(row[1]), bool(row[2]), bool(row[3]))
+            for row in self._exec(sql, since=since, until=until))
+
+
+def _report(label: str, builds: typing.Sequence[_Build]) -> None:
+    """Prints duration statistics of given builds."""
+    print(f'{label}: {len(builds)} builds')
+    for is_release in (False, True):
+        durations = sorted(build.duration
+                           for build in builds
+                           if build.is_release == is_release)
+        if not durations:
+            continue
+        profile = 'release' if is_release else 'dev'
+        print(f'  {profile:<8} p50={statistics.median(durations) / 60:.1f} min '
+              f'p90={durations[len(durations) * 9 // 10] / 60:.1f} min '
+              f'mean={statistics.fmean(durations) / 60:.1f} min')
+    if builds:
+        commit = sum(build.same_commit for build in builds)
+        features = sum(build.same_features for build in builds)
+        print(f'  affinity: {commit} after a build of the same commit, '
+              f'{features} after a build with the same features')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Compares durations of builds before and after given time, '
+        'e.g. a deployment of a builder change.')
+    parser.add_argument('cutoff',
+                        type=datetime.datetime.fromisoformat,
+                        help='time of the change in ISO 8601 format')
+    parser.add_argument('--days',
+                        type=float,
+                        default=7,
+                        help='number of days before and after the cutoff '
+                        'to look at')
+    args = parser.parse_args()
+    cutoff = args.cutoff
+    if not cutoff.tzinfo:
+        cutoff = cutoff.astimezone()
+    period = datetime.timedelta(days=args.days)
+
+    with BuildTimesDB() as server:
+        _report('before', server.get_builds(cutoff - period, cutoff))
+        _report('after', server.get_builds(cutoff, cutoff + period))
+
+
+if __name__ == '__main__':
+    main()
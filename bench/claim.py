@@ -0,0 +1,231 @@
+import argparse
+import multiprocessing
+import multiprocessing.synchronize
+import statistics
+import sys
+import threading
+import time
+import typing
+
+from lib import common_db
+from workers import worker_db
+
+_BENCH_REQUESTER = 'claim-benchmark'
+
+
+class BenchDB(common_db.DB):
+
+    def create_run(self, count: int) -> int:
+        """Creates a run with `count` pending tests ready to be claimed."""
+
+        def execute() -> int:
+            run_id = self._insert('runs',
+                                  'run_id',
+                                  branch='bench',
+                                  sha=bytes(20),
+                                  title='Test claiming benchmark',
+                                  requester=_BENCH_REQUESTER)
+            build_id = self._insert('builds',
+                                    'build_id',
+                                    run_id=run_id,
+                                    status='BUILD DONE',
+                                    builder_ip=1)
+            columns = ('run_id', 'build_id', 'name', 'category', 'branch')
+            rows = [
+                (run_id, build_id, 'pytest sanity/bench.py', 'pytest', 'bench')
+            ] * count
+            for start in range(0, count, 1000):
+                self._multi_insert('tests', columns, rows[start:start + 1000])
+            return run_id
+
+        return self._in_transaction(execute)
+
+    def count_foreign_pending_tests(self) -> int:
+        """Returns number of pending tests which aren’t benchmark’s own."""
+        sql = '''SELECT COUNT(*)
+                   FROM tests JOIN runs USING (run_id)
+                  WHERE status = 'PENDING' AND requester != :requester'''
+        return int(
+            self._exec(sql, requester=_BENCH_REQUESTER).scalar_one() or 0)
+
+    def delete_run(self, run_id: int) -> None:
+        self._exec('DELETE FROM runs WHERE run_id = :id', id=run_id)
+
+    def count_lock_waiters(self) -> int:
+        """Returns number of backends currently waiting on a lock."""
+        sql = '''SELECT COUNT(*)
+                   FROM pg_stat_activity
+                  WHERE datname = current_database()
+                    AND wait_event_type = 'Lock' '''
+        return int(self._exec(sql).scalar_one() or 0)
+
+
+class LegacyWorkerDB(worker_db.WorkerDB):
+    """Worker database using the claim query from before SKIP LOCKED."""
+
+    # pylint: disable=duplicate-code
+
+    def get_pending_tests(
+            self,
+            count: int,
+            cached_builds: typing.Sequence[int] = (),
+            *,
+            free_slots: int = 1,
+            total_slots: int = 1) -> typing.Sequence[worker_db.Test]:
+        del cached_builds, free_slots, total_slots
+        sql = '''SELECT test_id
+                   FROM tests
+                   JOIN builds USING (build_id)
+                  WHERE tests.status = 'PENDING'
+                    AND (skip_build OR
+                         (builds.status = 'BUILD DONE' AND builder_ip != 0))
+                  ORDER BY low_priority
+                  LIMIT 1'''
+        sql = f'''UPDATE tests
+                     SET started = NOW(),
+                         finished = NULL,
+                         status = 'RUNNING',
+                         worker_ip = :ip,
+                         worker_hostname = :hostname,
+                         tries = tries + 1
+                   WHERE test_id IN ({sql})
+               RETURNING test_id, build_id, run_id, name, timeout, skip_build,
+                         tries'''
+        rows = self._exec(sql, ip=self._ipv4, hostname=self.hostname).fetchall()
+        return typing.cast(typing.Sequence[worker_db.Test], rows)
+
+
+class _WorkerResult(typing.NamedTuple):
+    claimed: list[int]
+    latencies: list[float]
+
+
+def _run_worker(index: int, legacy: bool, batch: int,
+                barrier: multiprocessing.synchronize.Barrier,
+                results: 'multiprocessing.Queue[_WorkerResult]') -> None:
+    """Claims tests until there are none left; reports claimed test ids."""
+    cls = LegacyWorkerDB if legacy else worker_db.WorkerDB
+    claimed: list[int] = []
+    latencies: list[float] = []
+    with cls(0x7f000000 + index, f'bench-{index}') as server:
+        barrier.wait()
+        while True:
+            start = time.monotonic()
+            tests = server.get_pending_tests(batch)
+            latencies.append(time.monotonic() - start)
+            if not tests:
+                break
+            claimed.extend(int(test.test_id) for test in tests)
+    results.put(_WorkerResult(claimed, latencies))
+
+
+def _sample_lock_waiters(stop: threading.Event, samples: list[int]) -> None:
+    """Polls number of backends waiting on locks until `stop` is set."""
+    with BenchDB() as server:
+        while not stop.is_set():
+            samples.append(server.count_lock_waiters())
+            time.sleep(0.005)
+
+
+def run_benchmark(*, legacy: bool, workers: int, tests: int,
+                  batch: int) -> None:
+    """Runs a single benchmark and prints its results to standard output."""
+    with BenchDB() as server:
+        run_id = server.create_run(tests)
+    try:
+        outcomes, elapsed, samples = _run_workers(legacy=legacy,
+                                                  workers=workers,
+                                                  batch=batch)
+    finally:
+        with BenchDB() as server:
+            server.delete_run(run_id)
+    mode = 'legacy' if legacy else f'skip-locked batch={batch}'
+    print(f'{mode}: {tests} tests, {workers} workers')
+    _report(outcomes, elapsed, samples)
+
+
+def _run_workers(*, legacy: bool, workers: int,
+                 batch: int) -> tuple[list[_WorkerResult], float, list[int]]:
+    """Runs worker processes until they claim all pending tests.
+
+    Returns:
+        A (outcomes, elapsed, samples) tuple where first element are results
+        reported by each worker, second is wall time it took to claim all tests
+        and third are numbers of backends waiting on a lock sampled throughout
+        the run.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    barrier = ctx.Barrier(workers + 1)
+    results: 'multiprocessing.Queue[_WorkerResult]' = ctx.Queue()
+    procs = [
+        ctx.Process(target=_run_worker,
+                    args=(index, legacy, batch, barrier, results))
+        for index in range(workers)
+    ]
+    for proc in procs:
+        proc.start()
+
+    stop = threading.Event()
+    samples: list[int] = []
+    sampler = threading.Thread(target=_sample_lock_waiters,
+                               args=(stop, samples))
+    sampler.start()
+    barrier.wait()
+    start = time.monotonic()
+    outcomes = [results.get() for _ in procs]
+    elapsed = time.monotonic() - start
+    stop.set()
+    sampler.join()
+    for proc in procs:
+        proc.join()
+    return outcomes, elapsed, samples
+
+
+def _report(outcomes: typing.Sequence[_WorkerResult], elapsed: float,
+            samples: typing.Sequence[int]) -> None:
+    """Prints summary of a single benchmark run."""
+    claimed = [test_id for outcome in outcomes for test_id in outcome.claimed]
+    latencies = sorted(
+        latency for outcome in outcomes for latency in outcome.latencies)
+    waiting = [count for count in samples if count]
+    print(f'  throughput:  {len(claimed)} claims in {elapsed:.2f} s; '
+          f'{len(claimed) / elapsed:.1f} claims/s')
+    print(f'  duplicates:  {len(claimed) - len(set(claimed))}')
+    print(f'  round trip:  p50={statistics.median(latencies) * 1000:.1f} ms '
+          f'p99={latencies[len(latencies) * 99 // 100] * 1000:.1f} ms')
+    print(f'  lock waits:  {len(waiting)} of {len(samples)} samples; '
+          f'mean {statistics.fmean(samples or [0]):.2f} '
+          f'max {max(samples or [0])} waiting backends')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Benchmarks claiming of pending tests by workers.  Must be '
+        'run against a scratch database with no other pending tests.')
+    parser.add_argument('--workers', type=int, default=100)
+    parser.add_argument('--tests', type=int, default=5000)
+    parser.add_argument('--batch', type=int, default=4)
+    parser.add_argument('--mode',
+                        choices=('legacy', 'skip-locked', 'both'),
+                        default='both')
+    args = parser.parse_args()
+
+    with BenchDB() as server:
+        if server.count_foreign_pending_tests():
+            sys.exit('Database has pending tests; refusing to run benchmark')
+
+    if args.mode in ('legacy', 'both'):
+        run_benchmark(legacy=True,
+                      workers=args.workers,
+                      tests=args.tests,
+                      batch=1)
+    if args.mode in ('skip-locked', 'both'):
+        for batch in sorted({1, args.batch}):
+            run_benchmark(legacy=False,
+                          workers=args.workers,
+                          tests=args.tests,
+                          batch=batch)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,10 @@ parallel 'sh -xc {}' ::: \
 	'exec mypy -m fuzzers.main' \
 	'exec mypy -m workers.builder' \
 	'exec mypy -m workers.worker' \
+	'exec mypy -m bench.artifact_fanout' \
+	'exec mypy -m bench.artifact_transfer' \
+	'exec mypy -m bench.build_times' \
+	'exec mypy -m bench.claim' \
 	'exec shellcheck */*.sh'
 
 exec pytest "$@"
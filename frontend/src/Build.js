@@ -1,15 +1,18 @@
-import React, { useState, useEffect } from "react";
+import React, { useCallback, useState, useEffect } from "react";
+import { NavLink } from "react-router-dom";
 
 import * as common from "./common";
 
 
 function Build (props) {
     const [BuildInfo, setBuildInfo] = useState({});
+    const [generation, setGeneration] = useState(0);
+    const refresh = useCallback(() => setGeneration(gen => gen + 1), []);
 
     useEffect(() => {
         common.fetchAPI('/build/' + (0 | props.match.params.build_id))
             .then(data => setBuildInfo(data));
-    }, [props.match.params.build_id]);
+    }, [props.match.params.build_id, generation]);
 
     const statusCell = BuildInfo.status ? <td className={
         common.statusClassName('text', BuildInfo.status)
@@ -20,7 +23,7 @@ function Build (props) {
         return blob ? common.logRow({
             storage: '/logs/build/' + id + '/' + name,
             log: blob,
-            size: blob.length,
+            size: BuildInfo[name + '_size'] || blob.length,
             type: name
         }) : null;
     };
@@ -28,6 +31,18 @@ function Build (props) {
     const logRows = () => {
         const stderr = BuildInfo.stderr;
         const stdout = BuildInfo.stdout;
+        if (BuildInfo.status === 'BUILDING') {
+            const id = (0 | props.match.params.build_id);
+            return <>
+              <tr><th colSpan="2">Live output</th></tr>
+              <tr>
+                <td>stderr</td>
+                <td><common.LiveTail path={'/build/' + id + '/tail/stderr'}
+                                     status="BUILDING"
+                                     onDone={refresh}/></td>
+              </tr>
+            </>;
+        }
         return stderr || stdout ? <>
             <tr><th colSpan="2">Logs</th></tr>
             {logRow('stderr', stderr)}
@@ -35,6 +50,25 @@ function Build (props) {
         </> : null;
     };
 
+    const phaseRows = () => {
+        const phases = BuildInfo.phases;
+        if (!phases) {
+            return null;
+        }
+        const formatMiB = bytes => (bytes / (1 << 20)).toFixed(0) + ' MiB';
+        return <>
+          <tr><th colSpan="2">Phases</th></tr>
+          {phases.map(phase => <tr key={phase.phase}>
+            <td>{phase.phase}</td>
+            <td>
+              {common.formatTimeDelta(phase.wall_time * 1000)} wall time,{' '}
+              {common.formatTimeDelta(phase.cpu_time * 1000)} CPU time,{' '}
+              {formatMiB(phase.peak_rss)} peak RSS
+            </td>
+          </tr>)}
+        </>;
+    };
+
     const buildType = (() => {
         const type = BuildInfo.is_release ? 'Release' : 'Dev';
         const features = BuildInfo.features;
@@ -56,8 +90,20 @@ function Build (props) {
           <td>{common.formatRequester(BuildInfo.requester)}</td>
         </tr>
         <tr><td>Build Type</td><td>{buildType}</td></tr>
+        {BuildInfo.expensive ? <tr>
+          <td>Expensive tests</td>
+          <td>{BuildInfo.expensive_packages ?
+               BuildInfo.expensive_packages.join(', ') : 'All packages'}</td>
+        </tr> : null}
         {common.formatTimeStatsRows('Build Time', BuildInfo)}
         <tr><td>Status</td>{statusCell}</tr>
+        {BuildInfo.artifact_id ? <tr>
+          <td>Artifacts</td>
+          <td>Reused from <NavLink to={"/build/" + BuildInfo.artifact_id}>
+            build #{BuildInfo.artifact_id}
+          </NavLink></td>
+        </tr> : null}
+        {phaseRows()}
         {logRows()}
       </tbody></table>
     </>;
@@ -56,6 +56,11 @@ const processRun = run => {
             words.splice(pos, 1);
         }
 
+        pos = words.findIndex(word => word.startsWith('--slots='));
+        if (pos !== -1) {
+            words.splice(pos, 1);
+        }
+
         test.name = words.join(' ');
 
         let short_name;
@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from "react";
+import React, { useCallback, useState, useEffect } from "react";
 
 import * as common from "./common"
 
@@ -122,6 +122,8 @@ function formatTriesCount(test) {
 function ATest(props) {
     const [aTest, setATest] = useState(null);
     const [baseBranchHistory, setBaseBranchHistory] = useState(null);
+    const [generation, setGeneration] = useState(0);
+    const refresh = useCallback(() => setGeneration(gen => gen + 1), []);
     const baseBranch = "master";
 
     useEffect(() => {
@@ -135,13 +137,14 @@ function ATest(props) {
                 setBaseBranchHistory(null);
             }
         });
-    }, [props.match.params.test_id]);
+    }, [props.match.params.test_id, generation]);
 
     const gitBisectCommand = aTest && aTest.first_bad && aTest.last_good ?
         <div><code><small>
             git bisect start {aTest.first_bad.substr(0, 8)} {aTest.last_good.substr(0, 8)}
         </small></code></div> : null;
 
+    const testId = 0 | props.match.params.test_id;
     const { testBaseName, testCommand } = parseTestName(aTest);
     common.useTitle(aTest && (testBaseName + ' (run #' + aTest.run_id + ')'));
     const statusCls = aTest && common.statusClassName('text', aTest.status);
@@ -172,7 +175,16 @@ function ATest(props) {
                     {formatTriesCount(aTest)}
                     {gitBisectCommand}</td>
             </tr>
-            {aTest.logs ? <>
+            {aTest.status === 'RUNNING' ? <>
+                <tr><th colSpan="2">Live output</th></tr>
+                {['stderr', 'stdout'].map(type => <tr key={type}>
+                    <td>{type}</td>
+                    <td><common.LiveTail
+                            path={'/test/' + testId + '/tail/' + type}
+                            status="RUNNING"
+                            onDone={refresh}/></td>
+                </tr>)}
+            </> : aTest.logs ? <>
                 <tr><th colSpan="2">Logs</th></tr>
                 {aTest.logs.map(common.logRow)}
             </> : null}
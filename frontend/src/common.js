@@ -1,4 +1,4 @@
-import React, { useEffect } from "react";
+import React, { useEffect, useState } from "react";
 import { NavLink } from "react-router-dom";
 import * as ansicolor from "ansicolor";
 
@@ -184,6 +184,50 @@ export function logRow(log) {
 }
 
 
+/* Maximum number of characters of output kept by LiveTail. */
+const LIVE_TAIL_KEEP = 64 * 1024;
+
+
+/**
+ * Follows output of a running test or build.
+ *
+ * Polls the tail API (see get_tail in backend.py) for new output while
+ * `status` matches status reported by the server and shows the most recent
+ * output.  Calls `onDone` once the status changes so that the caller can
+ * fetch full logs.
+ */
+export function LiveTail({path, status, onDone}) {
+    const [text, setText] = useState('');
+
+    useEffect(() => {
+        let offset = 0;
+        let timer = null;
+        let cancelled = false;
+        const poll = () => fetchAPI(path + '?offset=' + offset).then(data => {
+            if (cancelled || !data) {
+                return;
+            }
+            if (data.data) {
+                setText(prev => (prev + data.data).slice(-LIVE_TAIL_KEEP));
+            }
+            offset = data.next;
+            if (data.status !== status) {
+                onDone();
+            } else {
+                timer = setTimeout(poll, data.next < data.size ? 0 : 2000);
+            }
+        });
+        poll();
+        return () => {
+            cancelled = true;
+            clearTimeout(timer);
+        };
+    }, [path, status, onDone]);
+
+    return <div className="blob">{text || '(no output yet)'}</div>;
+}
+
+
 function pad(value) {
     return (value < 10 ? '0' : '') + value;
 }
@@ -218,7 +262,7 @@ export function formatDateTime(timestampMs, utc=false) {
 }
 
 
-function formatTimeDelta(milliseconds) {
+export function formatTimeDelta(milliseconds) {
     milliseconds = 0 | milliseconds;
     const sign = milliseconds < 0 ? '-' : '';
     if (milliseconds < 0) {
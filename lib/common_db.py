@@ -1,4 +1,7 @@
+import datetime
+import functools
 import gzip
+import select
 import time
 import typing
 import sys
@@ -14,7 +17,13 @@ _T = typing.TypeVar('_T')
 _D = typing.TypeVar('_D', bound='DB')
 
 
-def __create_engine() -> sqlalchemy.engine.Engine:
+@functools.cache
+def _engine() -> sqlalchemy.engine.Engine:
+    """Returns the database engine, creating it on first use.
+
+    The engine is created lazily so that modules which use the database can be
+    imported (e.g. by tests) without database configuration.
+    """
     cfg = config.load('database')
     cfg.setdefault('database', 'nayduck')
     cfg.setdefault('username', 'nayduck')
@@ -27,13 +36,55 @@ def __create_engine() -> sqlalchemy.engine.Engine:
                                     max_overflow=20)
 
 
-_ENGINE = __create_engine()
+# Channel notified whenever there may be new tests for workers to pick up.
+PENDING_TESTS_CHANNEL = 'nayduck_pending_tests'
+
+# PostgreSQL regular expression extracting package from short name of an
+# expensive test (see testspec.TestSpec.short_name).  The package is the first
+# argument following the category and its flags.
+EXPENSIVE_PACKAGE_RE = r'^expensive(?: --\S+)* (\S+)'
+
+# Requester of runs holding speculative builds of master commits; see
+# scheduler.prebuild_master.
+PREBUILD_REQUESTER = 'NayDuck prebuild'
+
+# For how long artifacts of a speculative build are kept if no build reuses
+# them.  Speculative builds are also unused once a newer one is scheduled.
+SPECULATIVE_BUILD_TTL = datetime.timedelta(hours=36)
+
+# Condition which is true if the `source` build is a speculative build nobody
+# has reused and which isn’t going to be reused since it’s been superseded by
+# a newer speculative build or it’s been around for longer than :ttl.
+UNUSED_SPECULATIVE_SQL = '''source.speculative
+    AND source.status != 'BUILDING'
+    AND NOT EXISTS (SELECT 1 FROM builds
+                     WHERE builds.artifact_id = source.build_id)
+    AND (source.finished < NOW() - :ttl OR
+         EXISTS (SELECT 1 FROM builds
+                  WHERE builds.speculative
+                    AND builds.run_id > source.run_id))'''
+
+
+class ArtifactFile(typing.NamedTuple):
+    """A file listed in build’s manifest (i.e. the build_files table).
+
+    Attributes:
+        path: Path of the file relative to the build directory, e.g.
+            'target/neard' or 'near-test-contracts/test_contract_rs.wasm'.
+        size: Size of the file in bytes.
+        sha256: SHA-256 digest of file’s contents.
+        executable: Whether the file is executable.
+    """
+    path: str
+    size: int
+    sha256: bytes
+    executable: bool
 
 
 class DB:
 
     def __init__(self) -> None:
-        self.__conn = _ENGINE.connect()
+        self.__conn = _engine().connect()
         self.__transaction: typing.Optional[
             sqlalchemy.engine.Transaction] = None
 
@@ -113,7 +164,7 @@ class DB:
                     print(f'Got {ex}; retrying', file=sys.stderr)
                     time.sleep(1 + retry * 4)
                     retry += 1
-                    self.__conn = _ENGINE.connect()
+                    self.__conn = _engine().connect()
         finally:
             self.__transaction = None
 
@@ -183,6 +234,92 @@ class DB:
         }
         return self._exec(sql, **values)
 
+    def _notify(self, channel: str) -> None:
+        """Sends a notification on given channel.
+
+        If called inside of a transaction, the notification is delivered to the
+        listeners only once the transaction commits.  Multiple notifications on
+        the same channel within a single transaction are collapsed into one.
+
+        Args:
+            channel: Name of the channel to notify.  See Listener class.
+        """
+        self._exec("SELECT pg_notify(:channel, '')", channel=channel)
+
+    def _reuse_artifacts(self, build_ids: typing.Collection[int]) -> int:
+        """Satisfies pending builds with artifacts of identical finished builds.
+
+        Builds are identified by their key: commit SHA, normalised features and
+        whether it’s a release build.  A pending build whose key matches a build
+        which is done and whose artifacts are still on a builder is marked as
+        done right away and pointed at those artifacts through its artifact_id
+        column.  Workers then fetch artifacts of the referenced build.  If the
+        pending build has expensive tests, only a build which compiled
+        expensive tests of all their packages can be reused.
+
+        Referenced builds are locked for share so that a builder can’t delete
+        their artifacts while they are being reused; see
+        BuilderDB.release_builds.
+
+        Args:
+            build_ids: Candidate builds.  Builds which aren’t pending are
+                ignored.
+        Returns:
+            Number of builds which have been satisfied.
+        """
+        if not build_ids:
+            return 0
+        sql = '''WITH candidate AS (
+                     SELECT build_id, sha, is_release, features
+                       FROM builds JOIN runs USING (run_id)
+                      WHERE build_id IN :ids AND status = 'PENDING'
+                 ), source AS MATERIALIZED (
+                     SELECT build_id, builder_ip, expensive, expensive_packages,
+                            sha, is_release, features
+                       FROM builds JOIN runs USING (run_id)
+                      WHERE status = 'BUILD DONE'
+                        AND builder_ip != 0
+                        AND artifact_id IS NULL
+                        AND (sha, is_release, features) IN (
+                                SELECT sha, is_release, features
+                                  FROM candidate)
+                        FOR SHARE OF builds
+                 ), best AS (
+                     SELECT DISTINCT ON (sha, is_release, features) *
+                       FROM source
+                      ORDER BY sha, is_release, features,
+                               expensive DESC,
+                               expensive_packages IS NULL DESC,
+                               build_id DESC
+                 )
+                 UPDATE builds
+                    SET started = NOW(),
+                        finished = NOW(),
+                        status = 'BUILD DONE',
+                        builder_ip = best.builder_ip,
+                        expensive = best.expensive,
+                        expensive_packages = best.expensive_packages,
+                        artifact_id = best.build_id
+                   FROM candidate JOIN best USING (sha, is_release, features)
+                  WHERE builds.build_id = candidate.build_id
+                    AND builds.status = 'PENDING'
+                    AND NOT EXISTS (
+                            SELECT 1 FROM tests
+                             WHERE tests.build_id = builds.build_id
+                               AND tests.status = 'PENDING'
+                               AND tests.category = 'expensive'
+                               AND NOT (best.expensive AND
+                                        (best.expensive_packages IS NULL OR
+                                         SUBSTRING(tests.name FROM :package_re)
+                                         = ANY(best.expensive_packages))))'''
+        count = int(
+            self._exec(sql,
+                       ids=tuple(build_ids),
+                       package_re=EXPENSIVE_PACKAGE_RE).rowcount or 0)
+        if count:
+            self._notify(PENDING_TESTS_CHANNEL)
+        return count
+
     @classmethod
     def _to_dict(cls, row: _Row) -> dict[str, typing.Any]:
         """Converts an SQLAlchemy row into a dictionary."""
@@ -234,3 +371,63 @@ class DB:
         if bytes(blob[:2]) == b'\x1f\x8b':
             blob = gzip.decompress(blob)
         return str(blob, 'utf-8', 'replace')
+
+
+class Listener:
+    """Waits for notifications sent with DB._notify on given channels.
+
+    The object holds a dedicated database connection (outside of the connection
+    pool) on which it LISTENs to the channels.  It should be used as a context
+    manager which closes the connection on exit.
+    """
+
+    def __init__(self, *channels: str) -> None:
+        self.__channels = channels
+        self.__conn = self.__connect()
+
+    def __connect(self) -> typing.Any:
+        """Opens a new connection and starts listening on the channels."""
+        raw = _engine().raw_connection()
+        raw.detach()
+        conn: typing.Any = raw.dbapi_connection
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            for channel in self.__channels:
+                cursor.execute(f'LISTEN "{channel}"')
+        return conn
+
+    def wait(self, timeout: float) -> bool:
+        """Waits for a notification on any of the channels.
+
+        Args:
+            timeout: Maximum time in seconds to wait for.
+        Returns:
+            Whether a notification has been received (or connection to the
+            database has been reset in which case notifications might have been
+            missed).  False if the method timed out.
+        """
+        try:
+            if not self.__conn.notifies:
+                select.select([self.__conn], [], [], timeout)
+                self.__conn.poll()
+            received = bool(self.__conn.notifies)
+            self.__conn.notifies.clear()
+            return received
+        except Exception as ex:
+            print(f'Got {ex}; reconnecting listener', file=sys.stderr)
+            self.close()
+            time.sleep(1)
+            self.__conn = self.__connect()
+            return True
+
+    def close(self) -> None:
+        try:
+            self.__conn.close()
+        except Exception:
+            pass
+
+    def __enter__(self) -> 'Listener':
+        return self
+
+    def __exit__(self, *_: typing.Any) -> None:
+        self.close()
@@ -83,6 +83,64 @@ CREATE TABLE public.auth_cookies (
 
 ALTER TABLE public.auth_cookies OWNER TO nayduck;
 
+--
+-- Name: build_files; Type: TABLE; Schema: public; Owner: nayduck
+--
+
+CREATE TABLE public.build_files (
+    build_id integer NOT NULL,
+    path character varying NOT NULL,
+    size bigint NOT NULL,
+    sha256 bytea NOT NULL,
+    executable boolean DEFAULT false NOT NULL
+);
+
+
+ALTER TABLE public.build_files OWNER TO nayduck;
+
+--
+-- Name: build_logs; Type: TABLE; Schema: public; Owner: nayduck
+--
+
+CREATE TABLE public.build_logs (
+    build_id integer NOT NULL,
+    type character varying NOT NULL,
+    start bigint NOT NULL,
+    data bytea NOT NULL
+);
+
+
+ALTER TABLE public.build_logs OWNER TO nayduck;
+
+--
+-- Name: build_peers; Type: TABLE; Schema: public; Owner: nayduck
+--
+
+CREATE TABLE public.build_peers (
+    build_id integer NOT NULL,
+    worker_ip bigint NOT NULL,
+    transfers integer DEFAULT 0 NOT NULL,
+    updated timestamp with time zone DEFAULT now() NOT NULL
+);
+
+
+ALTER TABLE public.build_peers OWNER TO nayduck;
+
+--
+-- Name: build_phases; Type: TABLE; Schema: public; Owner: nayduck
+--
+
+CREATE TABLE public.build_phases (
+    build_id integer NOT NULL,
+    phase character varying NOT NULL,
+    wall_time real NOT NULL,
+    cpu_time real NOT NULL,
+    peak_rss bigint NOT NULL
+);
+
+
+ALTER TABLE public.build_phases OWNER TO nayduck;
+
 --
 -- Name: builds; Type: TABLE; Schema: public; Owner: nayduck
 --
@@ -98,7 +156,11 @@ CREATE TABLE public.builds (
     features character varying DEFAULT ''::character varying NOT NULL,
     is_release boolean DEFAULT false NOT NULL,
     low_priority boolean DEFAULT false NOT NULL,
-    builder_ip bigint DEFAULT 0 NOT NULL
+    builder_ip bigint DEFAULT 0 NOT NULL,
+    expensive boolean DEFAULT false NOT NULL,
+    artifact_id integer,
+    expensive_packages character varying[],
+    speculative boolean DEFAULT false NOT NULL
 );
 
 
@@ -118,6 +180,20 @@ ALTER TABLE public.builds ALTER COLUMN build_id ADD GENERATED BY DEFAULT AS IDEN
 );
 
 
+--
+-- Name: live_logs; Type: TABLE; Schema: public; Owner: nayduck
+--
+
+CREATE TABLE public.live_logs (
+    test_id integer NOT NULL,
+    type character varying NOT NULL,
+    start bigint NOT NULL,
+    data bytea NOT NULL
+);
+
+
+ALTER TABLE public.live_logs OWNER TO nayduck;
+
 --
 -- Name: logs; Type: TABLE; Schema: public; Owner: nayduck
 --
@@ -164,6 +240,19 @@ ALTER TABLE public.runs ALTER COLUMN run_id ADD GENERATED BY DEFAULT AS IDENTITY
 );
 
 
+--
+-- Name: test_durations; Type: TABLE; Schema: public; Owner: nayduck
+--
+
+CREATE TABLE public.test_durations (
+    identifier character varying NOT NULL,
+    duration integer NOT NULL,
+    samples integer NOT NULL
+);
+
+
+ALTER TABLE public.test_durations OWNER TO nayduck;
+
 --
 -- Name: tests; Type: TABLE; Schema: public; Owner: nayduck
 --
@@ -183,7 +272,9 @@ CREATE TABLE public.tests (
     timeout integer DEFAULT 180 NOT NULL,
     skip_build boolean DEFAULT false NOT NULL,
     tries integer DEFAULT 0 NOT NULL,
-    worker_hostname character varying
+    worker_hostname character varying,
+    expected_duration integer DEFAULT 0 NOT NULL,
+    lease_expires timestamp with time zone
 );
 
 
@@ -211,6 +302,38 @@ ALTER TABLE ONLY public.auth_cookies
     ADD CONSTRAINT auth_cookies_pkey PRIMARY KEY ("timestamp", cookie);
 
 
+--
+-- Name: build_files build_files_pkey; Type: CONSTRAINT; Schema: public; Owner: nayduck
+--
+
+ALTER TABLE ONLY public.build_files
+    ADD CONSTRAINT build_files_pkey PRIMARY KEY (build_id, path);
+
+
+--
+-- Name: build_logs build_logs_pkey; Type: CONSTRAINT; Schema: public; Owner: nayduck
+--
+
+ALTER TABLE ONLY public.build_logs
+    ADD CONSTRAINT build_logs_pkey PRIMARY KEY (build_id, type, start);
+
+
+--
+-- Name: build_peers build_peers_pkey; Type: CONSTRAINT; Schema: public; Owner: nayduck
+--
+
+ALTER TABLE ONLY public.build_peers
+    ADD CONSTRAINT build_peers_pkey PRIMARY KEY (build_id, worker_ip);
+
+
+--
+-- Name: build_phases build_phases_pkey; Type: CONSTRAINT; Schema: public; Owner: nayduck
+--
+
+ALTER TABLE ONLY public.build_phases
+    ADD CONSTRAINT build_phases_pkey PRIMARY KEY (build_id, phase);
+
+
 --
 -- Name: builds builds_pkey; Type: CONSTRAINT; Schema: public; Owner: nayduck
 --
@@ -219,6 +342,14 @@ ALTER TABLE ONLY public.builds
     ADD CONSTRAINT builds_pkey PRIMARY KEY (build_id);
 
 
+--
+-- Name: live_logs live_logs_pkey; Type: CONSTRAINT; Schema: public; Owner: nayduck
+--
+
+ALTER TABLE ONLY public.live_logs
+    ADD CONSTRAINT live_logs_pkey PRIMARY KEY (test_id, type, start);
+
+
 --
 -- Name: logs logs_pkey; Type: CONSTRAINT; Schema: public; Owner: nayduck
 --
@@ -235,6 +366,14 @@ ALTER TABLE ONLY public.runs
     ADD CONSTRAINT runs_pkey PRIMARY KEY (run_id);
 
 
+--
+-- Name: test_durations test_durations_pkey; Type: CONSTRAINT; Schema: public; Owner: nayduck
+--
+
+ALTER TABLE ONLY public.test_durations
+    ADD CONSTRAINT test_durations_pkey PRIMARY KEY (identifier);
+
+
 --
 -- Name: tests tests_pkey; Type: CONSTRAINT; Schema: public; Owner: nayduck
 --
@@ -243,6 +382,13 @@ ALTER TABLE ONLY public.tests
     ADD CONSTRAINT tests_pkey PRIMARY KEY (test_id);
 
 
+--
+-- Name: builds_artifact_id_idx; Type: INDEX; Schema: public; Owner: nayduck
+--
+
+CREATE INDEX builds_artifact_id_idx ON public.builds USING btree (artifact_id) WHERE (artifact_id IS NOT NULL);
+
+
 --
 -- Name: builds_builder_ip_idx; Type: INDEX; Schema: public; Owner: nayduck
 --
@@ -313,6 +459,46 @@ CREATE INDEX tests_name_finished_status_idx ON public.tests USING btree (name, f
 CREATE INDEX tests_run_id_idx ON public.tests USING btree (run_id);
 
 
+--
+-- Name: build_files build_files_build_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: nayduck
+--
+
+ALTER TABLE ONLY public.build_files
+    ADD CONSTRAINT build_files_build_id_fkey FOREIGN KEY (build_id) REFERENCES public.builds(build_id) ON DELETE CASCADE;
+
+
+--
+-- Name: build_logs build_logs_build_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: nayduck
+--
+
+ALTER TABLE ONLY public.build_logs
+    ADD CONSTRAINT build_logs_build_id_fkey FOREIGN KEY (build_id) REFERENCES public.builds(build_id) ON DELETE CASCADE;
+
+
+--
+-- Name: build_peers build_peers_build_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: nayduck
+--
+
+ALTER TABLE ONLY public.build_peers
+    ADD CONSTRAINT build_peers_build_id_fkey FOREIGN KEY (build_id) REFERENCES public.builds(build_id) ON DELETE CASCADE;
+
+
+--
+-- Name: build_phases build_phases_build_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: nayduck
+--
+
+ALTER TABLE ONLY public.build_phases
+    ADD CONSTRAINT build_phases_build_id_fkey FOREIGN KEY (build_id) REFERENCES public.builds(build_id) ON DELETE CASCADE;
+
+
+--
+-- Name: builds builds_artifact_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: nayduck
+--
+
+ALTER TABLE ONLY public.builds
+    ADD CONSTRAINT builds_artifact_id_fkey FOREIGN KEY (artifact_id) REFERENCES public.builds(build_id) ON DELETE SET NULL;
+
+
 --
 -- Name: builds builds_run_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: nayduck
 --
@@ -321,6 +507,14 @@ ALTER TABLE ONLY public.builds
     ADD CONSTRAINT builds_run_id_fkey FOREIGN KEY (run_id) REFERENCES public.runs(run_id) ON DELETE CASCADE;
 
 
+--
+-- Name: live_logs live_logs_test_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: nayduck
+--
+
+ALTER TABLE ONLY public.live_logs
+    ADD CONSTRAINT live_logs_test_id_fkey FOREIGN KEY (test_id) REFERENCES public.tests(test_id) ON DELETE CASCADE;
+
+
 --
 -- Name: logs logs_test_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: nayduck
 --
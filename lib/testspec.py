@@ -13,6 +13,7 @@ class _CategorySpec(typing.NamedTuple):
     is_release: bool
     is_remote: bool
     skip_build: bool
+    slots: int
 
 
 _TIME_SUFFIXES = {'h': 3600, 'm': 60, 's': 1}
@@ -40,6 +41,25 @@ def _parse_timeout(timeout: str) -> int:
         raise ValueError(f'Invalid timeout argument ‘{timeout}’') from ex
 
 
+def _parse_slots(slots: str) -> int:
+    """Parses number of worker slots a test needs.
+
+    Args:
+        slots: A positive integer.
+    Returns:
+        The number of slots.
+    Raises:
+        ValueError: if the string argument is not a positive integer.
+    """
+    try:
+        count = int(slots)
+    except ValueError:
+        count = 0
+    if count < 1:
+        raise ValueError(f'Invalid slots argument ‘{slots}’')
+    return count
+
+
 def _format_timeout(timeout: int) -> str:
     """Formats timeout expressed in seconds as a string with optional suffix.
 
@@ -62,7 +82,8 @@ def _extract_category(words: list[str]) -> _CategorySpec:
 
     Expects words in the format:
 
-        <category> [--timeout=<timeout>] [--skip-build] [--release] [--remote] <args>...
+        <category> [--timeout=<timeout>] [--skip-build] [--release] [--remote]
+                   [--slots=<count>] <args>...
 
     Args:
         words: The test as list of words.  The list is modified in place by
@@ -78,6 +99,7 @@ def _extract_category(words: list[str]) -> _CategorySpec:
     is_release = False
     is_remote = False
     skip_build = False
+    slots = 1
 
     index = 0  # silence pylint warning
     for index, word in enumerate(words):
@@ -91,6 +113,8 @@ def _extract_category(words: list[str]) -> _CategorySpec:
             skip_build = True
         elif word.startswith('--timeout='):
             timeout = _parse_timeout(word[10:])
+        elif word.startswith('--slots='):
+            slots = _parse_slots(word[8:])
         elif word.startswith('--'):
             raise ValueError(f'Invalid argument ‘{word}’')
         else:
@@ -109,7 +133,8 @@ def _extract_category(words: list[str]) -> _CategorySpec:
                          timeout=timeout,
                          is_release=is_release,
                          is_remote=is_remote,
-                         skip_build=skip_build or category == 'mocknet')
+                         skip_build=skip_build or category == 'mocknet',
+                         slots=slots)
 
 
 def _extract_features(words: list[str]) -> str:
@@ -207,7 +232,7 @@ class TestDBRow:
 
 
 @dataclasses.dataclass(frozen=True)
-class TestSpec:
+class TestSpec:  # pylint: disable=too-many-instance-attributes
     """Specification for a test to be run.
 
     Attributes:
@@ -220,6 +245,10 @@ class TestSpec:
             was present in test spec.
         is_remote: Whether the test runs remotely.  True if ‘--remote’ was
             present in test spec.
+        slots: Number of worker slots the test occupies when it runs.  Tests
+            which spawn many nodes or otherwise use a lot of CPU can ask for
+            more than one with ‘--slots=<count>’ so that workers running
+            multiple tests concurrently don’t overcommit the host.
         args: The test arguments past the category and category flags excluding
             any features.  The exact format of the arguments depends on the test
             category.
@@ -230,6 +259,7 @@ class TestSpec:
     is_release: bool
     is_remote: bool
     skip_build: bool
+    slots: int
     args: typing.Sequence[str]
     features: str
 
@@ -265,6 +295,7 @@ class TestSpec:
         object.__setattr__(self, 'is_release', category_spec.is_release)
         object.__setattr__(self, 'is_remote', category_spec.is_remote)
         object.__setattr__(self, 'skip_build', category_spec.skip_build)
+        object.__setattr__(self, 'slots', category_spec.slots)
         object.__setattr__(self, 'args', tuple(words))
         object.__setattr__(self, 'features', features)
 
@@ -337,6 +368,8 @@ class TestSpec:
             result.append('--release')
         if self.is_remote:
             result.append('--remote')
+        if self.slots > 1:
+            result.append(f'--slots={self.slots}')
         result.extend(self.args)
         if self.features:
             result.append(f'--features {self.features}')
@@ -26,6 +26,14 @@ def test_testspec():
          '1320 pytest --timeout=7m --release --remote sanity/test.py'),
         ('pytest --timeout=420 --release --remote --skip-build s/test.py',
          '1320 pytest --skip-build --timeout=7m --release --remote s/test.py'),
+        ('pytest --slots=4 --release sanity/test.py',
+         ' 180 pytest --timeout=3m --release --slots=4 sanity/test.py'),
+        ('pytest --slots=1 sanity/test.py',
+         ' 180 pytest --timeout=3m sanity/test.py'),
+        ('pytest --slots=0 sanity/test.py',
+         'Err: Invalid slots argument ‘0’'),
+        ('pytest --slots=many sanity/test.py',
+         'Err: Invalid slots argument ‘many’'),
         ('pytest sanity/test.py --features foo,bar --features=baz',
          ' 180 pytest --timeout=3m sanity/test.py --features bar,baz,foo'),
         ('pytest sanity/test.py --features foo,adversarial --features=foo',
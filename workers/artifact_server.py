@@ -0,0 +1,344 @@
+import http.server
+import os
+import pathlib
+import re
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import typing
+import urllib.parse
+
+import prometheus_client
+
+from lib import common_db
+
+from . import utils
+
+SERVED_BYTES = prometheus_client.Counter(
+    'nayduck_artifact_served_bytes',
+    'Bytes of build artifacts sent to workers over HTTP')
+SERVED_REQUESTS = prometheus_client.Counter(
+    'nayduck_artifact_server_requests',
+    'Number of HTTP requests for build artifacts by status code', ['code'])
+COMPRESSED_REQUESTS = prometheus_client.Counter(
+    'nayduck_artifact_server_compressed_requests',
+    'Number of requests for build artifacts served with zstd compression by '
+    'whether compressed copy of the file was already cached', ['result'])
+COMPRESSION_TIME = prometheus_client.Counter(
+    'nayduck_artifact_compression_seconds',
+    'Wall time spent compressing build artifacts')
+
+# Directory in a build directory with compressed copies of its files, e.g.
+# `.zst/target/neard.zst`.  Its name starts with a dot so that it cannot be
+# requested directly.
+COMPRESSED_DIR = '.zst'
+# Smaller files aren’t worth compressing.
+MIN_COMPRESSED_SIZE = 1 << 20
+# Modification time of a build directory is bumped when a file from it is
+# served but at most once per this many seconds; see ArtifactServer.mark_used.
+MARK_USED_INTERVAL = 60
+
+# Path of a file in a build directory, i.e. `/<build_id>/<path>`.  Components
+# must not start with a dot which rules out `..` and hidden files.
+_PATH_RE = re.compile(r'^/[0-9]+(?:/[^./][^/]*)+$')
+_RANGE_RE = re.compile(r'^bytes=([0-9]+)-([0-9]*)$')
+
+
+class Compression(typing.NamedTuple):
+    """Settings of zstd compression of build artifacts.
+
+    Higher levels compress better, and thus let workers download artifacts
+    faster over slow links, but take more CPU time.  Compression is done once
+    per file so the cost is mostly in build’s latency.  Decompression speed on
+    workers doesn’t depend on the level much.
+    """
+    # Compression level from 1 to 19.
+    level: int = 3
+    # Number of threads to compress with; 0 uses all cores.
+    threads: int = 0
+
+
+def compressed_path(build_dir: pathlib.Path, path: str) -> pathlib.Path:
+    """Returns path of the compressed copy of a file in a build directory."""
+    return build_dir / COMPRESSED_DIR / (path + '.zst')
+
+
+def compress_file(src: pathlib.Path,
+                  dst: pathlib.Path,
+                  compression: Compression,
+                  runner: typing.Optional[utils.Runner] = None) -> None:
+    """Compresses a file with zstd unless compressed copy already exists.
+
+    The copy is written to a temporary file renamed to `dst` once complete so
+    a partial copy is never served.
+
+    Args:
+        src: File to compress.
+        dst: Path to write compressed copy to.
+        compression: Compression settings.
+        runner: Runner to execute zstd with.  If not given, it’s executed
+            directly.
+    Raises:
+        OSError: if reading or writing the files fails.
+        subprocess.SubprocessError: if compression fails.
+    """
+    if dst.exists():
+        return
+    utils.mkdirs(dst.parent)
+    tmp = dst.with_name(f'{dst.name}.{threading.get_ident()}.tmp')
+    start = time.monotonic()
+    try:
+        cmd = ('zstd', '-q', '-f', f'-{compression.level}',
+               f'-T{compression.threads}', '-o', tmp, '--', src)
+        if runner:
+            runner(cmd, cwd=dst.parent, check=True)
+        else:
+            subprocess.run(cmd, stdin=subprocess.DEVNULL, check=True)
+        tmp.rename(dst)
+    finally:
+        tmp.unlink(missing_ok=True)
+        COMPRESSION_TIME.inc(time.monotonic() - start)
+
+
+def compress_build(build_dir: pathlib.Path,
+                   files: typing.Sequence[common_db.ArtifactFile],
+                   compression: Compression,
+                   runner: typing.Optional[utils.Runner] = None) -> None:
+    """Creates compressed copies of files in a build directory.
+
+    Files smaller than MIN_COMPRESSED_SIZE are skipped.  Doing this ahead of
+    time means workers don’t wait for the artifact server to compress files on
+    the first request.
+
+    Args:
+        build_dir: Directory with build artifacts.
+        files: Build’s manifest as returned by artifacts.scan_build_dir.
+        compression: Compression settings.
+        runner: Runner to execute zstd with; see compress_file.
+    Raises:
+        OSError: if reading or writing the files fails.
+        subprocess.SubprocessError: if compression fails.
+    """
+    for file in files:
+        if file.size >= MIN_COMPRESSED_SIZE:
+            compress_file(build_dir / file.path,
+                          compressed_path(build_dir, file.path), compression,
+                          runner)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """Serves files from the builds directory with support for byte ranges."""
+
+    protocol_version = 'HTTP/1.1'
+    server: 'ArtifactServer'
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        self.__serve(send_body=True)
+
+    def do_HEAD(self) -> None:  # pylint: disable=invalid-name
+        self.__serve(send_body=False)
+
+    def log_request(self,
+                    code: typing.Union[int, str] = '-',
+                    size: typing.Union[int, str] = '-') -> None:
+        SERVED_REQUESTS.labels(str(code)).inc()
+
+    def __serve(self, *, send_body: bool) -> None:
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        if not _PATH_RE.match(path):
+            self.send_error(404)
+            return
+        encoding = None
+        try:
+            src = self.server.compressed(
+                path[1:], self.headers.get('Accept-Encoding', ''))
+            if src:
+                encoding = 'zstd'
+            else:
+                src = self.server.root / path[1:]
+            rd = open(src, 'rb')
+        except OSError:
+            self.send_error(404)
+            return
+        self.server.mark_used(path[1:].partition('/')[0])
+        with rd:
+            size = os.fstat(rd.fileno()).st_size
+            start, end = 0, size
+            # Multiple ranges aren’t supported so such requests get the whole
+            # file which is what RFC 9110 allows.
+            match = _RANGE_RE.match(self.headers.get('Range', ''))
+            if match:
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(end, int(match.group(2)) + 1)
+                if start >= end:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range',
+                                 f'bytes {start}-{end - 1}/{size}')
+            else:
+                self.send_response(200)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Type', 'application/octet-stream')
+            if encoding:
+                self.send_header('Content-Encoding', encoding)
+            self.send_header('Content-Length', str(end - start))
+            self.end_headers()
+            if send_body:
+                self.__send(rd, start, end - start)
+
+    def __send(self, rd: typing.BinaryIO, offset: int, count: int) -> None:
+        """Sends part of a file throttling the transfer if configured to."""
+        # Uses sendfile(2) so the data never goes through user space.
+        chunk = 1 << 20 if self.server.max_rate else count
+        while count > 0:
+            self.server.throttle(min(chunk, count))
+            sent = self.connection.sendfile(rd, offset, min(chunk, count))
+            if not sent:
+                break
+            SERVED_BYTES.inc(sent)
+            offset += sent
+            count -= sent
+
+
+class ArtifactServer(http.server.ThreadingHTTPServer):
+    """HTTP server which lets workers download build artifacts.
+
+    Files in the builds directory are available at `/<build_id>/<path>` URLs,
+    e.g. `/42/target/neard`.  Only GET and HEAD requests of a single byte range
+    are supported; that’s enough for workers to split large files into parts
+    downloaded in parallel and to resume interrupted downloads.  Files are sent
+    with sendfile(2) and, unlike with scp, without encryption which makes
+    serving a build to many workers cheap for the builder.
+
+    Workers run the server as well to serve builds in their artifacts cache
+    (whose layout is the same) to other workers.
+
+    If configured with compression, clients which accept `zstd` content
+    encoding get files of at least MIN_COMPRESSED_SIZE bytes compressed.
+    Compressed copies are cached in the build directory (see compress_build)
+    so each file is compressed once; byte ranges then refer to the compressed
+    copy.
+
+    Serving a file bumps modification time of its build directory so that it
+    tells when the build was last fetched; the builder’s disk.DiskManager and
+    the worker’s artifacts.BuildCache evict least recently used builds by it.
+
+    Build artifacts aren’t secret so there’s no authentication.  The server is
+    read-only and never serves anything outside of the builds directory.
+    """
+
+    daemon_threads = True
+
+    def __init__(self,
+                 root: pathlib.Path = utils.BUILDS_DIR,
+                 port: int = utils.ARTIFACT_PORT,
+                 *,
+                 host: str = '',
+                 max_rate: typing.Optional[float] = None,
+                 compression: typing.Optional[Compression] = None) -> None:
+        """Creates the server; it must be started with start.
+
+        Args:
+            root: Directory to serve.
+            port: Port to listen on.
+            host: Address to listen on; all addresses by default.
+            max_rate: If given, limits number of bytes per second sent by the
+                server over all connections.
+            compression: If given, files are compressed with given settings
+                for clients which accept it.
+        """
+        super().__init__((host, port), _Handler)
+        self.root = root
+        self.max_rate = max_rate
+        self.compression = compression
+        self.__lock = threading.Lock()
+        self.__compress_lock = threading.Lock()
+        self.__next_send = 0.0
+        self.__marked: dict[str, float] = {}
+
+    def throttle(self, size: int) -> None:
+        """Waits until `size` bytes can be sent without exceeding max_rate."""
+        if not self.max_rate:
+            return
+        with self.__lock:
+            now = time.monotonic()
+            start = max(self.__next_send, now)
+            self.__next_send = start + size / self.max_rate
+        time.sleep(start - now)
+
+    def mark_used(self, build_id: str) -> None:
+        """Records that a file from given build has been served.
+
+        Sets modification time of the build directory to now unless it’s been
+        done in the last MARK_USED_INTERVAL seconds.  Unlike access times, this
+        isn’t affected by ‘relatime’ and survives restarts of the server.
+        """
+        now = time.monotonic()
+        with self.__lock:
+            last = self.__marked.get(build_id)
+            if last is not None and now - last < MARK_USED_INTERVAL:
+                return
+            # Forget builds marked long ago so the dictionary doesn’t grow.
+            self.__marked = {
+                key: value
+                for key, value in self.__marked.items()
+                if now - value < MARK_USED_INTERVAL
+            }
+            self.__marked[build_id] = now
+        try:
+            os.utime(self.root / build_id)
+        except FileNotFoundError:
+            # The build has been deleted in the meantime.
+            pass
+
+    def compressed(self, path: str,
+                   accept_encoding: str) -> typing.Optional[pathlib.Path]:
+        """Returns compressed copy of a file to serve if there should be one.
+
+        Compresses the file if it hasn’t been compressed yet.  Compressions are
+        serialised since each of them uses multiple threads anyway.
+
+        Args:
+            path: Path of the file relative to the root directory, i.e.
+                `<build_id>/<path>`.
+            accept_encoding: Value of request’s Accept-Encoding header.
+        Returns:
+            Path of compressed copy of the file or None if the file should be
+            served as is because compression is disabled or failed, client
+            doesn’t accept zstd encoding or the file is too small.
+        Raises:
+            OSError: if the file doesn’t exist.
+        """
+        accepted = (encoding.split(';')[0].strip()
+                    for encoding in accept_encoding.split(','))
+        if not self.compression or 'zstd' not in accepted:
+            return None
+        src = self.root / path
+        if src.stat().st_size < MIN_COMPRESSED_SIZE:
+            return None
+        build_id, _, rel_path = path.partition('/')
+        dst = compressed_path(self.root / build_id, rel_path)
+        if dst.exists():
+            COMPRESSED_REQUESTS.labels('hit').inc()
+            return dst
+        COMPRESSED_REQUESTS.labels('miss').inc()
+        try:
+            with self.__compress_lock:
+                compress_file(src, dst, self.compression)
+        except (OSError, subprocess.SubprocessError):
+            traceback.print_exc()
+            return None
+        return dst
+
+    def start(self) -> None:
+        """Starts serving requests in a background thread."""
+        print(f'Serving artifacts on port {self.server_address[1]}',
+              file=sys.stderr)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
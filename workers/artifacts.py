@@ -0,0 +1,997 @@
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import math
+import os
+import pathlib
+import random
+import shutil
+import stat
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import typing
+
+import prometheus_client
+import requests
+import urllib3
+
+from lib import common_db
+from lib import testspec
+
+from . import artifact_server
+from . import utils
+from . import worker_db
+
+CACHE_DIR = utils.WORKDIR / 'artifacts'
+
+ARTIFACT_REQUESTS = prometheus_client.Counter(
+    'nayduck_worker_artifact_requests',
+    'Number of times build artifacts were needed by a test by whether they '
+    'were already in the local cache', ['result'])
+COPIED_BYTES = prometheus_client.Counter(
+    'nayduck_worker_artifact_copied_bytes',
+    'Bytes of build artifacts copied from builders')
+REUSED_BYTES = prometheus_client.Counter(
+    'nayduck_worker_artifact_reused_bytes',
+    'Bytes of build artifacts taken from the local cache rather than copied '
+    'from builders')
+TRANSFERRED_BYTES = prometheus_client.Counter(
+    'nayduck_worker_artifact_transferred_bytes',
+    'Bytes of build artifacts received over HTTP; with compression this is '
+    'less than number of bytes copied')
+DEDUPLICATED_BYTES = prometheus_client.Counter(
+    'nayduck_worker_artifact_deduplicated_bytes',
+    'Bytes of build artifacts not copied from builders because an identical '
+    'file of another build was already in the local cache')
+ARTIFACT_SOURCES = prometheus_client.Counter(
+    'nayduck_worker_artifact_sources',
+    'Number of times build artifacts were copied by where they were copied '
+    'from: another worker, the builder’s artifact server or the builder over '
+    'scp', ['source'])
+PREFETCHES = prometheus_client.Counter(
+    'nayduck_worker_artifact_prefetches',
+    'Number of times build artifacts of the next test were prefetched while '
+    'another test was running by whether they were already in the cache, '
+    'were copied or copying failed', ['result'])
+SETUP_TIME = prometheus_client.Histogram(
+    'nayduck_worker_artifact_setup_seconds',
+    'Time spent making build artifacts available to a test',
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+
+# Number of connections used to download artifacts from builder’s artifact
+# server and size of parts files are split into to download them in parallel.
+HTTP_STREAMS = 4
+HTTP_PART_SIZE = 64 << 20
+# Timeout in seconds for connecting to the artifact server and for each read.
+HTTP_TIMEOUT = 60
+# Time in seconds copying artifacts for a single test may take in total,
+# including waiting for a source and falling back to other sources.
+FETCH_TIMEOUT = 20 * 60
+# For how long to wait for a peer or the builder to have capacity to serve
+# a download before downloading from the builder anyway; see
+# WorkerDB.acquire_source.
+SOURCE_WAIT = 120
+
+_FilesByDir = dict[pathlib.PurePosixPath, list[common_db.ArtifactFile]]
+
+
+def _dir_size(path: pathlib.Path, prefix: str = '') -> int:
+    """Returns total size of regular files in given directory.
+
+    Args:
+        path: Directory to scan.  It’s not an error if it doesn’t exist.
+        prefix: If given, only files whose names start with it are counted.
+    """
+    try:
+        return sum(entry.stat().st_size
+                   for entry in os.scandir(path)
+                   if entry.name.startswith(prefix) and entry.is_file())
+    except FileNotFoundError:
+        return 0
+
+
+def hash_file(path: pathlib.Path) -> bytes:
+    """Returns SHA-256 digest of given file’s contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as rd:
+        for chunk in iter(lambda: rd.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def scan_build_dir(build_dir: pathlib.Path) -> list[common_db.ArtifactFile]:
+    """Returns manifest of a build directory.
+
+    Args:
+        build_dir: Directory with build artifacts as laid out by the builder.
+    Returns:
+        All regular files in the directory and its subdirectories sorted by
+        path.
+    """
+    files = []
+    for dirpath, dirnames, filenames in os.walk(build_dir):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = pathlib.Path(dirpath, name)
+            attrs = path.stat()
+            if stat.S_ISREG(attrs.st_mode):
+                files.append(
+                    common_db.ArtifactFile(
+                        path.relative_to(build_dir).as_posix(), attrs.st_size,
+                        hash_file(path), bool(attrs.st_mode & 0o100)))
+    return files
+
+
+def _link_files(src_dir: pathlib.Path,
+                dst_dir: pathlib.Path,
+                prefix: str = '') -> None:
+    """Hard links files from one directory to another.
+
+    Falls back to copying files if hard linking fails (e.g. because the
+    directories are on different file systems).
+
+    Args:
+        src_dir: Directory to link files from.
+        dst_dir: Directory to put the links in.  It’s created if necessary.
+        prefix: If given, only files whose names start with it are linked.
+    """
+    utils.mkdirs(dst_dir)
+    for entry in os.scandir(src_dir):
+        if not entry.name.startswith(prefix) or not entry.is_file():
+            continue
+        dst = dst_dir / entry.name
+        dst.unlink(missing_ok=True)
+        try:
+            os.link(entry.path, dst)
+        except OSError:
+            shutil.copy2(entry.path, dst)
+
+
+class BuildCache:  # pylint: disable=too-many-instance-attributes
+    """A local cache of build artifacts copied from the builders.
+
+    Every build is kept in its own `<build_id>` directory whose layout is the
+    same as layout of the build directory on the builder, i.e. there are
+    `target`, `near-test-contracts` and `expensive` subdirectories.  Expensive
+    test executables are copied lazily, only once a test needs them.
+
+    Least recently used builds are removed once there are more than `capacity`
+    of them in the cache.
+
+    If the builder stored a manifest of the build (see
+    BuilderDB.update_build_status), files are also kept in an `objects`
+    directory named after their SHA-256 digests.  Files of a new build which
+    are already there (e.g. test contracts and tools which often don’t change
+    between builds with different features) are hard linked from it rather than
+    copied and files which are copied are checked against the manifest.
+    Objects which are no longer part of any build in the cache are removed when
+    builds are evicted.
+
+    Builds in the cache are advertised to other workers which can download them
+    from this worker’s artifact server rather than from the builder.  This way
+    when many workers need the same build (e.g. when a nightly run starts) the
+    builder serves it only to the first few of them.
+
+    Artifacts of a test which is likely to run next can be copied with
+    prefetch while another test is running.  Like all copies, they are
+    written into a staging `<build_id>.tmp` directory renamed once complete so
+    the cache never contains a partial build.
+
+    Unless disabled, large files are downloaded from builder’s artifact server
+    compressed with zstd which trades CPU time for transfer time; see
+    artifact_server.Compression.
+
+    The cache may be shared by multiple worker slots each with its own
+    repository.  Copying is serialised per build so that slots don’t copy the
+    same build twice, and builds which are being copied or linked from can’t
+    be evicted.  Copies of different builds don’t wait for each other so
+    a slow prefetch holds up only a test which needs the very build being
+    prefetched.
+    """
+
+    def __init__(self,
+                 capacity: int,
+                 root: pathlib.Path = CACHE_DIR,
+                 *,
+                 compressed: bool = True) -> None:
+        self.__root = root
+        self.__compressed = compressed
+        self.__objects = root / 'objects'
+        self.__capacity = max(1, capacity)
+        self.__installed: dict[pathlib.Path, int] = {}
+        # Guards eviction, __installed and the per-build locks.
+        self.__lock = threading.Lock()
+        # Locks of builds in use and numbers of threads using them.
+        self.__build_locks: dict[int, threading.Lock] = {}
+        self.__users: dict[int, int] = {}
+        utils.mkdirs(root)
+        # Get rid of any partial copies left after the worker was killed.
+        for path in root.iterdir():
+            if not path.name.isdigit() and path != self.__objects:
+                utils.rmdirs(path)
+        utils.mkdirs(self.__objects)
+
+    def build_ids(self) -> list[int]:
+        """Returns ids of builds in the cache; most recently used first."""
+        entries = [(path.stat().st_mtime, int(path.name))
+                   for path in self.__root.iterdir()
+                   if path.name.isdigit()]
+        return [build_id for _, build_id in sorted(entries, reverse=True)]
+
+    def prepare(self,
+                build_id: int,
+                builder_ip: int,
+                test: testspec.TestSpec,
+                runner: utils.Runner,
+                repo_dir: pathlib.Path = utils.REPO_DIR,
+                *,
+                files: typing.Sequence[common_db.ArtifactFile] = (),
+                peers: typing.Optional[worker_db.WorkerDB] = None) -> None:
+        """Makes artifacts of given build available in the repository.
+
+        Copies the artifacts from the builder unless they are already in the
+        cache and then links them into the `target` and
+        `runtime/near-test-contracts/res` directories in the repository.
+
+        Args:
+            build_id: Build to prepare artifacts of.
+            builder_ip: IP address (as an integer) of the builder the build is
+                located on.
+            test: Test the build is needed for.  Used to determine whether the
+                test is a debug or release one and for expensive tests which
+                test executable is needed.
+            runner: Runner to execute copying commands with.
+            repo_dir: Repository to link the artifacts into.
+            files: Manifest of the build as returned by
+                WorkerDB.get_build_files.  If empty, the build’s directories are
+                copied as a whole.
+            peers: Database to advertise builds in the cache in and to look
+                for other workers with the build in.  If not given, artifacts
+                are always copied from the builder.
+        Raises:
+            OSError: if copying artifacts fails or copied file doesn’t match
+                the manifest.
+            subprocess.SubprocessError: if copying artifacts fails.
+        """
+        start = time.monotonic()
+        remote = _Remote(builder_ip, build_id, peers)
+        with self.__using(build_id):
+            build_dir, cached = self.__fetch(
+                remote,
+                test,
+                runner,
+                files=files,
+                fetch=self.__settings(HTTP_STREAMS))
+            if cached:
+                ARTIFACT_REQUESTS.labels('hit').inc()
+                REUSED_BYTES.inc(
+                    _dir_size(build_dir / 'target') +
+                    _dir_size(build_dir / 'near-test-contracts'))
+            else:
+                ARTIFACT_REQUESTS.labels('miss').inc()
+            with self.__lock:
+                self.__install(build_id, build_dir, test, repo_dir)
+        SETUP_TIME.observe(time.monotonic() - start)
+
+    def prefetch(self,
+                 build_id: int,
+                 builder_ip: int,
+                 test: testspec.TestSpec,
+                 *,
+                 files: typing.Sequence[common_db.ArtifactFile] = (),
+                 peers: typing.Optional[worker_db.WorkerDB] = None) -> None:
+        """Copies artifacts of given build into the cache.
+
+        Meant to be called from a background thread while another test is
+        running so that the next test finds its artifacts in the cache.  Files
+        are downloaded over a single connection to limit the impact on the
+        running test.  Failures aren’t fatal since prepare tries again.
+
+        Args:
+            build_id: Build to prefetch artifacts of.
+            builder_ip: IP address (as an integer) of the builder the build is
+                located on.
+            test: Test the build is needed for; see prepare.
+            files: Manifest of the build; see prepare.
+            peers: Database to look for other workers with the build in; see
+                prepare.  Must not be used by any other thread.
+        """
+        remote = _Remote(builder_ip, build_id, peers)
+        try:
+            with utils.Runner() as runner:
+                with self.__using(build_id):
+                    _, cached = self.__fetch(remote,
+                                             test,
+                                             runner,
+                                             files=files,
+                                             fetch=self.__settings(1))
+            PREFETCHES.labels('hit' if cached else 'copied').inc()
+        except (OSError, subprocess.SubprocessError,
+                requests.exceptions.RequestException):
+            PREFETCHES.labels('failed').inc()
+            traceback.print_exc()
+
+    @contextlib.contextmanager
+    def __using(self, build_id: int) -> typing.Iterator[None]:
+        """Locks given build and keeps it from being evicted while in use."""
+        with self.__lock:
+            lock = self.__build_locks.setdefault(build_id, threading.Lock())
+            self.__users[build_id] = self.__users.get(build_id, 0) + 1
+        try:
+            with lock:
+                yield
+        finally:
+            with self.__lock:
+                self.__users[build_id] -= 1
+                if not self.__users[build_id]:
+                    del self.__users[build_id]
+                    del self.__build_locks[build_id]
+
+    def __settings(self, streams: int) -> '_Fetch':
+        """Returns settings for copying artifacts for a test starting now."""
+        return _Fetch(streams,
+                      time.monotonic() + FETCH_TIMEOUT, self.__compressed)
+
+    def __fetch(self, remote: '_Remote', test: testspec.TestSpec,
+                runner: utils.Runner, *,
+                files: typing.Sequence[common_db.ArtifactFile],
+                fetch: '_Fetch') -> tuple[pathlib.Path, bool]:
+        """Copies artifacts needed by a test into the cache.
+
+        With a manifest, expensive test executable of a build which isn’t in
+        the cache yet is copied along with the rest of the build so that all
+        the files are downloaded concurrently.
+
+        Returns:
+            A (build_dir, cached) tuple where the first element is build’s
+            directory in the cache and the second is whether the build (though
+            not necessarily expensive test executable) was already there.
+        """
+        build_id = remote.build_id
+        build_dir = self.__root / str(build_id)
+
+        expensive = test.args[1] if test.category == 'expensive' else None
+        copied = 0
+        cached = build_dir.is_dir()
+        if not cached:
+            with self.__lock:
+                self.__evict(remote.peers)
+            tmp_dir = self.__root / f'{build_id}.tmp'
+            utils.rmdirs(tmp_dir)
+            if files:
+                selected = [
+                    file for file in files
+                    if not file.path.startswith('expensive/')
+                ]
+                if expensive:
+                    selected.extend(_select_expensive(files, expensive))
+                copied += self.__fetch_files(remote, selected, tmp_dir, runner,
+                                             fetch)
+            else:
+                copied += _scp_build(remote.scp, tmp_dir, runner,
+                                     fetch.deadline)
+            tmp_dir.rename(build_dir)
+            if remote.peers:
+                remote.peers.advertise_build(build_id)
+        os.utime(build_dir)
+
+        if expensive and (cached or not files):
+            copied += self.__fetch_expensive(build_dir,
+                                             remote,
+                                             expensive,
+                                             runner,
+                                             files=files,
+                                             fetch=fetch)
+
+        COPIED_BYTES.inc(copied)
+        return build_dir, cached
+
+    def __fetch_expensive(self, build_dir: pathlib.Path, remote: '_Remote',
+                          test_name: str, runner: utils.Runner, *,
+                          files: typing.Sequence[common_db.ArtifactFile],
+                          fetch: '_Fetch') -> int:
+        """Copies expensive test executable unless it’s already in the cache.
+
+        Returns:
+            Number of bytes copied from the builder.
+        """
+        prefix = test_name + '-'
+        expensive_dir = build_dir / 'expensive'
+        size = _dir_size(expensive_dir, prefix)
+        if size:
+            REUSED_BYTES.inc(size)
+            return 0
+        tmp_dir = build_dir / 'expensive.tmp'
+        utils.rmdirs(tmp_dir)
+        if files:
+            size = self.__fetch_files(remote,
+                                      _select_expensive(files, test_name),
+                                      tmp_dir, runner, fetch)
+            _link_files(tmp_dir / 'expensive', expensive_dir)
+        else:
+            _scp([f'{remote.scp}/expensive/{prefix}*'],
+                 tmp_dir,
+                 runner,
+                 deadline=fetch.deadline)
+            size = _dir_size(tmp_dir)
+            _link_files(tmp_dir, expensive_dir)
+        utils.rmdirs(tmp_dir)
+        return size
+
+    def __fetch_files(self, remote: '_Remote',
+                      files: typing.Sequence[common_db.ArtifactFile],
+                      dst_dir: pathlib.Path, runner: utils.Runner,
+                      fetch: '_Fetch') -> int:
+        """Copies files listed in a manifest skipping ones already in the cache.
+
+        Files whose digests are in the objects directory are hard linked from
+        there.  The rest are downloaded (see _download) and added to the objects
+        directory.
+
+        Args:
+            remote: Where to download the files from.
+            files: Files to copy.
+            dst_dir: Local directory to copy the files into.  Paths of the files
+                are relative to it.
+            runner: Runner to execute copying commands with.
+            fetch: Settings of the download.
+        Returns:
+            Number of bytes copied from the builder.
+        Raises:
+            OSError: if copying fails or copied file doesn’t match the manifest.
+            subprocess.SubprocessError: if copying fails.
+        """
+        missing = []
+        for file in files:
+            dst = dst_dir / file.path
+            utils.mkdirs(dst.parent)
+            try:
+                os.link(self.__objects / file.sha256.hex(), dst)
+                DEDUPLICATED_BYTES.inc(file.size)
+            except FileNotFoundError:
+                missing.append(file)
+
+        if missing:
+            _download(remote, missing, dst_dir, runner, fetch)
+        for file in missing:
+            try:
+                os.link(dst_dir / file.path, self.__objects / file.sha256.hex())
+            except FileExistsError:
+                pass
+        return sum(file.size for file in missing)
+
+    def __install(self, build_id: int, build_dir: pathlib.Path,
+                  test: testspec.TestSpec, repo_dir: pathlib.Path) -> None:
+        """Links artifacts from the cache into the repository."""
+        target_dir = repo_dir / 'target'
+        # The repository may have been recreated since we last linked artifacts
+        # into it so check the target directory is still there.
+        if (self.__installed.get(repo_dir) != build_id or
+                not target_dir.is_dir()):
+            self.__installed.pop(repo_dir, None)
+            utils.rmdirs(target_dir)
+            res_dir = repo_dir / 'runtime/near-test-contracts/res'
+            for path in res_dir.iterdir():
+                if path.suffix == '.wasm':
+                    path.unlink()
+            _link_files(build_dir / 'target', target_dir / test.build_dir)
+            _link_files(build_dir / 'near-test-contracts', res_dir)
+            self.__installed[repo_dir] = build_id
+        if test.category == 'expensive':
+            _link_files(build_dir / 'expensive', target_dir / 'expensive',
+                        test.args[1] + '-')
+
+    def __evict(self, peers: typing.Optional[worker_db.WorkerDB]) -> None:
+        """Removes least recently used builds to make room for a new one.
+
+        Builds in use are kept even if that takes the cache over capacity.
+        Must be called with the lock held.
+        """
+        evicted = [
+            build_id for build_id in self.build_ids()[self.__capacity - 1:]
+            if build_id not in self.__users
+        ]
+        if peers:
+            peers.withdraw_builds(evicted)
+        for build_id in evicted:
+            print(f'Evicting build #{build_id} from artifacts cache',
+                  file=sys.stderr)
+            utils.rmdirs(self.__root / str(build_id))
+        for entry in os.scandir(self.__objects):
+            if entry.stat(follow_symlinks=False).st_nlink == 1:
+                os.unlink(entry.path)
+
+
+def _select_expensive(files: typing.Sequence[common_db.ArtifactFile],
+                      test_name: str) -> list[common_db.ArtifactFile]:
+    """Returns executable of given expensive test from build’s manifest.
+
+    Raises:
+        OSError: if there’s no such executable in the manifest.
+    """
+    prefix = f'expensive/{test_name}-'
+    selected = [file for file in files if file.path.startswith(prefix)]
+    if not selected:
+        raise OSError(f'{test_name}: no test executable in build’s manifest')
+    return selected
+
+
+class _Fetch(typing.NamedTuple):
+    """Settings of copying artifacts for a single test."""
+    # Number of connections to download files over.
+    streams: int
+    # Value of time.monotonic() by which all copying must finish.
+    deadline: float
+    # Whether to ask builder’s artifact server for compressed files.
+    compressed: bool
+
+
+class _Remote(typing.NamedTuple):
+    """Where to copy artifacts of a build from."""
+    builder_ip: int
+    build_id: int
+    # Database to look for peers with the build in; see BuildCache.prepare.
+    peers: typing.Optional[worker_db.WorkerDB] = None
+
+    @property
+    def scp(self) -> str:
+        """Build directory on the builder in `<host>:<path>` format."""
+        host = utils.int_to_ip(self.builder_ip)
+        return f'{host}:{utils.BUILDS_DIR}/{self.build_id}'
+
+    @property
+    def url(self) -> str:
+        """URL of the build directory on builder’s artifact server."""
+        host = utils.int_to_ip(self.builder_ip)
+        return f'http://{host}:{utils.ARTIFACT_PORT}/{self.build_id}'
+
+    def peer_url(self, peer_ip: int) -> str:
+        """URL of the build directory on peer’s artifact server."""
+        host = utils.int_to_ip(peer_ip)
+        return f'http://{host}:{utils.PEER_ARTIFACT_PORT}/{self.build_id}'
+
+
+def _download(remote: _Remote, files: typing.Sequence[common_db.ArtifactFile],
+              dst_dir: pathlib.Path, runner: utils.Runner,
+              fetch: _Fetch) -> None:
+    """Downloads files of a build and verifies them against the manifest.
+
+    Files are downloaded from the least loaded peer or the builder (see
+    WorkerDB.acquire_source) falling back to builder’s artifact server and
+    finally to scp if that fails.  Files are requested compressed only from
+    builder’s artifact server; peers never compress files since they have
+    tests to run.
+
+    Args:
+        remote: Where to download the files from.
+        files: Files to download.
+        dst_dir: Local directory to download the files into.  Paths of the
+            files are relative to it.
+        runner: Runner to execute copying commands with.
+        fetch: Settings of the download.
+    Raises:
+        OSError: if copying fails or copied file doesn’t match the manifest.
+        TimeoutError: if copying didn’t finish by fetch’s deadline.
+        subprocess.SubprocessError: if copying fails.
+    """
+    source = _acquire_source(remote, fetch.deadline)
+    urls = [('builder', remote.url, fetch.compressed)]
+    if source and source != remote.builder_ip:
+        urls.insert(0, ('peer', remote.peer_url(source), False))
+    try:
+        for kind, url, compressed in urls:
+            try:
+                download_files(url,
+                               files,
+                               dst_dir,
+                               streams=fetch.streams,
+                               compressed=compressed,
+                               deadline=fetch.deadline)
+                _verify_files(files, dst_dir)
+                ARTIFACT_SOURCES.labels(kind).inc()
+                return
+            except TimeoutError:
+                raise
+            except (OSError, subprocess.SubprocessError,
+                    requests.exceptions.RequestException):
+                runner.log_traceback()
+    finally:
+        if source and remote.peers:
+            remote.peers.release_source(remote.build_id, source)
+    _scp_files(remote.scp, files, dst_dir, runner, fetch.deadline)
+    _verify_files(files, dst_dir)
+    ARTIFACT_SOURCES.labels('scp').inc()
+
+
+def _acquire_source(remote: _Remote, deadline: float) -> typing.Optional[int]:
+    """Acquires host to download build from waiting until one is available.
+
+    Returns:
+        IP address (as an integer) of the acquired peer or builder or None if
+        no host could be acquired within SOURCE_WAIT seconds or by the
+        deadline.  The host must be released with WorkerDB.release_source.
+    """
+    if not remote.peers:
+        return None
+    deadline = min(deadline, time.monotonic() + SOURCE_WAIT)
+    delay = 0.5
+    while True:
+        source = remote.peers.acquire_source(remote.build_id)
+        if source != 0 or time.monotonic() >= deadline:
+            return source or None
+        time.sleep(delay)
+        delay = min(delay * 2, 5)
+
+
+def _verify_files(files: typing.Sequence[common_db.ArtifactFile],
+                  dst_dir: pathlib.Path) -> None:
+    """Checks that downloaded files match the manifest.
+
+    Raises:
+        OSError: if any of the files doesn’t match its manifest entry.
+    """
+    for file in files:
+        path = dst_dir / file.path
+        if path.stat().st_size != file.size or hash_file(path) != file.sha256:
+            raise OSError(f'{file.path}: contents of copied file do not '
+                          'match build’s manifest')
+
+
+def _remaining(deadline: float) -> float:
+    """Returns number of seconds left until given time.monotonic() deadline.
+
+    Raises:
+        TimeoutError: if the deadline has passed.
+    """
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError('Copying build artifacts took too long')
+    return remaining
+
+
+class _Cancelled(Exception):
+    """Raised by parts of a download stopped because another part failed."""
+
+
+class _Schedule:
+    """Deadline and cancellation shared by all parts of a download."""
+
+    def __init__(self, deadline: float) -> None:
+        self.deadline = deadline
+        self.cancelled = threading.Event()
+
+    def check(self) -> float:
+        """Returns number of seconds left until the deadline.
+
+        Raises:
+            TimeoutError: if the deadline has passed.
+            _Cancelled: if the download has been cancelled.
+        """
+        if self.cancelled.is_set():
+            raise _Cancelled()
+        return _remaining(self.deadline)
+
+
+def download_files(base_url: str,
+                   files: typing.Sequence[common_db.ArtifactFile],
+                   dst_dir: pathlib.Path,
+                   *,
+                   streams: int = HTTP_STREAMS,
+                   compressed: bool = False,
+                   deadline: float = math.inf) -> None:
+    """Downloads files from an artifact server.
+
+    Files are split into parts of at most HTTP_PART_SIZE bytes which are
+    downloaded in parallel over `streams` connections.  Interrupted downloads
+    of a part are resumed from where they stopped so a failure of one part
+    doesn’t restart others.  Once a part fails for good, or the deadline
+    passes, the remaining parts are cancelled.
+
+    With compression, files the server may compress (see
+    artifact_server.MIN_COMPRESSED_SIZE) are instead downloaded whole, each over
+    its own connection, and decompressed as they arrive (see
+    _download_compressed).
+
+    Args:
+        base_url: URL of the build directory on the artifact server.
+        files: Files to download.  Their sizes must match sizes of the files on
+            the server.
+        dst_dir: Local directory to download the files into.  Paths of the
+            files are relative to it.
+        streams: Maximum number of parts downloaded at the same time.
+        compressed: Whether to ask the server to compress files.
+        deadline: Value of time.monotonic() by which the download must finish.
+    Raises:
+        OSError: if writing the files fails or connection was closed too early.
+        TimeoutError: if the download didn’t finish by the deadline.
+        requests.exceptions.RequestException: if downloading fails.
+        subprocess.SubprocessError: if decompressing a file fails.
+    """
+    fds = []
+    try:
+        parts: list[typing.Callable[[_Schedule], None]] = []
+        for file in files:
+            dst = dst_dir / file.path
+            utils.mkdirs(dst.parent)
+            fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o755 if file.executable else 0o644)
+            fds.append(fd)
+            url = f'{base_url}/{file.path}'
+            if compressed and file.size >= artifact_server.MIN_COMPRESSED_SIZE:
+                parts.append(
+                    functools.partial(_download_compressed, url, fd, file.size))
+                continue
+            os.ftruncate(fd, file.size)
+            parts.extend(
+                functools.partial(_download_part, url, fd, start,
+                                  min(start + HTTP_PART_SIZE, file.size))
+                for start in range(0, file.size, HTTP_PART_SIZE))
+        _run_parts(parts, streams, _Schedule(deadline))
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def _run_parts(parts: typing.Sequence[typing.Callable[[_Schedule], None]],
+               streams: int, schedule: _Schedule) -> None:
+    """Runs parts of a download in parallel until all finish or one fails.
+
+    Raises:
+        Exception: exception raised by the first failed part.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max(1, streams)) as executor:
+        futures = [executor.submit(part, schedule) for part in parts]
+        try:
+            done, _ = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+            for future in done:
+                future.result()
+        except BaseException:
+            # Stop parts in progress rather than wait for them to finish.
+            schedule.cancelled.set()
+            executor.shutdown(cancel_futures=True)
+            raise
+
+
+def _download_part(url: str, fd: int, start: int, end: int,
+                   schedule: _Schedule) -> None:
+    """Downloads a byte range of a file retrying and resuming on failures.
+
+    Args:
+        url: URL of the file.
+        fd: File descriptor to write the data to at the same offsets as in the
+            downloaded file.
+        start: Offset of the first byte to download.
+        end: Offset of the byte past the last one to download.
+        schedule: Deadline and cancellation of the download.
+    Raises:
+        OSError: if writing fails or connection was closed too early.
+        TimeoutError: if the deadline passed.
+        requests.exceptions.RequestException: if all attempts failed.
+    """
+    delay = 1 + random.random()
+    for retry in range(3):
+        try:
+            with requests.get(url,
+                              headers={'Range': f'bytes={start}-{end - 1}'},
+                              stream=True,
+                              timeout=min(HTTP_TIMEOUT,
+                                          schedule.check())) as response:
+                if response.status_code != 206:
+                    raise requests.exceptions.HTTPError(
+                        f'{url}: unexpected status {response.status_code}',
+                        response=response)
+                for chunk in response.iter_content(1 << 20):
+                    os.pwrite(fd, chunk, start)
+                    start += len(chunk)
+                    TRANSFERRED_BYTES.inc(len(chunk))
+                    schedule.check()
+            if start >= end:
+                return
+        except requests.exceptions.HTTPError:
+            # The server responded so there’s no point retrying.  This happens
+            # for example if a peer has just evicted the build.
+            raise
+        except requests.exceptions.RequestException:
+            if retry == 2:
+                raise
+        time.sleep(min(delay, schedule.check()))
+        delay *= 2
+    raise OSError(f'{url}: connection closed before whole file was received')
+
+
+def _download_compressed(url: str, fd: int, size: int,
+                         schedule: _Schedule) -> None:
+    """Downloads a whole file asking the server to compress it.
+
+    Compressed response is piped into a zstd process which writes decompressed
+    data straight into the file so there’s no intermediate copy.  If the server
+    sends the file as is (e.g. because it has compression disabled), it’s
+    written directly.  A compressed stream cannot be resumed so failed attempts
+    are restarted from the beginning.
+
+    Args:
+        url: URL of the file.
+        fd: File descriptor to write the file to.
+        size: Expected size of the file.
+        schedule: Deadline and cancellation of the download.
+    Raises:
+        OSError: if writing fails or connection was closed too early.
+        TimeoutError: if the deadline passed.
+        requests.exceptions.RequestException: if all attempts failed.
+        subprocess.SubprocessError: if decompression failed.
+    """
+    delay = 1 + random.random()
+    for retry in range(3):
+        os.ftruncate(fd, 0)
+        os.lseek(fd, 0, os.SEEK_SET)
+        try:
+            with requests.get(url,
+                              headers={'Accept-Encoding': 'zstd'},
+                              stream=True,
+                              timeout=min(HTTP_TIMEOUT,
+                                          schedule.check())) as response:
+                if response.status_code != 200:
+                    raise requests.exceptions.HTTPError(
+                        f'{url}: unexpected status {response.status_code}',
+                        response=response)
+                # Read the body as sent since requests would otherwise try to
+                # decode it itself.
+                chunks = _checked(
+                    response.raw.stream(1 << 20, decode_content=False),
+                    schedule)
+                if response.headers.get('Content-Encoding') == 'zstd':
+                    _decompress(chunks, fd)
+                else:
+                    for chunk in chunks:
+                        os.write(fd, chunk)
+                        TRANSFERRED_BYTES.inc(len(chunk))
+            if os.fstat(fd).st_size == size:
+                return
+        except requests.exceptions.HTTPError:
+            raise
+        except requests.exceptions.RequestException:
+            if retry == 2:
+                raise
+        except urllib3.exceptions.HTTPError as ex:
+            # Reading the raw body bypasses requests’ exception wrapping.
+            if retry == 2:
+                raise requests.exceptions.ConnectionError(ex) from ex
+        time.sleep(min(delay, schedule.check()))
+        delay *= 2
+    raise OSError(f'{url}: connection closed before whole file was received')
+
+
+def _checked(chunks: typing.Iterable[bytes],
+             schedule: _Schedule) -> typing.Iterator[bytes]:
+    """Yields given chunks checking the schedule before each of them."""
+    for chunk in chunks:
+        schedule.check()
+        yield chunk
+
+
+def _decompress(chunks: typing.Iterable[bytes], fd: int) -> None:
+    """Decompresses zstd stream writing the result to given file descriptor.
+
+    Raises:
+        OSError: if writing fails.
+        subprocess.CalledProcessError: if the stream is corrupted.
+    """
+    with subprocess.Popen(('zstd', '-d', '-q', '-c'),
+                          stdin=subprocess.PIPE,
+                          stdout=fd) as proc:
+        assert proc.stdin
+        try:
+            for chunk in chunks:
+                proc.stdin.write(chunk)
+                TRANSFERRED_BYTES.inc(len(chunk))
+        except BaseException:
+            proc.kill()
+            raise
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+def _scp_build(remote: str, dst_dir: pathlib.Path, runner: utils.Runner,
+               deadline: float) -> int:
+    """Copies a build from a builder without relying on a manifest.
+
+    Args:
+        remote: Build directory on the builder in `<host>:<path>` format.
+        dst_dir: Local directory to copy the build into.
+        runner: Runner to execute the commands with.
+        deadline: Value of time.monotonic() by which copying must finish.
+    Returns:
+        Number of bytes copied.
+    Raises:
+        TimeoutError: if copying didn’t finish by the deadline.
+        subprocess.SubprocessError: if copying failed.
+    """
+    copied = 0
+    for src, dst in (('target/*', 'target'), ('near-test-contracts/*.wasm',
+                                              'near-test-contracts')):
+        _scp([f'{remote}/{src}'], dst_dir / dst, runner, deadline=deadline)
+        copied += _dir_size(dst_dir / dst)
+    return copied
+
+
+def _scp_files(remote: str, files: typing.Sequence[common_db.ArtifactFile],
+               dst_dir: pathlib.Path, runner: utils.Runner,
+               deadline: float) -> None:
+    """Copies given files from a builder retrying failed files one by one.
+
+    Files are first copied with as few scp commands as possible.  Files which
+    failed to copy are then retried individually so that a failure of one
+    small file doesn’t restart copying of large ones.
+
+    Args:
+        remote: Build directory on the builder in `<host>:<path>` format.
+        files: Files to copy.
+        dst_dir: Local directory to copy the files into.  Paths of the files
+            are relative to it.
+        runner: Runner to execute the commands with.
+        deadline: Value of time.monotonic() by which copying must finish.
+    Raises:
+        TimeoutError: if copying didn’t finish by the deadline.
+        subprocess.SubprocessError: if copying failed.
+    """
+    by_dir: _FilesByDir = collections.defaultdict(list)
+    for file in files:
+        by_dir[pathlib.PurePosixPath(file.path).parent].append(file)
+    for parent, group in by_dir.items():
+        _scp([f'{remote}/{file.path}' for file in group],
+             dst_dir / parent,
+             runner,
+             deadline=deadline,
+             attempts=1)
+    for file in files:
+        dst = dst_dir / file.path
+        if not dst.exists() or dst.stat().st_size != file.size:
+            _scp([f'{remote}/{file.path}'],
+                 dst.parent,
+                 runner,
+                 deadline=deadline)
+
+
+def _scp(srcs: typing.Sequence[str],
+         dst: pathlib.Path,
+         runner: utils.Runner,
+         *,
+         deadline: float,
+         attempts: int = 3) -> None:
+    """Copies files from a builder retrying on failures.
+
+    Args:
+        srcs: Sources in `<host>:<path>` format.  The paths may include globs.
+        dst: Local directory to copy the files to.  It’s created if it doesn’t
+            exist.
+        runner: Runner to execute the commands with.
+        deadline: Value of time.monotonic() by which copying must finish.
+        attempts: Number of times to try copying.  If one, failure is not an
+            error and it’s up to the caller to check which files were copied.
+    Raises:
+        TimeoutError: if copying didn’t finish by the deadline.
+        subprocess.CalledProcessError: if all attempts to copy files failed.
+        subprocess.TimeoutExpired: if copying didn’t finish by the deadline.
+    """
+    if not dst.is_dir():
+        runner.log_command(('mkdir', '-p', '--', dst), cwd=utils.WORKDIR)
+        utils.mkdirs(dst)
+    delay = 1 + random.random()
+    for retry in range(attempts):
+        if runner(('scp', '-oStrictHostKeyChecking=no', '-oControlMaster=auto',
+                   '-oControlPath=/dev/shm/.ssh.%C', '-oControlPersist=2',
+                   '-oBatchMode=yes', *srcs, dst),
+                  print_cmd=('scp', *srcs, dst),
+                  cwd=utils.WORKDIR,
+                  check=attempts > 1 and retry == attempts - 1,
+                  timeout=math.ceil(_remaining(deadline))) == 0:
+            break
+        if retry + 1 < attempts:
+            time.sleep(min(delay, _remaining(deadline)))
+        delay *= 2
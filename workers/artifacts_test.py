@@ -0,0 +1,300 @@
+from __future__ import annotations
+
+import os
+import pathlib
+import shutil
+import threading
+import time
+import typing
+
+import pytest
+import requests
+
+from lib import common_db
+from lib import testspec
+
+from . import artifact_server
+from . import artifacts
+from . import utils
+
+_LOCALHOST = 0x7F000001
+
+
+class _FakeRunner:
+    """Runner which fails the test if any command is run."""
+
+    def __call__(self, cmd: typing.Sequence[typing.Any],
+                 **_kw: typing.Any) -> int:
+        raise AssertionError(f'Unexpected command: {cmd}')
+
+    def log_command(self, *_args: typing.Any, **_kw: typing.Any) -> None:
+        pass
+
+    def log_traceback(self) -> None:
+        raise  # pylint: disable=misplaced-bare-raise
+
+
+@pytest.fixture(name='server')
+def _server(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    server = artifact_server.ArtifactServer(tmp_path / 'builds', port=0)
+    server.start()
+    monkeypatch.setattr(utils, 'ARTIFACT_PORT', server.server_address[1])
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def _make_build(builds_dir: pathlib.Path, build_id: int,
+                contents: dict[str, bytes]) -> list[common_db.ArtifactFile]:
+    build_dir = builds_dir / str(build_id)
+    for name, data in contents.items():
+        (build_dir / name).parent.mkdir(parents=True, exist_ok=True)
+        (build_dir / name).write_bytes(data)
+        if not name.endswith('.wasm'):
+            (build_dir / name).chmod(0o755)
+    return artifacts.scan_build_dir(build_dir)
+
+
+def test_artifact_server(tmp_path: pathlib.Path, server: str):
+    _make_build(tmp_path / 'builds', 1, {'target/neard': b'0123456789'})
+    os.utime(tmp_path / 'builds/1', (1000, 1000))
+    response = requests.get(f'{server}/1/target/neard',
+                            headers={'Range': 'bytes=4-'},
+                            timeout=10)
+    assert (response.status_code, response.content) == (206, b'456789')
+    assert response.headers['Content-Range'] == 'bytes 4-9/10'
+    # Serving a file marks the build as used.
+    assert (tmp_path / 'builds/1').stat().st_mtime > 1000
+    response = requests.get(f'{server}/1/target/neard',
+                            headers={'Range': 'bytes=10-'},
+                            timeout=10)
+    assert response.status_code == 416
+    for path in ('1/target/../../x', '1/target', '1/target/missing', '1'):
+        assert requests.get(f'{server}/{path}', timeout=10).status_code == 404
+
+
+def test_prepare_with_manifest(tmp_path: pathlib.Path, server: str,
+                               monkeypatch: pytest.MonkeyPatch):
+    builds_dir = tmp_path / 'builds'
+    repo_dir = tmp_path / 'repo'
+    (repo_dir / 'runtime/near-test-contracts/res').mkdir(parents=True)
+    contents = {
+        'target/neard': b'neard 1',
+        'target/restaked': b'restaked',
+        'near-test-contracts/contract.wasm': b'wasm',
+        'expensive/test_tests-0123': b'expensive',
+    }
+    first = _make_build(builds_dir, 1, contents)
+    assert [(file.path, file.executable) for file in first] == [
+        ('expensive/test_tests-0123', True),
+        ('near-test-contracts/contract.wasm', False),
+        ('target/neard', True),
+        ('target/restaked', True),
+    ]
+    contents['target/neard'] = b'neard 2'
+    second = _make_build(builds_dir, 2, contents)
+
+    downloaded: list[str] = []
+    download_files = artifacts.download_files
+
+    def download(base_url: str, files: typing.Sequence[common_db.ArtifactFile],
+                 dst_dir: pathlib.Path, **kw: typing.Any) -> None:
+        assert base_url.startswith(server)
+        downloaded.extend(file.path for file in files)
+        download_files(base_url, files, dst_dir, **kw)
+
+    # Small parts so that files are downloaded in multiple ranges.
+    monkeypatch.setattr(artifacts, 'HTTP_PART_SIZE', 3)
+    monkeypatch.setattr(artifacts, 'download_files', download)
+
+    cache = artifacts.BuildCache(2, root=tmp_path / 'cache')
+    test = testspec.TestSpec('pytest sanity/foo.py')
+    cache.prepare(1, _LOCALHOST, test, _FakeRunner(), repo_dir, files=first)
+    assert downloaded == [
+        'near-test-contracts/contract.wasm', 'target/neard', 'target/restaked'
+    ]
+
+    downloaded.clear()
+    test = testspec.TestSpec('expensive nearcore test_tests test_tests::foo')
+    cache.prepare(2, _LOCALHOST, test, _FakeRunner(), repo_dir, files=second)
+    assert downloaded == ['target/neard', 'expensive/test_tests-0123']
+    assert (repo_dir / 'target/debug/neard').read_bytes() == b'neard 2'
+    assert os.access(repo_dir / 'target/debug/neard', os.X_OK)
+    assert (repo_dir / 'target/expensive/test_tests-0123').exists()
+
+    # Build #1 is evicted but its objects shared with build #2 are kept.
+    contents['target/neard'] = b'neard 3'
+    third = _make_build(builds_dir, 3, contents)
+    (builds_dir / '3/target/neard').write_bytes(b'corrupted')
+    with pytest.raises(OSError):
+        cache.prepare(3,
+                      _LOCALHOST,
+                      testspec.TestSpec('pytest sanity/foo.py'),
+                      _FakeRunner(),
+                      repo_dir,
+                      files=third)
+    assert len(list((tmp_path / 'cache/objects').iterdir())) == 4
+
+
+def test_compressed_download(tmp_path: pathlib.Path,
+                             monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(artifact_server, 'MIN_COMPRESSED_SIZE', 8)
+    server = artifact_server.ArtifactServer(
+        tmp_path / 'builds', port=0, compression=artifact_server.Compression())
+    server.start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/1'
+    try:
+        files = _make_build(tmp_path / 'builds', 1, {
+            'target/neard': b'neard ' * 1000,
+            'target/tiny': b'tiny',
+        })
+        artifacts.download_files(url, files, tmp_path / 'a', compressed=True)
+        artifacts.download_files(url, files, tmp_path / 'b', compressed=False)
+    finally:
+        server.shutdown()
+        server.server_close()
+    for dst in ('a', 'b'):
+        assert artifacts.scan_build_dir(tmp_path / dst) == files
+    # Only the large file was compressed and the copy was cached.
+    assert [
+        path.name for path in (tmp_path / 'builds/1' /
+                               artifact_server.COMPRESSED_DIR).rglob('*')
+    ] == ['target', 'neard.zst']
+
+
+@pytest.mark.usefixtures('server')
+def test_prefetch(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    repo_dir = tmp_path / 'repo'
+    (repo_dir / 'runtime/near-test-contracts/res').mkdir(parents=True)
+    files = _make_build(
+        tmp_path / 'builds', 1, {
+            'target/neard': b'neard',
+            'near-test-contracts/contract.wasm': b'wasm',
+            'expensive/test_tests-0123': b'expensive',
+        })
+    cache = artifacts.BuildCache(2, root=tmp_path / 'cache')
+    test = testspec.TestSpec('expensive nearcore test_tests test_tests::foo')
+    cache.prefetch(1, _LOCALHOST, test, files=files)
+    assert cache.build_ids() == [1]
+    assert not (repo_dir / 'target').exists()
+
+    def download(*_args: typing.Any, **_kw: typing.Any) -> None:
+        raise AssertionError('Prefetched files downloaded again')
+
+    monkeypatch.setattr(artifacts, 'download_files', download)
+    cache.prepare(1, _LOCALHOST, test, _FakeRunner(), repo_dir, files=files)
+    assert (repo_dir / 'target/debug/neard').read_bytes() == b'neard'
+    assert (repo_dir / 'target/expensive/test_tests-0123').exists()
+
+
+@pytest.mark.usefixtures('server')
+def test_prefetch_doesnt_block(tmp_path: pathlib.Path,
+                               monkeypatch: pytest.MonkeyPatch):
+    repo_dir = tmp_path / 'repo'
+    (repo_dir / 'runtime/near-test-contracts/res').mkdir(parents=True)
+    files = {
+        build_id:
+            _make_build(
+                tmp_path / 'builds', build_id, {
+                    'target/neard': b'neard %d' % build_id,
+                    'near-test-contracts/contract.wasm': b'wasm',
+                }) for build_id in (1, 2)
+    }
+    cache = artifacts.BuildCache(2, root=tmp_path / 'cache')
+    test = testspec.TestSpec('pytest sanity/foo.py')
+    cache.prefetch(1, _LOCALHOST, test, files=files[1])
+
+    download_files = artifacts.download_files
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_download(*args: typing.Any, **kw: typing.Any) -> None:
+        started.set()
+        assert release.wait(10)
+        download_files(*args, **kw)
+
+    monkeypatch.setattr(artifacts, 'download_files', slow_download)
+    prefetcher = threading.Thread(target=cache.prefetch,
+                                  args=(2, _LOCALHOST, test),
+                                  kwargs={'files': files[2]})
+    prefetcher.start()
+    try:
+        assert started.wait(10)
+        # A cached build is installed while another one is being prefetched.
+        cache.prepare(1,
+                      _LOCALHOST,
+                      test,
+                      _FakeRunner(),
+                      repo_dir,
+                      files=files[1])
+        assert (repo_dir / 'target/debug/neard').read_bytes() == b'neard 1'
+        assert prefetcher.is_alive()
+    finally:
+        release.set()
+        prefetcher.join()
+    assert sorted(cache.build_ids()) == [1, 2]
+
+
+class _ScpRunner(_FakeRunner):
+    """Runner which executes scp commands by copying local files.
+
+    The first copy of a `restaked` file fails as if the connection dropped.
+    """
+
+    def __init__(self) -> None:
+        self.copied: list[list[str]] = []
+        self.__failed = False
+
+    def __call__(self, cmd: typing.Sequence[typing.Any],
+                 **_kw: typing.Any) -> int:
+        srcs = [str(src).removeprefix('builder:') for src in cmd[6:-1]]
+        self.copied.append([os.path.basename(src) for src in srcs])
+        for src in srcs:
+            if src.endswith('/restaked') and not self.__failed:
+                self.__failed = True
+                return 1
+            shutil.copy(src, cmd[-1])
+        return 0
+
+    def log_traceback(self) -> None:
+        pass
+
+
+def test_scp_fallback(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    repo_dir = tmp_path / 'repo'
+    (repo_dir / 'runtime/near-test-contracts/res').mkdir(parents=True)
+    files = _make_build(
+        tmp_path / 'builds', 1, {
+            'target/neard': b'neard',
+            'target/restaked': b'restaked',
+            'near-test-contracts/contract.wasm': b'wasm',
+        })
+
+    def download(*_args: typing.Any, **_kw: typing.Any) -> None:
+        raise OSError('Artifact server is down')
+
+    monkeypatch.setattr(artifacts, 'download_files', download)
+    monkeypatch.setattr(utils, 'BUILDS_DIR', tmp_path / 'builds')
+    monkeypatch.setattr(utils, 'int_to_ip', lambda _ip: 'builder')
+    runner = _ScpRunner()
+    cache = artifacts.BuildCache(2, root=tmp_path / 'cache')
+    cache.prepare(1,
+                  _LOCALHOST,
+                  testspec.TestSpec('pytest sanity/foo.py'),
+                  typing.cast(utils.Runner, runner),
+                  repo_dir,
+                  files=files)
+    # Only the file which failed to copy is copied again.
+    assert runner.copied == [['contract.wasm'], ['neard', 'restaked'],
+                             ['restaked']]
+    assert (repo_dir / 'target/debug/restaked').read_bytes() == b'restaked'
+
+
+@pytest.mark.usefixtures('server')
+def test_download_deadline(tmp_path: pathlib.Path):
+    files = _make_build(tmp_path / 'builds', 1, {'target/neard': b'neard'})
+    with pytest.raises(TimeoutError):
+        artifacts.download_files(f'http://127.0.0.1:{utils.ARTIFACT_PORT}/1',
+                                 files,
+                                 tmp_path / 'dst',
+                                 deadline=time.monotonic())
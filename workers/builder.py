@@ -1,16 +1,65 @@
+import argparse
+import concurrent.futures
+import contextlib
+import dataclasses
+import json
 import os
 from pathlib import Path
+import resource
 import socket
 import stat
+import subprocess
 import time
 import traceback
 import sys
 import typing
 
-import psutil
+import prometheus_client
 
+from lib import common_db
+from lib import testspec
+from . import artifact_server
+from . import artifacts
 from . import builder_db
+from . import disk
+from . import live_logs
 from . import utils
+from . import worktrees
+
+# Directory with Cargo target directories of build slots.  See BuildSlot.
+TARGETS_DIR = utils.WORKDIR / 'targets'
+
+METRICS_PORT = 5509
+
+BUILD_TIME = prometheus_client.Histogram(
+    'nayduck_builder_build_seconds',
+    'Time spent on successful builds by how similar the build was to the '
+    'previous build in the same slot: same commit and features, same features '
+    'only, same commit only or neither', ['affinity'],
+    buckets=(60, 120, 300, 600, 900, 1200, 1800, 2700, 3600, 5400))
+
+EXPENSIVE_BUILDS = prometheus_client.Counter(
+    'nayduck_builder_expensive_builds',
+    'Number of builds of expensive tests by whether only packages with tests '
+    'the build needs were compiled or the whole workspace', ['scope'])
+
+_PHASE_LABELS = ('phase', 'release', 'features')
+PHASE_TIME = prometheus_client.Histogram(
+    'nayduck_builder_phase_seconds',
+    'Wall time of finished phases of builds (see build_target)',
+    _PHASE_LABELS,
+    buckets=(1, 10, 30, 60, 120, 300, 600, 900, 1200, 1800, 2700, 3600))
+PHASE_CPU_TIME = prometheus_client.Histogram(
+    'nayduck_builder_phase_cpu_seconds',
+    'CPU time used by finished phases of builds (see build_target)',
+    _PHASE_LABELS,
+    buckets=(1, 10, 60, 300, 600, 1200, 1800, 3600, 7200, 14400, 28800))
+PHASE_PEAK_RSS = prometheus_client.Histogram(
+    'nayduck_builder_phase_peak_rss_bytes',
+    'Peak memory usage of a single process in finished phases of builds '
+    '(see build_target)',
+    _PHASE_LABELS,
+    buckets=tuple(2**exp for exp in range(26, 37)))
 
 
 class BuildSpec(typing.NamedTuple):
@@ -21,6 +70,7 @@ class BuildSpec(typing.NamedTuple):
     features: str
     is_release: bool
     is_expensive: bool
+    expensive_tests: tuple[str, ...] = ()
 
     @classmethod
     def from_row(cls, data: builder_db.Build) -> 'BuildSpec':
@@ -30,7 +80,14 @@ class BuildSpec(typing.NamedTuple):
                    sha=str(data.sha),
                    features=data.features,
                    is_release=bool(data.is_release),
-                   is_expensive=bool(data.expensive))
+                   is_expensive=bool(data.expensive),
+                   expensive_tests=tuple(data.expensive_tests or ()))
+
+    @property
+    def key(self) -> builder_db.BuildKey:
+        return builder_db.BuildKey(sha=self.sha,
+                                   features=self.features,
+                                   is_release=self.is_release)
 
     @property
     def build_type(self) -> str:
@@ -51,28 +108,246 @@ class BuildFailure(RuntimeError):
     pass
 
 
-def build_target(spec: BuildSpec, runner: utils.Runner) -> None:
+class ExpensiveScope(typing.NamedTuple):
+    """Packages whose expensive tests a build compiles; see expensive_scope.
+
+    Attributes:
+        packages: Packages to compile or None to compile the whole workspace.
+        features: Features defined by any of the packages.
+    """
+    packages: typing.Optional[tuple[str, ...]] = None
+    features: frozenset[str] = frozenset()
+
+    @property
+    def package_args(self) -> list[str]:
+        """Returns Cargo arguments selecting the packages."""
+        return [f'-p{package}' for package in self.packages or ()]
+
+    def select_features(self, features: typing.Iterable[str]) -> list[str]:
+        """Returns features which can be passed to Cargo for the packages.
+
+        Cargo refuses features which none of the selected packages defines.
+        """
+        if self.packages is None:
+            return list(features)
+        return [feature for feature in features if feature in self.features]
+
+
+class PhaseTimer:
+    """Measures resources used by phases of a build.
+
+    Resource usage of commands is collected through runner’s `on_exit` hook so
+    that, even with multiple slots running concurrently, each phase is charged
+    only for its own commands.  CPU time spent by the builder itself (e.g. when
+    copying artifacts) is measured with the calling thread’s CPU clock.
+    """
+
+    def __init__(self, runner: utils.Runner) -> None:
+        self.phases: list[builder_db.BuildPhase] = []
+        self.__cpu_time = 0.0
+        self.__peak_rss = 0
+        runner.on_exit = self.__on_exit
+
+    def __on_exit(self, usage: resource.struct_rusage) -> None:
+        self.__cpu_time += usage.ru_utime + usage.ru_stime
+        # On Linux ru_maxrss is in kilobytes.
+        self.__peak_rss = max(self.__peak_rss, usage.ru_maxrss * 1024)
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> typing.Iterator[None]:
+        """Measures a phase of the build run inside the context.
+
+        Phases which raise an exception aren’t recorded.
+        """
+        self.__cpu_time = 0.0
+        self.__peak_rss = 0
+        start = time.monotonic()
+        thread_start = time.thread_time()
+        yield
+        cpu_time = self.__cpu_time + time.thread_time() - thread_start
+        self.phases.append(
+            builder_db.BuildPhase(phase=name,
+                                  wall_time=time.monotonic() - start,
+                                  cpu_time=cpu_time,
+                                  peak_rss=self.__peak_rss))
+
+    def observe(self, spec: 'BuildSpec') -> None:
+        """Records measured phases in Prometheus histograms."""
+        release = str(spec.is_release).lower()
+        for phase in self.phases:
+            labels = (phase.phase, release, spec.features)
+            PHASE_TIME.labels(*labels).observe(phase.wall_time)
+            PHASE_CPU_TIME.labels(*labels).observe(phase.cpu_time)
+            PHASE_PEAK_RSS.labels(*labels).observe(phase.peak_rss)
+
+
+class Jobserver:
+    """A GNU make jobserver shared by Cargo invocations of all build slots.
+
+    Cargo and rustc act as jobserver clients when they find one in MAKEFLAGS.
+    Each of them can run one job for free and needs to take a token from the
+    jobserver for any additional one.  Sharing a single jobserver between
+    slots caps the total number of jobs at the number of CPUs while letting
+    a slot whose build is in a mostly serial phase (such as linking or the
+    tail of code generation) leave its CPUs to builds in other slots.
+    """
+
+    def __init__(self, slots: int) -> None:
+        self.__fds = os.pipe()
+        tokens = max(0, len(os.sched_getaffinity(0)) - slots)
+        os.write(self.__fds[1], b'+' * tokens)
+
+    @property
+    def pass_fds(self) -> tuple[int, int]:
+        """File descriptors which need to be passed to Cargo processes."""
+        return self.__fds
+
+    def environ(self) -> dict[str, str]:
+        """Returns environment for Cargo processes using the jobserver."""
+        auth = f'{self.__fds[0]},{self.__fds[1]}'
+        flags = f'-j --jobserver-fds={auth} --jobserver-auth={auth}'
+        return dict(os.environ, MAKEFLAGS=flags, CARGO_MAKEFLAGS=flags)
+
+
+@dataclasses.dataclass(frozen=True)
+class BuildSlot:
+    """A place on the builder host where a single build runs.
+
+    Builds running concurrently on the host get a worktree each from
+    a worktrees.WorktreeCache and have separate target directories so that
+    Cargo invocations of different slots never wait on each other’s lock of
+    the build directory.  Target directories belong to the slot rather than
+    the worktree so that dependencies compiled for one build are reused by
+    the next build in the slot.  Cargo’s registry and git caches are shared by
+    all slots; Cargo serialises access to them with its package cache lock.
+
+    Attributes:
+        index: Index of the slot starting from zero.
+        target_dir: Cargo target directory for regular builds.
+        expensive_target_dir: Cargo target directory for builds of expensive
+            tests.
+        jobserver: Jobserver shared between all slots or None if this is the
+            only slot.
+    """
+    index: int
+    target_dir: Path
+    expensive_target_dir: Path
+    jobserver: typing.Optional[Jobserver]
+
+    @classmethod
+    def create(cls, index: int,
+               jobserver: typing.Optional[Jobserver]) -> 'BuildSlot':
+        base = TARGETS_DIR / str(index)
+        return cls(index=index,
+                   target_dir=base / 'target',
+                   expensive_target_dir=base / 'target_expensive',
+                   jobserver=jobserver)
+
+
+def expensive_scope(spec: BuildSpec, repo_dir: Path) -> ExpensiveScope:
+    """Returns packages whose expensive tests the build needs to compile.
+
+    Package and test executable of each expensive test are the first two
+    arguments of the test.  They are looked up among workspace members as
+    reported by `cargo metadata`.  If any test can’t be parsed or its package
+    doesn’t exist, doesn’t define the `expensive_tests` feature or doesn’t have
+    a target named after test’s executable, the whole workspace needs to be
+    compiled.
+
+    Args:
+        spec: The build specification.
+        repo_dir: Worktree with the commit to build checked out.
+    Returns:
+        Packages to compile along with features any of them defines.
+    """
+    needed: dict[str, set[str]] = {}
+    try:
+        for name in spec.expensive_tests:
+            args = testspec.TestSpec(name).args
+            needed.setdefault(args[0], set()).add(args[1])
+        metadata = json.loads(
+            subprocess.run(
+                ('cargo', 'metadata', '--no-deps', '--format-version=1'),
+                cwd=repo_dir,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                check=True).stdout)
+    except (ValueError, subprocess.CalledProcessError) as ex:
+        print(f'Cannot determine packages of expensive tests: {ex}',
+              file=sys.stderr)
+        return ExpensiveScope()
+    if not needed:
+        return ExpensiveScope()
+    members = set(metadata['workspace_members'])
+    packages = {
+        package['name']: package
+        for package in metadata['packages']
+        if package['id'] in members
+    }
+    features: set[str] = set()
+    for name, executables in needed.items():
+        package = packages.get(name)
+        if not package or 'expensive_tests' not in package['features']:
+            print(f'Package {name} has no expensive tests', file=sys.stderr)
+            return ExpensiveScope()
+        targets = {
+            target['name'].replace('-', '_') for target in package['targets']
+        }
+        if not executables <= targets:
+            missing = ', '.join(sorted(executables - targets))
+            print(f'Package {name} has no {missing} target', file=sys.stderr)
+            return ExpensiveScope()
+        features.update(package['features'])
+    return ExpensiveScope(packages=tuple(sorted(needed)),
+                          features=frozenset(features))
+
+
+def build_target(spec: BuildSpec, runner: utils.Runner, *, slot: BuildSlot,
+                 repo_dir: Path,
+                 timer: PhaseTimer) -> typing.Optional[typing.Sequence[str]]:
     """Builds and copies artefacts to the build output directory.
 
+    The build is split into phases measured by `timer`: ‘prepare’, ‘neard’,
+    ‘tools’ (which includes the test contracts), ‘copy’ and, for builds with
+    expensive tests, ‘expensive’ and ‘expensive_copy’.
+
+    Expensive tests are compiled only for packages which have expensive tests
+    the build needs (see expensive_scope) rather than for the whole
+    workspace.
+
     Args:
         spec: The build specification as read from the database.  Based on it,
             the function determines which files were built (most notably whether
             expensive targets were compiled) and where they are located
             (e.g. whether they are in debug or release subdirectories).
         runner: A utils.Runner class used to execute `cp` commands.
+        slot: The slot the build runs in.
+        repo_dir: Worktree with the commit to build checked out.
+        timer: Timer to measure phases of the build with.
+    Returns:
+        Packages whose expensive tests have been compiled or None if
+        expensive tests of the whole workspace have been compiled or the build
+        has no expensive tests.
     Raises:
         BuildFailure: if build fails
     """
     msg = 'expensive ' if spec.is_expensive else ''
-    print(f'Building {msg}target', file=sys.stderr)
+    print(f'[slot {slot.index}] Building {msg}target', file=sys.stderr)
+
+    kw: dict[str, typing.Any] = {}
+    if slot.jobserver:
+        kw.update(env=slot.jobserver.environ(),
+                  pass_fds=slot.jobserver.pass_fds)
 
-    def cargo(*args: typing.Union[str, Path], features: typing.List[str]) -> None:
-        cmd = ['cargo', *args]
+    def cargo(*args: typing.Union[str, Path],
+              features: typing.List[str],
+              target_dir: Path = slot.target_dir) -> None:
+        cmd = ['cargo', *args, '--target-dir', target_dir]
         if features:
             cmd.append('--features=' + ','.join(features))
         if spec.is_release:
             cmd.append('--release')
-        if runner(cmd, cwd=utils.REPO_DIR) != 0:
+        if runner(cmd, cwd=repo_dir, **kw) != 0:
             raise BuildFailure()
 
     def copy(src_dir: Path, files: typing.Iterable[str], dst_dir: Path) -> None:
@@ -89,28 +364,30 @@ def build_target(spec: BuildSpec, runner: utils.Runner) -> None:
             return False
         return bool(stat.S_ISREG(attrs.st_mode) and attrs.st_mode & 0o100)
 
-    utils.rmdirs(spec.build_dir)
+    with timer.phase('prepare'):
+        utils.rmdirs(spec.build_dir)
 
-    features = ['rosetta_rpc']
-    if spec.features:
-        features.extend(spec.features.split(','))
-    if runner(('git', 'merge-base', '--is-ancestor',
-               '9786eead37abee9097015510d6d17d76f00465ef', '@'),
-              cwd=utils.REPO_DIR) == 0:
-        features.append('test_features')
-    else:
-        features.append('adversarial')
+        features = ['rosetta_rpc']
+        if spec.features:
+            features.extend(spec.features.split(','))
+        if runner(('git', 'merge-base', '--is-ancestor',
+                   '9786eead37abee9097015510d6d17d76f00465ef', '@'),
+                  cwd=repo_dir) == 0:
+            features.append('test_features')
+        else:
+            features.append('adversarial')
 
     # Be sure to update the build commands in the web UI if you make any changes here!
     # The logic is in the parseTestName function.
 
-    cargo(
-        'build',
-        '-pneard',
-        '--bin',
-        'neard',
-        features=features
-    )
+    with timer.phase('neard'):
+        cargo(
+            'build',
+            '-pneard',
+            '--bin',
+            'neard',
+            features=features
+        )
 
     # For tools (genesis populate, restaked and test contracts) only enable
     # 'nightly' and 'test_features' since other features might not be supported
@@ -120,100 +397,117 @@ def build_target(spec: BuildSpec, runner: utils.Runner) -> None:
     if "nightly" in features:
         tools_features.append('nightly')
 
-    cargo(
-        'build',
-        '-vv',
-        '-pgenesis-populate',
-        '-prestaked',
-        '-pnear-test-contracts',
-        features=tools_features,
-    )
-
-    copy(src_dir=utils.REPO_DIR / 'target' / spec.build_type,
-         dst_dir=spec.build_dir / 'target',
-         files=('neard', 'genesis-populate', 'restaked'))
-
-    src_dir = utils.REPO_DIR / 'runtime' / 'near-test-contracts' / 'res'
-    copy(src_dir=src_dir,
-         dst_dir=spec.build_dir / 'near-test-contracts',
-         files=[name for name in os.listdir(src_dir) if name.endswith('.wasm')])
+    with timer.phase('tools'):
+        cargo(
+            'build',
+            '-vv',
+            '-pgenesis-populate',
+            '-prestaked',
+            '-pnear-test-contracts',
+            features=tools_features,
+        )
+
+    with timer.phase('copy'):
+        copy(src_dir=slot.target_dir / spec.build_type,
+             dst_dir=spec.build_dir / 'target',
+             files=('neard', 'genesis-populate', 'restaked'))
+
+        src_dir = repo_dir / 'runtime' / 'near-test-contracts' / 'res'
+        copy(src_dir=src_dir,
+             dst_dir=spec.build_dir / 'near-test-contracts',
+             files=[
+                 name for name in os.listdir(src_dir) if name.endswith('.wasm')
+             ])
 
     if not spec.is_expensive:
-        return
-
-    # Make sure there are no left overs from previous builds.  Don't delete
-    # the entire directory so we can benefit from incremental building.
-    src_dir = utils.REPO_DIR / 'target_expensive' / spec.build_type / 'deps'
-    if src_dir.exists():
-        for filename in os.listdir(src_dir):
-            if '.' not in filename:
-                (src_dir / filename).unlink()
-
-    cargo(
-        'build',
-        '--tests',
-        '--target-dir',
-        'target_expensive',
-        features=['expensive_tests'] + tools_features
-    )
-
-    copy(src_dir=src_dir,
-         dst_dir=spec.build_dir / 'expensive',
-         files=[
-             name for name in os.listdir(src_dir)
-             if is_test_executable(src_dir, name)
-         ])
-
-
-def wait_for_free_space(server: builder_db.BuilderDB) -> None:
-    """Wait until there's at least 20% free space on /datadrive.
-
-    If there's less than 50GB of free space on /datadrive file system, delete
-    finished builds and wait until enough tests finish that enough free space
-    becomes available.  50GB threshold has been chosen to be able to finish any
-    build even in the worst circumstances.  Considering that even the largest
-    build does not exceed 15GB this should be a safe bet.
-
-    Args:
-        server: Database to query for finished tests.
+        return None
+
+    with timer.phase('expensive'):
+        # Make sure there are no left overs from previous builds.  Don't delete
+        # the entire directory so we can benefit from incremental building.
+        src_dir = slot.expensive_target_dir / spec.build_type / 'deps'
+        if src_dir.exists():
+            for filename in os.listdir(src_dir):
+                if '.' not in filename:
+                    (src_dir / filename).unlink()
+
+        scope = expensive_scope(spec, repo_dir)
+        EXPENSIVE_BUILDS.labels(
+            'targeted' if scope.packages else 'workspace').inc()
+
+        cargo(
+            'build',
+            '--tests',
+            *scope.package_args,
+            features=scope.select_features(['expensive_tests'] +
+                                           tools_features),
+            target_dir=slot.expensive_target_dir
+        )
+
+    with timer.phase('expensive_copy'):
+        copy(src_dir=src_dir,
+             dst_dir=spec.build_dir / 'expensive',
+             files=[
+                 name for name in os.listdir(src_dir)
+                 if is_test_executable(src_dir, name)
+             ])
+
+    return scope.packages
+
+
+def _compress(spec: BuildSpec, files: typing.Sequence[common_db.ArtifactFile],
+              compression: artifact_server.Compression, runner: utils.Runner,
+              timer: PhaseTimer) -> None:
+    """Creates compressed copies of build’s artifacts in ‘compress’ phase.
+
+    Failure isn’t fatal since the artifact server compresses missing files on
+    demand or serves them uncompressed.
     """
-
-    def enough_space() -> bool:
-        return psutil.disk_usage(str(utils.WORKDIR)).free >= 50_000_000_000
-
-    def clean_finished() -> bool:
-        bids = server.builds_without_pending_tests()
-        if bids:
-            utils.rmdirs(*[utils.BUILDS_DIR / str(bid) for bid in bids])
-            server.unassign_builds(bids)
-        return enough_space()
-
-    if enough_space() or clean_finished():
-        return
-
-    utils.rmdirs(utils.REPO_DIR / 'target', utils.REPO_DIR / 'target_expensive')
-    if enough_space():
-        return
-
-    print(
-        'Not enough free space; '
-        'waiting for tests to finish to clean up more builds',
-        file=sys.stderr)
-    while True:
-        time.sleep(5)
-        if clean_finished():
-            break
-    print('Got enough free space; continuing', file=sys.stderr)
-
-
-def handle_build(server: builder_db.BuilderDB, spec: BuildSpec) -> None:
-    """Handles a single build request."""
-    print(spec, file=sys.stderr)
-    with utils.Runner() as runner:
+    try:
+        with timer.phase('compress'):
+            artifact_server.compress_build(spec.build_dir, files, compression,
+                                           runner)
+    except (OSError, subprocess.SubprocessError):
+        runner.log_traceback()
+
+
+def handle_build(
+        server: builder_db.BuilderDB, log_server: builder_db.BuilderDB,
+        spec: BuildSpec, *, slot: BuildSlot, trees: worktrees.WorktreeCache,
+        compression: typing.Optional[artifact_server.Compression]) -> bool:
+    """Handles a single build request; returns whether it succeeded.
+
+    Build’s output is streamed to the database as the build runs using
+    `log_server` connection.  Resources used by each phase of the build (see
+    build_target) are stored in the database and recorded in Prometheus
+    metrics.  Once the build succeeds, its manifest (see
+    artifacts.scan_build_dir) is computed in the ‘manifest’ phase and stored
+    along with build’s status.  If `compression` is given, compressed copies of
+    the artifacts are created in the ‘compress’ phase (see
+    artifact_server.compress_build).
+    """
+    print(f'[slot {slot.index}] {spec}', file=sys.stderr)
+    with utils.Runner() as runner, \
+         live_logs.BuildLog(log_server, spec.build_id) as log, \
+         contextlib.ExitStack() as stack:
+        runner.on_output = log.feed
+        timer = PhaseTimer(runner)
+        expensive_packages = None
+        files: list[common_db.ArtifactFile] = []
         success = False
         try:
-            if utils.checkout(spec.sha, runner=runner):
-                build_target(spec, runner=runner)
+            with timer.phase('checkout'):
+                repo_dir = stack.enter_context(trees.checkout(spec.sha, runner))
+            if repo_dir:
+                expensive_packages = build_target(spec,
+                                                  runner=runner,
+                                                  slot=slot,
+                                                  repo_dir=repo_dir,
+                                                  timer=timer)
+                with timer.phase('manifest'):
+                    files = artifacts.scan_build_dir(spec.build_dir)
+                if compression:
+                    _compress(spec, files, compression, runner, timer)
                 success = True
         except BuildFailure:
             pass
@@ -222,33 +516,123 @@ def handle_build(server: builder_db.BuilderDB, spec: BuildSpec) -> None:
 
         result = 'succeeded' if success else 'failed'
         print(f'Build #{spec.build_id} {result}', file=sys.stderr)
-        runner.stdout.seek(0)
-        stdout = runner.stdout.read()
-        runner.stderr.seek(0)
-        stderr = runner.stderr.read()
-    server.update_build_status(spec.build_id, success, out=stdout, err=stderr)
+    timer.observe(spec)
+    server.update_build_status(spec.build_id,
+                               success,
+                               timer.phases,
+                               expensive_packages=expensive_packages,
+                               files=files)
+    return success
+
+
+def _affinity(spec: BuildSpec,
+              last: typing.Optional[builder_db.BuildKey]) -> str:
+    """Returns value of the affinity label of BUILD_TIME for given build."""
+    if not last:
+        return 'none'
+    key = spec.key
+    same_commit = key.sha == last.sha
+    same_features = key[1:] == last[1:]
+    if same_commit:
+        return 'both' if same_features else 'commit'
+    return 'features' if same_features else 'none'
+
+
+def keep_pulling(
+        ipv4: int, slot: BuildSlot, trees: worktrees.WorktreeCache,
+        disks: disk.DiskManager,
+        compression: typing.Optional[artifact_server.Compression]) -> None:
+    """Claims and handles builds in a single slot forever."""
+    last: typing.Optional[builder_db.BuildKey] = None
+    with builder_db.BuilderDB(ipv4) as server, \
+         builder_db.BuilderDB(ipv4) as log_server:
+        while True:
+            build_id = None
+            try:
+                disks.wait_for_free_space(
+                    server, (slot.target_dir, slot.expensive_target_dir))
+                new_build = server.get_new_build(last)
+                if new_build:
+                    build_id = new_build.build_id
+                    spec = BuildSpec.from_row(new_build)
+                    start = time.monotonic()
+                    if handle_build(server,
+                                    log_server,
+                                    spec,
+                                    slot=slot,
+                                    trees=trees,
+                                    compression=compression):
+                        affinity = _affinity(spec, last)
+                        BUILD_TIME.labels(affinity).observe(time.monotonic() -
+                                                            start)
+                    last = spec.key
+                    continue
+            except Exception:
+                traceback.print_exc()
+                if build_id is not None:
+                    server.handle_restart(build_id)
+            time.sleep(10)
 
 
-def keep_pulling() -> None:
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Builds NayDuck builds.')
+    parser.add_argument('--slots',
+                        type=int,
+                        default=1,
+                        help='number of builds to run concurrently')
+    parser.add_argument('--compress-level',
+                        type=int,
+                        default=artifact_server.Compression().level,
+                        help='zstd level to compress artifacts served to '
+                        'workers with; higher levels save network bandwidth at '
+                        'cost of CPU time; 0 disables compression')
+    parser.add_argument('--compress-threads',
+                        type=int,
+                        default=artifact_server.Compression().threads,
+                        help='number of threads to compress artifacts with; '
+                        '0 uses all cores')
+    args = parser.parse_args()
+    slots = max(1, args.slots)
+    compression = None
+    if args.compress_level > 0:
+        compression = artifact_server.Compression(args.compress_level,
+                                                  args.compress_threads)
+
     ipv4, ip_str = utils.get_ip()
     print(f'Starting builder @ {socket.gethostname()} ({ip_str} / {ipv4})',
           file=sys.stderr)
+    prometheus_client.start_http_server(METRICS_PORT)
+    artifact_server.ArtifactServer(compression=compression).start()
 
     with builder_db.BuilderDB(ipv4) as server:
         server.handle_restart()
-        while True:
-            wait_for_free_space(server)
+    trees = worktrees.WorktreeCache(slots)
+    trees.start_fetcher()
+    disks = disk.DiskManager()
+    # With a single slot Cargo manages parallelism on its own.
+    jobserver = Jobserver(slots) if slots > 1 else None
+    with concurrent.futures.ThreadPoolExecutor(slots) as executor:
+        futures = [
+            executor.submit(keep_pulling, ipv4,
+                            BuildSlot.create(index, jobserver), trees, disks,
+                            compression) for index in range(slots)
+        ]
+        done, _ = concurrent.futures.wait(
+            futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+        for future in done:
             try:
-                new_build = server.get_new_build()
-                if new_build:
-                    handle_build(server, BuildSpec.from_row(new_build))
-                    continue
+                future.result()
             except Exception:
                 traceback.print_exc()
-                server.handle_restart()
-            time.sleep(10)
+        # Slots never finish on their own so getting here means one of them
+        # failed.  Other slots would keep running forever (and the executor
+        # waiting for them) so exit outright and let the supervisor restart
+        # the builder.  Builds they were working on are put back to pending
+        # by handle_restart on startup.
+        sys.stderr.flush()
+        os._exit(1)
 
 
 if __name__ == '__main__':
     utils.setup_environ()
-    keep_pulling()
+    main()
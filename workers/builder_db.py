@@ -1,7 +1,57 @@
+import datetime
 import typing
 
 from lib import common_db
 
+# For how long a pending build may be passed over in favour of builds which
+# are similar to what the builder has built last.  Builds which have been
+# waiting longer than that are picked in order they were scheduled.
+AFFINITY_DELAY = datetime.timedelta(minutes=15)
+
+# A (type, start, data) chunk of build output.
+LogChunk = tuple[str, int, bytes]
+
+
+class BuildPhase(typing.NamedTuple):
+    """Resources used by a single phase of a build.
+
+    Attributes:
+        phase: Name of the phase, e.g. 'neard' or 'tools'.
+        wall_time: Wall time the phase took in seconds.
+        cpu_time: User and system CPU time in seconds used by commands run in
+            the phase and by the builder itself.
+        peak_rss: Largest maximum resident set size in bytes of any process run
+            in the phase.
+    """
+    phase: str
+    wall_time: float
+    cpu_time: float
+    peak_rss: int
+
+
+class BuildKey(typing.NamedTuple):
+    """What the builder has last built; see BuilderDB.get_new_build."""
+    sha: str
+    features: str
+    is_release: bool
+
+
+class StoredBuild:
+    build_id: int
+    finished: typing.Optional[datetime.datetime]
+    pinned: bool
+    unused: bool
+
+
+# Condition which is true if artifacts of the `source` build are still needed
+# by some tests.
+_PINNED_SQL = '''SELECT 1 FROM tests
+                  WHERE tests.status IN ('RUNNING', 'PENDING')
+                    AND tests.build_id IN (
+                        SELECT build_id FROM builds
+                         WHERE build_id = source.build_id
+                            OR artifact_id = source.build_id)'''
+
 
 class Build:
     build_id: int
@@ -9,6 +59,7 @@ class Build:
     is_release: int
     sha: str
     expensive: bool
+    expensive_tests: list[str]
 
 
 class BuilderDB(common_db.DB):
@@ -24,49 +75,180 @@ class BuilderDB(common_db.DB):
         super().__init__()
         self._ipv4 = ipv4
 
-    def get_new_build(self) -> typing.Optional[Build]:
-        """Returns a pending build to process or None if none found."""
-        build_sql = '''SELECT build_id
-                         FROM builds
-                        WHERE status = 'PENDING'
-                        ORDER BY low_priority, build_id
-                        LIMIT 1
-                          FOR UPDATE'''
+    def get_new_build(
+            self,
+            last: typing.Optional[BuildKey] = None) -> typing.Optional[Build]:
+        """Returns a pending build to process or None if none found.
+
+        Builds of the same commit and with the same features as the previous
+        build in the slot are preferred since they can reuse most of the
+        compilation state left in slot’s worktree and target directory.  Builds
+        with the same features and build profile score higher than one of the
+        same commit since a change in features forces rebuilding of most
+        dependencies while a different commit usually only touches a handful of
+        nearcore’s crates.  To bound unfairness, builds which have been waiting
+        for longer than AFFINITY_DELAY are picked first in order they were
+        scheduled.  Low priority builds are still always picked last.
+
+        Builds identical to a speculative build which is being built (see
+        scheduler.prebuild_master) are skipped since they are going to reuse
+        its artifacts once it finishes.
+
+        Args:
+            last: Key of the last build performed in the slot if any.
+        Returns:
+            A build claimed by the builder or None.  Its `expensive_tests`
+            field lists names of pending expensive tests of the build.
+        """
+        affinity = ''
+        params: dict[str, typing.Any] = {}
+        if last:
+            affinity = '''2 * (builds.is_release = :is_release AND
+                               builds.features = :features)::int +
+                          (runs.sha = :sha)::int DESC,'''
+            params = {
+                'sha': bytes.fromhex(last.sha),
+                'features': last.features,
+                'is_release': last.is_release,
+            }
+        expensive_tests_sql = '''SELECT test_id FROM tests
+                                  WHERE status = 'PENDING'
+                                    AND category = 'expensive'
+                                    AND build_id = builds.build_id'''
+        speculative_sql = f'''SELECT 1
+                                FROM builds AS other
+                                JOIN runs AS other_run USING (run_id)
+                               WHERE other.speculative
+                                 AND other.status = 'BUILDING'
+                                 AND other.is_release = builds.is_release
+                                 AND other.features = builds.features
+                                 AND other_run.sha = runs.sha
+                                 AND (other.expensive OR
+                                      NOT EXISTS ({expensive_tests_sql}))'''
+        build_sql = f'''SELECT build_id
+                          FROM builds JOIN runs USING (run_id)
+                         WHERE status = 'PENDING'
+                           AND NOT EXISTS ({speculative_sql})
+                         ORDER BY low_priority,
+                                  runs.timestamp < NOW() - :delay DESC,
+                                  {affinity}
+                                  build_id
+                         LIMIT 1
+                           FOR UPDATE OF builds SKIP LOCKED'''
+        # Speculative builds have no tests.  Whether they need to compile
+        # expensive tests has been decided when they were scheduled.
         update_sql = f'''UPDATE builds
                             SET started = NOW(),
                                 finished = NULL,
                                 status = 'BUILDING',
-                                builder_ip = {int(self._ipv4)}
-                          WHERE build_id IN ({build_sql})
-                      RETURNING build_id, run_id, features, is_release'''
-        expensive_tests_sql = '''SELECT test_id FROM tests
-                                  WHERE status = 'PENDING'
-                                    AND category = 'expensive'
-                                    AND build_id = build.build_id'''
-        sql = f'''WITH build AS ({update_sql})
-                  SELECT build_id, features, is_release,
+                                builder_ip = {int(self._ipv4)},
+                                expensive = speculative AND expensive OR
+                                            EXISTS ({expensive_tests_sql}),
+                                expensive_packages = NULL
+                          WHERE build_id IN (SELECT build_id FROM claimed)
+                      RETURNING build_id, run_id, features, is_release,
+                                expensive'''
+        sql = f'''WITH claimed AS MATERIALIZED ({build_sql}),
+                       build AS ({update_sql})
+                  SELECT build_id, features, is_release, expensive,
                          ENCODE(sha, 'hex') sha,
-                         EXISTS ({expensive_tests_sql}) expensive
+                         ARRAY(SELECT name FROM tests
+                                WHERE status = 'PENDING'
+                                  AND category = 'expensive'
+                                  AND build_id = build.build_id
+                                ORDER BY name) AS expensive_tests
                     FROM build JOIN runs USING (run_id)'''
-        return typing.cast(typing.Optional[Build], self._exec(sql).first())
+        build = typing.cast(
+            typing.Optional[Build],
+            self._exec(sql, delay=AFFINITY_DELAY, **params).first())
+        if build:
+            # Discard output and statistics of any earlier attempt at the
+            # build.
+            self._exec('DELETE FROM build_logs WHERE build_id = :id',
+                       id=build.build_id)
+            self._exec('DELETE FROM build_phases WHERE build_id = :id',
+                       id=build.build_id)
+            self._exec('DELETE FROM build_files WHERE build_id = :id',
+                       id=build.build_id)
+            self._exec('DELETE FROM build_peers WHERE build_id = :id',
+                       id=build.build_id)
+        return build
 
-    def update_build_status(self, build_id: int, success: bool, *, out: bytes,
-                            err: bytes) -> None:
+    def append_build_logs(self, build_id: int,
+                          chunks: typing.Sequence[LogChunk]) -> None:
+        """Stores chunks of output of a running build.
+
+        A batch may be sent again if storing it failed (or seemed to fail) and
+        by that time more output may have been appended to its last chunk.
+        Chunks start at the same offsets as before so a chunk which has already
+        been stored is replaced if the new one is longer and ignored otherwise.
+
+        Args:
+            build_id: Id of the build.
+            chunks: Chunks of the output to store.
+        """
+        on_conflict = '''(build_id, type, start) DO UPDATE
+                             SET data = EXCLUDED.data
+                           WHERE LENGTH(EXCLUDED.data) >
+                                 LENGTH(build_logs.data)'''
+        self._multi_insert('build_logs', ('build_id', 'type', 'start', 'data'),
+                           [(build_id, *chunk) for chunk in chunks],
+                           on_conflict=on_conflict)
+
+    def update_build_status(
+        self,
+        build_id: int,
+        success: bool,
+        phases: typing.Sequence[BuildPhase] = (),
+        expensive_packages: typing.Optional[typing.Sequence[str]] = None,
+        files: typing.Sequence[common_db.ArtifactFile] = ()
+    ) -> None:
         """Updates build status in the database.
 
         If the build failed also updates all dependent tests to CANCELED status.
+        Build’s output is expected to have been stored with append_build_logs.
+        Manifest and phase timings are stored in the same transaction as the
+        status so that workers never see a finished build with a partial
+        manifest.
+        If the build succeeded, the builder is added to build’s peers (see
+        WorkerDB.acquire_source) so that workers can download its artifacts.
 
         Args:
             build_id: Id of the build.
             success: Whether the build has succeeded.
-            out: Standard output of the build process.
-            err: Standard error output of the build process.
+            phases: Resources used by phases of the build which have finished.
+            expensive_packages: Packages whose expensive tests have been
+                compiled or None if expensive tests of all packages have been
+                compiled (or the build has no expensive tests).
+            files: Manifest of the build, i.e. all files in the build
+                directory.  Workers use it to copy only the files they don’t
+                already have.  Ignored if the build failed.
         """
+        self._in_transaction(self.__update_build_status, build_id, success,
+                             phases, expensive_packages, files)
+        if success:
+            self._notify(common_db.PENDING_TESTS_CHANNEL)
+            self.__reuse_build(build_id)
+
+    def __update_build_status(
+            self, build_id: int, success: bool,
+            phases: typing.Sequence[BuildPhase],
+            expensive_packages: typing.Optional[typing.Sequence[str]],
+            files: typing.Sequence[common_db.ArtifactFile]) -> None:
+        if success and files:
+            self._multi_insert(
+                'build_files',
+                ('build_id', 'path', 'size', 'sha256', 'executable'),
+                [(build_id, *file) for file in files])
+        if phases:
+            self._multi_insert(
+                'build_phases',
+                ('build_id', 'phase', 'wall_time', 'cpu_time', 'peak_rss'),
+                [(build_id, *phase) for phase in phases])
         sql = '''UPDATE builds
                     SET finished = NOW(),
                         status = :status,
-                        stderr = :err,
-                        stdout = :out
+                        expensive_packages = :packages
                   WHERE build_id = :id'''
         if success:
             status = 'BUILD DONE'
@@ -78,30 +260,123 @@ class BuilderDB(common_db.DB):
                  WHERE build_id IN (SELECT build_id FROM b)
                    AND tests.status = 'PENDING'
             '''
-        out = self._blob_from_data(out)
-        err = self._blob_from_data(err)
-        self._exec(sql, status=status, err=err, out=out, id=build_id)
+        packages = None if expensive_packages is None else list(
+            expensive_packages)
+        self._exec(sql, status=status, id=build_id, packages=packages)
+        if success:
+            sql = '''INSERT INTO build_peers (build_id, worker_ip)
+                     VALUES (:id, :ip) ON CONFLICT DO NOTHING'''
+            self._exec(sql, id=build_id, ip=self._ipv4)
+
+    def __reuse_build(self, build_id: int) -> None:
+        """Lets pending builds identical to given one reuse its artifacts.
+
+        Runs on the same commit are often scheduled close to each other (e.g.
+        a nightly run and a developer’s run on master) so the build of the
+        later one may still be pending when the first one finishes.
+        """
+        sql = '''SELECT other.build_id
+                   FROM builds AS this
+                   JOIN runs AS this_run USING (run_id),
+                        builds AS other
+                   JOIN runs AS other_run USING (run_id)
+                  WHERE this.build_id = :id
+                    AND other.status = 'PENDING'
+                    AND other.is_release = this.is_release
+                    AND other.features = this.features
+                    AND other_run.sha = this_run.sha'''
+        self._reuse_artifacts(self._exec(sql, id=build_id).scalars().all())
 
-    def handle_restart(self) -> None:
+    def handle_restart(self, build_id: typing.Optional[int] = None) -> None:
+        """Puts builds owned by the builder back to PENDING.
+
+        Args:
+            build_id: If given, only this build is reset; otherwise all builds
+                the builder is building are.
+        """
         sql = '''UPDATE builds
                     SET started = NULL,
                         status = 'PENDING',
                         builder_ip = 0
                   WHERE status = 'BUILDING'
                     AND builder_ip = :ip'''
-        self._exec(sql, ip=self._ipv4)
+        kw: dict[str, typing.Any] = {'ip': self._ipv4}
+        if build_id is not None:
+            sql += ' AND build_id = :id'
+            kw['id'] = build_id
+        self._exec(sql, **kw)
+
+    def get_stored_builds(self) -> typing.Sequence[StoredBuild]:
+        """Returns builds whose artifacts are stored on this builder.
+
+        A build is pinned as long as any test of the build or of any build
+        reusing its artifacts (see DB._reuse_artifacts) is pending or running
+        since workers are going to fetch its artifacts.  A build is unused if
+        it’s a speculative build which no build is going to reuse; see
+        common_db.UNUSED_SPECULATIVE_SQL.  Builds which are being built are not
+        returned.
+        """
+        sql = f'''SELECT build_id, finished,
+                         EXISTS ({_PINNED_SQL}) AS pinned,
+                         ({common_db.UNUSED_SPECULATIVE_SQL}) AS unused
+                    FROM builds AS source
+                   WHERE builder_ip = :ip
+                     AND artifact_id IS NULL
+                     AND status != 'BUILDING' '''
+        rows = self._exec(sql,
+                          ip=self._ipv4,
+                          ttl=common_db.SPECULATIVE_BUILD_TTL).fetchall()
+        return typing.cast(typing.Sequence[StoredBuild], rows)
 
-    def builds_without_pending_tests(self) -> typing.Sequence[int]:
-        """Returns IDs of builds assigned to this builder w/no pending tests."""
-        sql = '''SELECT builds.build_id
+    def release_builds(self,
+                       ids: typing.Collection[int]) -> typing.Sequence[int]:
+        """Unassigns given builds from this builder unless they are pinned.
+
+        Builds reusing artifacts of a released build are unassigned as well so
+        that workers don’t try to fetch artifacts which are gone.  Builds are
+        unassigned before their artifacts are deleted so that no new run can
+        start using them in the meantime.  The caller is expected to delete
+        artifacts of the returned builds.
+
+        Args:
+            ids: Builds to release.  Pinned builds (see get_stored_builds) and
+                builds not owned by the builder are ignored.
+        Returns:
+            IDs of builds whose artifacts can be deleted.
+        """
+        if not ids:
+            return ()
+        return self._in_transaction(self.__release_builds, tuple(ids))
+
+    def __release_builds(self, ids: tuple[int, ...]) -> typing.Sequence[int]:
+        # Lock the builds first.  This waits for any transaction which is in
+        # the middle of reusing one of them and, since each statement in
+        # a transaction gets a fresh snapshot, makes tests added by such
+        # transaction visible to the query below.
+        sql = '''SELECT build_id
                    FROM builds
-                   LEFT JOIN tests ON (tests.build_id = builds.build_id
-                                   AND tests.status IN ('RUNNING', 'PENDING'))
-                  WHERE builder_ip = :ip AND test_id IS NULL'''
-        scalars = self._exec(sql, ip=self._ipv4).scalars()
+                  WHERE build_id IN :ids
+                    AND builder_ip = :ip
+                    AND artifact_id IS NULL
+                    FOR UPDATE'''
+        if not self._exec(sql, ids=ids, ip=self._ipv4).first():
+            return ()
+        sql = f'''WITH unused AS (
+                     SELECT build_id
+                       FROM builds AS source
+                      WHERE build_id IN :ids
+                        AND builder_ip = :ip
+                        AND artifact_id IS NULL
+                        AND NOT EXISTS ({_PINNED_SQL})
+                 ), released AS (
+                     UPDATE builds SET builder_ip = 0
+                      WHERE build_id IN (SELECT build_id FROM unused)
+                         OR artifact_id IN (SELECT build_id FROM unused)
+                 ), withdrawn AS (
+                     DELETE FROM build_peers
+                      WHERE build_id IN (SELECT build_id FROM unused)
+                        AND worker_ip = :ip
+                 )
+                 SELECT build_id FROM unused'''
+        scalars = self._exec(sql, ids=ids, ip=self._ipv4).scalars()
         return tuple(int(bid) for bid in scalars)
-
-    def unassign_builds(self, ids: typing.Sequence[int]) -> None:
-        """Unassigns given builds from any builder."""
-        sql = 'UPDATE builds SET builder_ip = 0 WHERE build_id IN ({})'
-        self._exec(sql.format(', '.join(str(int(bid)) for bid in ids)))
@@ -0,0 +1,281 @@
+import dataclasses
+import os
+import pathlib
+import re
+import sys
+import threading
+import time
+import typing
+
+import prometheus_client
+import psutil
+
+from . import builder_db
+from . import utils
+
+# Free space needed before a build starts.  The threshold has been chosen to be
+# able to finish any build even in the worst circumstances.  Considering that
+# even the largest build does not exceed 15GB this should be a safe bet.
+REQUIRED_FREE_SPACE = 50_000_000_000
+
+# Cargo units used more recently than that are deleted only if removing all
+# older units and all unneeded builds didn’t free enough space.  With the
+# ‘relatime’ mount option access times are updated at most once a day so this
+# shouldn’t be less than a day.
+STALE_UNIT_AGE = 3 * 24 * 3600
+
+# Longest interval between checks while waiting for tests to finish.
+MAX_WAIT_INTERVAL = 60
+
+RECLAIMED_BYTES = prometheus_client.Counter(
+    'nayduck_builder_reclaimed_bytes',
+    'Bytes of disk space freed by deleting artifacts of builds no longer '
+    'needed by any test and by trimming Cargo target directories', ['kind'])
+
+# Matches metadata hash Cargo puts in names of unit’s files and directories.
+_UNIT_HASH_RE = re.compile(r'-([0-9a-f]{16})(?:\.|$)')
+
+
+@dataclasses.dataclass
+class CargoUnit:
+    """Files of a single Cargo compilation unit; see cargo_units."""
+    last_used: float
+    paths: list[pathlib.Path]
+
+
+class DiskManager:
+    """Makes sure there’s enough free disk space before builds start.
+
+    Space is reclaimed in stages, each of which stops as soon as there’s
+    REQUIRED_FREE_SPACE available:
+
+    1. Artifacts of builds no test needs any longer are deleted, least recently
+       used first.  Builds with pending or running tests are pinned and never
+       deleted.  A build is considered used whenever a worker fetches its
+       artifacts (see artifact_server.ArtifactServer.mark_used) and for as long
+       as it’s pinned.  Both are recorded in modification time of the build
+       directory so the order survives restarts.  Unused speculative builds
+       (see BuilderDB.get_stored_builds) are deleted first and regardless of
+       how much free space there is.
+    2. Cargo units of the slot’s target directories which haven’t been used for
+       STALE_UNIT_AGE are deleted, least recently used first.
+    3. Remaining Cargo units of the slot are deleted, least recently used first.
+       Target directories of other slots are left alone since they may be in
+       use.
+    4. Finally, the manager waits for tests to finish and keeps deleting builds
+       as they become unpinned.
+
+    A single object is shared by all slots of the builder.
+    """
+
+    def __init__(self, required: int = REQUIRED_FREE_SPACE) -> None:
+        self.__required = required
+        self.__lock = threading.Lock()
+
+    def wait_for_free_space(self, server: builder_db.BuilderDB,
+                            target_dirs: typing.Sequence[pathlib.Path]) -> None:
+        """Reclaims disk space and waits until there’s enough of it.
+
+        Args:
+            server: Database to query for builds stored on the builder.
+            target_dirs: Cargo target directories of the slot which is about to
+                start a build.
+        """
+        with self.__lock:
+            if self.__reclaim(server, target_dirs):
+                return
+
+        print(
+            'Not enough free space; '
+            'waiting for tests to finish to clean up more builds',
+            file=sys.stderr)
+        interval = 5
+        while True:
+            time.sleep(interval)
+            interval = min(interval * 2, MAX_WAIT_INTERVAL)
+            with self.__lock:
+                if self.__deficit() <= 0:
+                    return
+                self.__evict_builds(server)
+                if self.__deficit() <= 0:
+                    return
+
+    def __deficit(self) -> int:
+        """Returns how many bytes need to be freed; not positive if none."""
+        return self.__required - psutil.disk_usage(str(utils.WORKDIR)).free
+
+    def __reclaim(self, server: builder_db.BuilderDB,
+                  target_dirs: typing.Sequence[pathlib.Path]) -> bool:
+        """Runs reclamation stages; returns whether enough space was freed."""
+        self.__evict_builds(server)
+        now = time.time()
+        for max_last_used in (now - STALE_UNIT_AGE, now):
+            deficit = self.__deficit()
+            if deficit <= 0:
+                return True
+            freed = trim_target_dirs(target_dirs, deficit, max_last_used)
+            RECLAIMED_BYTES.labels('cargo').inc(freed)
+        return self.__deficit() <= 0
+
+    def __evict_builds(self, server: builder_db.BuilderDB) -> None:
+        """Deletes unused builds and, as space requires, unpinned builds."""
+        candidates = []
+        for build in server.get_stored_builds():
+            build_id = int(build.build_id)
+            build_dir = utils.BUILDS_DIR / str(build_id)
+            if build.pinned:
+                _mark_used(build_dir)
+                continue
+            try:
+                last_used = build_dir.stat().st_mtime
+            except FileNotFoundError:
+                last_used = build.finished.timestamp() if build.finished else 0
+            candidates.append((not build.unused, last_used, build_id))
+
+        deficit = self.__deficit()
+        sizes = {}
+        for used, _, build_id in sorted(candidates):
+            if used and deficit <= 0:
+                break
+            sizes[build_id] = _reclaimable_size(utils.BUILDS_DIR /
+                                                str(build_id))
+            deficit -= sizes[build_id]
+        for build_id in server.release_builds(sizes):
+            print(f'Deleting build #{build_id}', file=sys.stderr)
+            utils.rmdirs(utils.BUILDS_DIR / str(build_id))
+            RECLAIMED_BYTES.labels('build').inc(sizes[build_id])
+
+
+def trim_target_dirs(target_dirs: typing.Sequence[pathlib.Path], goal: int,
+                     max_last_used: float) -> int:
+    """Deletes least recently used Cargo units from target directories.
+
+    Args:
+        target_dirs: Cargo target directories to trim.
+        goal: Number of bytes to free.  Deleting stops once that many bytes
+            have been freed.
+        max_last_used: Only units last used before this time (as returned by
+            time.time()) are deleted.
+    Returns:
+        Number of bytes freed.
+    """
+    units = sorted((
+        unit for target_dir in target_dirs for unit in cargo_units(target_dir)),
+                   key=lambda unit: unit.last_used)
+    freed = 0
+    for unit in units:
+        if freed >= goal or unit.last_used >= max_last_used:
+            break
+        # Fingerprint goes first so that if we’re interrupted Cargo won’t
+        # consider the unit fresh with some of its outputs missing.
+        for path in unit.paths:
+            freed += _reclaimable_size(path)
+            _remove(path)
+    if freed:
+        print(f'Trimmed {freed} bytes from Cargo target directories',
+              file=sys.stderr)
+    return freed
+
+
+def cargo_units(target_dir: pathlib.Path) -> list[CargoUnit]:
+    """Returns compilation units found in a Cargo target directory.
+
+    Cargo keeps outputs of every unit (a crate compiled with particular
+    features, profile and dependencies) it has ever built.  All files of
+    a unit are named after unit’s metadata hash: its fingerprint directory in
+    `.fingerprint`, build script outputs in `build` and compiled artifacts in
+    `deps`.  Cargo reads unit’s fingerprint whenever it checks whether the unit
+    is fresh so access time of the fingerprint tells when the unit was last
+    used.  Incremental compilation caches in `incremental` are treated as
+    units of their own and use modification time instead.
+
+    Args:
+        target_dir: Cargo target directory.  It’s not an error if it doesn’t
+            exist.
+    Returns:
+        Units found in the directory.  Paths of each unit start with its
+        fingerprint directory.
+    """
+    units: list[CargoUnit] = []
+    for fingerprints in (*target_dir.glob('*/.fingerprint'),
+                         *target_dir.glob('*/*/.fingerprint')):
+        profile_dir = fingerprints.parent
+        by_hash: dict[str, CargoUnit] = {}
+        for path in _list_dir(fingerprints):
+            match = _UNIT_HASH_RE.search(path.name)
+            if match:
+                by_hash[match.group(1)] = CargoUnit(_last_used(path), [path])
+        for path in (*_list_dir(profile_dir / 'build'),
+                     *_list_dir(profile_dir / 'deps')):
+            match = _UNIT_HASH_RE.search(path.name)
+            unit = by_hash.get(match.group(1)) if match else None
+            if unit:
+                unit.paths.append(path)
+        units.extend(by_hash.values())
+        for path in _list_dir(profile_dir / 'incremental'):
+            units.append(CargoUnit(_last_used(path, atime=False), [path]))
+    return units
+
+
+def _list_dir(path: pathlib.Path) -> list[pathlib.Path]:
+    """Returns entries of a directory or empty list if it doesn’t exist."""
+    try:
+        return list(path.iterdir())
+    except FileNotFoundError:
+        return []
+
+
+def _last_used(path: pathlib.Path, *, atime: bool = True) -> float:
+    """Returns latest access or modification time of files in a directory."""
+    latest = 0.0
+    for entry in _list_dir(path):
+        try:
+            attrs = entry.lstat()
+        except FileNotFoundError:
+            continue
+        latest = max(latest, attrs.st_mtime)
+        if atime:
+            latest = max(latest, attrs.st_atime)
+    return latest
+
+
+def _mark_used(build_dir: pathlib.Path) -> None:
+    """Sets modification time of a build directory to now if it exists."""
+    try:
+        os.utime(build_dir)
+    except FileNotFoundError:
+        pass
+
+
+def _reclaimable_size(path: pathlib.Path) -> int:
+    """Returns number of bytes deleting given file or directory would free.
+
+    Only files which have no other hard links are counted.  Build artifacts are
+    hard links to files in Cargo target directories so deleting one of them
+    frees space only after Cargo replaced its copy (and vice versa).
+    """
+    if not path.is_dir():
+        paths = [str(path)]
+    else:
+        paths = [
+            os.path.join(dirpath, name)
+            for dirpath, _, filenames in os.walk(path)
+            for name in filenames
+        ]
+    total = 0
+    for name in paths:
+        try:
+            attrs = os.lstat(name)
+        except FileNotFoundError:
+            continue
+        if attrs.st_nlink == 1:
+            total += attrs.st_blocks * 512
+    return total
+
+
+def _remove(path: pathlib.Path) -> None:
+    """Removes a file or a directory tree."""
+    if path.is_dir() and not path.is_symlink():
+        utils.rmdirs(path)
+    else:
+        path.unlink(missing_ok=True)
@@ -0,0 +1,45 @@
+import os
+import pathlib
+
+from . import disk
+
+
+def _make_unit(profile_dir: pathlib.Path, name: str, unit_hash: str,
+               last_used: float) -> None:
+    fingerprint = profile_dir / '.fingerprint' / f'{name}-{unit_hash}'
+    fingerprint.mkdir(parents=True)
+    (fingerprint / f'lib-{name}').write_text(unit_hash)
+    os.utime(fingerprint / f'lib-{name}', (last_used, last_used))
+    (profile_dir / 'deps').mkdir(exist_ok=True)
+    for filename in (f'lib{name}-{unit_hash}.rlib', f'{name}-{unit_hash}.d'):
+        (profile_dir / 'deps' / filename).write_bytes(b'x' * 8192)
+
+
+def test_trim_target_dirs(tmp_path: pathlib.Path):
+    profile_dir = tmp_path / 'target' / 'debug'
+    _make_unit(profile_dir, 'old', '0123456789abcdef', 1000)
+    _make_unit(profile_dir, 'stale', 'fedcba9876543210', 2000)
+    _make_unit(profile_dir, 'fresh', '00112233aabbccdd', 3000)
+    # Hard linked elsewhere (e.g. into a build directory) so deleting it
+    # doesn’t free anything.
+    os.link(profile_dir / 'deps/libold-0123456789abcdef.rlib',
+            tmp_path / 'neard')
+
+    units = disk.cargo_units(tmp_path / 'target')
+    assert sorted(
+        (unit.last_used, len(unit.paths)) for unit in units) == [(1000, 3),
+                                                                 (2000, 3),
+                                                                 (3000, 3)]
+
+    freed = disk.trim_target_dirs([tmp_path / 'target'], 1, 2500)
+    assert 0 < freed
+    assert sorted(os.listdir(profile_dir / 'deps')) == [
+        'fresh-00112233aabbccdd.d', 'libfresh-00112233aabbccdd.rlib',
+        'libstale-fedcba9876543210.rlib', 'stale-fedcba9876543210.d'
+    ]
+    assert (tmp_path / 'neard').exists()
+
+    freed = disk.trim_target_dirs([tmp_path / 'target'], 1 << 40, 2500)
+    assert 0 < freed
+    assert sorted(os.listdir(profile_dir /
+                             '.fingerprint')) == ['fresh-00112233aabbccdd']
@@ -0,0 +1,219 @@
+import sys
+import threading
+import types
+import typing
+
+import prometheus_client
+from sqlalchemy import exc
+
+from . import builder_db
+from . import worker_db
+
+# How often buffered output is sent to the database.
+FLUSH_INTERVAL = 2
+
+# Maximum number of bytes of each stream buffered between flushes.  If the
+# database can’t keep up, the oldest unsent output of a test is dropped (full
+# output is uploaded once the test finishes anyway) while a build is made to
+# wait until its output is sent.
+MAX_PENDING = 256 * 1024
+
+# Maximum size of a single row in the live_logs table.
+CHUNK_SIZE = 64 * 1024
+
+LIVE_LOG_BYTES = prometheus_client.Counter(
+    'nayduck_worker_live_log_bytes',
+    'Number of bytes of output of running tests by whether they were sent to '
+    'the database or dropped due to backpressure', ['result'])
+
+
+class _Pending:
+    """Output of a single stream waiting to be sent to the database."""
+
+    def __init__(self) -> None:
+        self.start = 0
+        self.data = bytearray()
+
+    def chunks(self, stream: str) -> list[worker_db.LiveChunk]:
+        """Splits pending output into chunks to be sent to the database."""
+        data = bytes(self.data)
+        return [(stream, self.start + pos, data[pos:pos + CHUNK_SIZE])
+                for pos in range(0, len(data), CHUNK_SIZE)]
+
+
+class LiveLog:
+    """Streams output of a running test to the database.
+
+    The object is used as a context manager.  While inside of the context,
+    output passed to feed() is buffered and periodically sent to the database
+    in batches from a background thread.  The slot’s thread running the test is
+    never blocked on the database; if sending is slower than the test produces
+    output, the oldest buffered output is dropped.  Gaps are visible to readers
+    as jumps in chunk offsets.
+    """
+
+    def __init__(self,
+                 server: worker_db.WorkerDB,
+                 test_id: int,
+                 *,
+                 interval: float = FLUSH_INTERVAL) -> None:
+        """Initialises the object.
+
+        Args:
+            server: Database connection to use.  It’s used from a background
+                thread so it mustn’t be used by anything else while inside of
+                the context.
+            test_id: Id of the test whose output is streamed.
+            interval: Time in seconds between sending batches of output.
+        """
+        self.__server = server
+        self.__test_id = test_id
+        self.__interval = interval
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__pending = {'stdout': _Pending(), 'stderr': _Pending()}
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+
+    def feed(self, stream: str, data: bytes) -> None:
+        """Buffers output of the test; see utils.Runner.on_output."""
+        if self.__stop.is_set():
+            return
+        with self.__lock:
+            pending = self.__pending[stream]
+            pending.data += data
+            excess = len(pending.data) - MAX_PENDING
+            if excess > 0:
+                del pending.data[:excess]
+                pending.start += excess
+                LIVE_LOG_BYTES.labels('dropped').inc(excess)
+
+    def __run(self) -> None:
+        while not self.__stop.wait(self.__interval):
+            try:
+                self.__flush()
+            except exc.SQLAlchemyError as ex:
+                print(f'Failed to send live logs: {ex}', file=sys.stderr)
+
+    def __flush(self) -> None:
+        """Sends all buffered output to the database."""
+        chunks: list[worker_db.LiveChunk] = []
+        with self.__lock:
+            for stream, pending in self.__pending.items():
+                chunks.extend(pending.chunks(stream))
+                pending.start += len(pending.data)
+                pending.data.clear()
+        if chunks:
+            self.__server.append_live_logs(self.__test_id, chunks)
+            LIVE_LOG_BYTES.labels('sent').inc(
+                sum(len(chunk[2]) for chunk in chunks))
+
+    def close(self) -> None:
+        """Stops streaming; output fed afterwards is ignored.
+
+        Any output buffered since the last batch is discarded rather than sent
+        since the caller is about to save test’s full logs.  Calling this
+        method more than once is harmless.
+        """
+        self.__stop.set()
+        if self.__thread.is_alive():
+            self.__thread.join()
+
+    def __enter__(self) -> 'LiveLog':
+        self.__thread.start()
+        return self
+
+    def __exit__(self, exc_type: typing.Optional[type[BaseException]],
+                 exc_value: typing.Optional[BaseException],
+                 exc_tb: typing.Optional[types.TracebackType]) -> None:
+        self.close()
+
+
+class BuildLog:
+    """Streams output of a build to the database.
+
+    The object is used as a context manager.  While inside of the context,
+    output passed to feed() is buffered and periodically sent to the database
+    in batches from a background thread.  Since the build_logs table holds the
+    only copy of build’s output, none of it is ever dropped.  Instead, if
+    sending is slower than the build produces output, feed() blocks which
+    makes the build wait on its output pipe.  If sending fails, it’s retried
+    with the next batch.  All output is sent by the time the context exits.
+    """
+
+    def __init__(self,
+                 server: builder_db.BuilderDB,
+                 build_id: int,
+                 *,
+                 interval: float = FLUSH_INTERVAL) -> None:
+        """Initialises the object.
+
+        Args:
+            server: Database connection to use.  It’s used from a background
+                thread so it mustn’t be used by anything else while inside of
+                the context.
+            build_id: Id of the build whose output is streamed.
+            interval: Time in seconds between sending batches of output.
+        """
+        self.__server = server
+        self.__build_id = build_id
+        self.__interval = interval
+        self.__cond = threading.Condition()
+        self.__closed = False
+        self.__pending = {'stdout': _Pending(), 'stderr': _Pending()}
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+
+    def feed(self, stream: str, data: bytes) -> None:
+        """Buffers output of the build; see utils.Runner.on_output."""
+        pending = self.__pending[stream]
+        with self.__cond:
+            self.__cond.wait_for(
+                lambda: self.__closed or len(pending.data) < MAX_PENDING)
+            if not self.__closed:
+                pending.data += data
+
+    def __run(self) -> None:
+        while True:
+            with self.__cond:
+                if self.__cond.wait_for(lambda: self.__closed, self.__interval):
+                    return
+            try:
+                self.__flush()
+            except exc.SQLAlchemyError as ex:
+                print(f'Failed to send build logs: {ex}', file=sys.stderr)
+
+    def __flush(self) -> None:
+        """Sends all buffered output to the database.
+
+        Output is removed from the buffer only once it has been sent.
+        Chunks sent more than once (e.g. if the database committed a batch but
+        we got an error) start at the same offsets and the database keeps the
+        longer copy; see BuilderDB.append_build_logs.
+        """
+        with self.__cond:
+            chunks = [
+                chunk for stream, pending in self.__pending.items()
+                for chunk in pending.chunks(stream)
+            ]
+        if not chunks:
+            return
+        self.__server.append_build_logs(self.__build_id, chunks)
+        with self.__cond:
+            for stream, pending in self.__pending.items():
+                size = sum(
+                    len(chunk[2]) for chunk in chunks if chunk[0] == stream)
+                del pending.data[:size]
+                pending.start += size
+            self.__cond.notify_all()
+
+    def __enter__(self) -> 'BuildLog':
+        self.__thread.start()
+        return self
+
+    def __exit__(self, exc_type: typing.Optional[type[BaseException]],
+                 exc_value: typing.Optional[BaseException],
+                 exc_tb: typing.Optional[types.TracebackType]) -> None:
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notify_all()
+        self.__thread.join()
+        self.__flush()
@@ -0,0 +1,257 @@
+import collections
+import json
+import os
+import pathlib
+import shutil
+import sys
+import threading
+import time
+import traceback
+import typing
+
+import prometheus_client
+from sqlalchemy import exc
+
+from . import utils
+
+# Directory with logs of finished tests waiting to be saved.  It’s on the data
+# drive so that the queue survives worker restarts.
+QUEUE_DIR = utils.WORKDIR / 'log-queue'
+
+# Maximum number of finished tests whose logs may wait in the queue.  Once
+# reached, slots wait for space before claiming their next test which bounds
+# disk space taken by the queue.
+DEFAULT_CAPACITY = 32
+
+# How long to wait before saving an entry again after a database error.
+RETRY_INTERVAL = 10
+
+# Suffix of entries which are still being written.  Those are deleted on
+# start since a crash may have left them incomplete.
+_STAGING_SUFFIX = '.tmp'
+_META_FILE = 'entry.json'
+
+QUEUE_DEPTH = prometheus_client.Gauge(
+    'nayduck_worker_log_queue_depth',
+    'Number of finished tests whose logs are waiting to be saved')
+QUEUE_WAIT_TIME = prometheus_client.Counter(
+    'nayduck_worker_log_queue_wait_seconds',
+    'Time slots spent waiting for space in the log queue')
+SAVE_LATENCY = prometheus_client.Histogram(
+    'nayduck_worker_log_save_latency_seconds',
+    'Time from a test finishing until all of its logs are saved',
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+
+
+class Entry(typing.NamedTuple):
+    """Logs of a single finished test waiting in the queue."""
+    # Directory of the entry.
+    path: pathlib.Path
+    test_id: int
+    # Test’s number of tries at the time it produced the logs.
+    tries: int
+    # Whether archive of nodes’ state should be saved along with the logs.
+    save_state: bool
+    # When the test finished as returned by time.time().
+    queued: float
+    # Summaries of test’s output files the runner scanned while the test was
+    # running, keyed by log name, so the files don’t need to be read again.
+    scanners: dict[str, utils.OutputScanner]
+
+    @property
+    def outdir(self) -> pathlib.Path:
+        """Test’s output directory with all of its log files."""
+        return self.path / 'output'
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> 'Entry':
+        """Reads entry stored in given directory.
+
+        Raises:
+            OSError: if reading entry’s metadata fails.
+            ValueError: if entry’s metadata is malformed.
+        """
+        with open(path / _META_FILE, encoding='utf-8') as rd:
+            meta = json.load(rd)
+        try:
+            # Entries queued by older workers have no scanners.
+            scanners = {
+                name: utils.OutputScanner.from_summary(summary)
+                for name, summary in meta.get('scanners', {}).items()
+            }
+            return cls(path, int(meta['test_id']), int(meta['tries']),
+                       bool(meta['save_state']), float(meta['queued']),
+                       scanners)
+        except (AttributeError, KeyError, TypeError) as ex:
+            raise ValueError(f'{path}: malformed metadata: {ex}') from ex
+
+
+def _detach_nodes(outdir: pathlib.Path, *, save_state: bool) -> None:
+    """Replaces links to nodes’ directories with what of them is needed.
+
+    Test’s output directory links to home directories of test’s nodes (see
+    worker.run_test) which are deleted once the next test in the slot starts.
+    Each node’s stderr is copied into the output directory or, if nodes’ state
+    is to be archived, the whole home directory is moved there.
+    """
+    for name in os.listdir(outdir):
+        path = outdir / name
+        if not path.is_symlink() or not path.is_dir():
+            continue
+        target = path.resolve()
+        path.unlink()
+        if save_state:
+            shutil.move(target, path)
+        elif (target / 'stderr').exists():
+            path.mkdir()
+            shutil.copyfile(target / 'stderr', path / 'stderr')
+
+
+class LogQueue:
+    """A bounded on-disk queue of logs of finished tests.
+
+    Slots put output directories of finished tests into the queue and move on
+    to their next test while a background thread (see drain) saves the logs.
+    Each entry is a directory with test’s output and a metadata file.  Entries
+    are written to a staging directory which is renamed into place once
+    complete so a crash never leaves a partial entry behind, and entries which
+    haven’t been saved when the worker stops are picked up when it starts
+    again.
+    """
+
+    def __init__(self,
+                 root: pathlib.Path = QUEUE_DIR,
+                 *,
+                 capacity: int = DEFAULT_CAPACITY) -> None:
+        """Opens the queue picking up entries left from previous runs.
+
+        Args:
+            root: Directory to store the queue in.
+            capacity: Maximum number of entries in the queue; see put.
+        """
+        self.__root = root
+        self.__capacity = max(1, capacity)
+        self.__cond = threading.Condition()
+        self.__entries: collections.deque[Entry] = collections.deque()
+        self.__staging = 0
+        utils.mkdirs(root)
+        for name in sorted(os.listdir(root)):
+            path = root / name
+            entry = None
+            if not name.endswith(_STAGING_SUFFIX):
+                try:
+                    entry = Entry.load(path)
+                except (OSError, ValueError) as ex:
+                    print(f'Dropping broken log queue entry: {ex}',
+                          file=sys.stderr)
+            if entry:
+                self.__entries.append(entry)
+            else:
+                utils.rmdirs(path)
+        QUEUE_DEPTH.set(len(self.__entries))
+
+    def __len__(self) -> int:
+        with self.__cond:
+            return len(self.__entries)
+
+    def put(
+        self,
+        outdir: pathlib.Path,
+        *,
+        test_id: int,
+        tries: int,
+        save_state: bool,
+        scanners: typing.Optional[typing.Mapping[str,
+                                                 utils.OutputScanner]] = None
+    ) -> None:
+        """Moves output of a finished test into the queue.
+
+        Blocks while the queue is full.  The output directory is moved rather
+        than copied if it’s on the same file system as the queue.
+
+        Args:
+            outdir: Test’s output directory.  It’s gone once this returns.
+            test_id: Id of the test.
+            tries: Test’s number of tries; logs aren’t saved if the test is
+                tried again before they are.
+            save_state: Whether to save archive of nodes’ state along with
+                the logs.
+            scanners: Scanners which have been fed whole contents of some of
+                the log files, keyed by log name (e.g. 'stdout').  Their
+                summaries are stored in the entry; see Entry.scanners.
+        Raises:
+            OSError: if moving the logs fails.  Logs are lost in that case.
+        """
+        start = time.monotonic()
+        with self.__cond:
+            self.__cond.wait_for(
+                lambda: len(self.__entries) + self.__staging < self.__capacity)
+            self.__staging += 1
+        QUEUE_WAIT_TIME.inc(time.monotonic() - start)
+
+        name = f'{time.time_ns():020}-{test_id}'
+        staging = self.__root / (name + _STAGING_SUFFIX)
+        scanners = dict(scanners or {})
+        entry = None
+        try:
+            utils.mkdirs(staging)
+            shutil.move(outdir, staging / 'output')
+            _detach_nodes(staging / 'output', save_state=save_state)
+            queued = time.time()
+            with open(staging / _META_FILE, 'w', encoding='utf-8') as wr:
+                json.dump(
+                    {
+                        'test_id': test_id,
+                        'tries': tries,
+                        'save_state': save_state,
+                        'queued': queued,
+                        'scanners': {
+                            log_name: scanner.summary()
+                            for log_name, scanner in scanners.items()
+                        },
+                    }, wr)
+            staging.rename(self.__root / name)
+            entry = Entry(self.__root / name, test_id, tries, save_state,
+                          queued, scanners)
+        finally:
+            if not entry:
+                utils.rmdirs(staging)
+            with self.__cond:
+                self.__staging -= 1
+                if entry:
+                    self.__entries.append(entry)
+                    QUEUE_DEPTH.set(len(self.__entries))
+                self.__cond.notify_all()
+
+    def drain(self, save: typing.Callable[[Entry], None]) -> None:
+        """Saves entries in the order they were put in; never returns.
+
+        Meant to be run in a daemon thread.  An entry is deleted once `save`
+        returns.  If it fails with a database error, it’s saved again after
+        RETRY_INTERVAL; on any other error the entry is dropped so that
+        a broken entry doesn’t hold up the queue.  Since an entry is saved
+        again if the worker stops while it’s being saved, `save` must be
+        idempotent.
+
+        Args:
+            save: Function which saves logs of a single entry.
+        """
+        while True:
+            with self.__cond:
+                self.__cond.wait_for(lambda: self.__entries)
+                entry = self.__entries[0]
+            try:
+                save(entry)
+                SAVE_LATENCY.observe(max(0, time.time() - entry.queued))
+            except exc.SQLAlchemyError as ex:
+                print(f'Failed to save logs of test {entry.test_id}: {ex}',
+                      file=sys.stderr)
+                time.sleep(RETRY_INTERVAL)
+                continue
+            except Exception:
+                traceback.print_exc()
+            utils.rmdirs(entry.path)
+            with self.__cond:
+                self.__entries.popleft()
+                QUEUE_DEPTH.set(len(self.__entries))
+                self.__cond.notify_all()
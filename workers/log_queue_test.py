@@ -0,0 +1,76 @@
+import pathlib
+import threading
+import time
+
+from . import log_queue
+from . import utils
+
+
+def _make_output(tmp_path: pathlib.Path, name: str) -> pathlib.Path:
+    outdir = tmp_path / name / 'output'
+    outdir.mkdir(parents=True)
+    (outdir / 'stdout').write_text(f'{name} stdout')
+    home = tmp_path / name / 'home/test0_finished'
+    (home / 'data').mkdir(parents=True)
+    (home / 'stderr').write_text(f'{name} node stderr')
+    (outdir / 'test0_finished').symlink_to(home)
+    return outdir
+
+
+def test_queue(tmp_path: pathlib.Path):
+    root = tmp_path / 'queue'
+    queue = log_queue.LogQueue(root, capacity=2)
+    scanner = utils.OutputScanner()
+    scanner.feed(b'first stdout')
+    queue.put(_make_output(tmp_path, 'first'),
+              test_id=1,
+              tries=1,
+              save_state=False,
+              scanners={'stdout': scanner})
+    queue.put(_make_output(tmp_path, 'second'),
+              test_id=2,
+              tries=3,
+              save_state=True)
+    assert len(queue) == 2
+    assert not (tmp_path / 'first/output').exists()
+    # Full queue makes slots wait.
+    blocked = threading.Thread(target=queue.put,
+                               args=(_make_output(tmp_path, 'third'),),
+                               kwargs={
+                                   'test_id': 3,
+                                   'tries': 1,
+                                   'save_state': False
+                               },
+                               daemon=True)
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()
+
+    # Entries outlive the worker while partially written ones are dropped.
+    (root / f'{time.time_ns():020}-4.tmp').mkdir()
+    queue = log_queue.LogQueue(root, capacity=2)
+    assert len(queue) == 2
+
+    saved = []
+
+    def save(entry: log_queue.Entry) -> None:
+        node_dir = entry.outdir / 'test0_finished'
+        assert not node_dir.is_symlink()
+        scanned = entry.scanners.get('stdout')
+        saved.append(
+            (entry.test_id, entry.tries, entry.save_state,
+             (entry.outdir / 'stdout').read_text(),
+             (node_dir / 'stderr').read_text(), (node_dir / 'data').exists(),
+             scanned and scanned.contents()))
+
+    threading.Thread(target=queue.drain, args=(save,), daemon=True).start()
+    deadline = time.monotonic() + 10
+    while len(queue) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert saved == [
+        (1, 1, False, 'first stdout', 'first node stderr', False,
+         b'first stdout'),
+        (2, 3, True, 'second stdout', 'second node stderr', True, None),
+    ]
+    assert not (tmp_path / 'second/home/test0_finished').exists()
+    assert (tmp_path / 'first/home/test0_finished').exists()
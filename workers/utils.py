@@ -1,5 +1,8 @@
+import base64
 import os
 import pathlib
+import resource
+import selectors
 import shlex
 import shutil
 import signal
@@ -8,6 +11,7 @@ import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import traceback
 import typing
@@ -21,6 +25,10 @@ WORKDIR = pathlib.Path('/datadrive')
 BUILDS_DIR = WORKDIR / 'builds'
 REPO_DIR = WORKDIR / 'nearcore'
 FUZZER_CMD_PORT = 7055
+# Port builders serve build artifacts on; see artifact_server.ArtifactServer.
+ARTIFACT_PORT = 7056
+# Port workers serve their artifacts cache on to other workers.
+PEER_ARTIFACT_PORT = 7057
 
 
 def mkdirs(*paths: pathlib.Path) -> None:
@@ -49,6 +57,31 @@ def format_duration(seconds: float) -> str:
     return f'{num // 3600}:{num // 60 % 60:02}:{num % 60:02}'
 
 
+def _wait(proc: 'subprocess.Popen[bytes]',
+          timeout: float) -> resource.struct_rusage:
+    """Waits for a process to exit and returns its resource usage.
+
+    Works like proc.wait(timeout) except that the process is reaped with
+    os.wait4 so that its resource usage is available.  Sets `proc.returncode`
+    once the process exits.
+
+    Raises:
+        subprocess.TimeoutExpired: if the process doesn’t exit in time.
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.0005
+    while True:
+        pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            return usage
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise subprocess.TimeoutExpired(proc.args, timeout)
+        delay = min(delay * 2, remaining, 0.05)
+        time.sleep(delay)
+
+
 def _kill_process_tree(pid: int) -> None:
     """Kills a process tree (including grandchildren).
 
@@ -80,10 +113,137 @@ def _kill_process_tree(pid: int) -> None:
 
 _Command = typing.Sequence[typing.Union[str, pathlib.Path]]
 
+_BACKTRACE = b'stack backtrace:'
+
+# Size of reads from command’s output pipes.
+_PIPE_CHUNK = 64 * 1024
+
+# How long to wait for command’s output pipes to be closed after it exited.
+# Background processes the command left behind may keep the pipes open; after
+# this time the Runner returns and their output is copied in the background
+# until the Runner is closed.
+_PIPE_GRACE_PERIOD = 10
+
+
+class OutputScanner:
+    """Incrementally analyses output of commands as it’s being written.
+
+    Keeps the first and last `buffer_size` bytes of the output and looks for
+    a `stack backtrace:` line so that once a command finishes its output can
+    be summarised without reading it back from disk.
+    """
+
+    def __init__(self, buffer_size: int = 8 * 1024) -> None:
+        self.__limit = buffer_size
+        self.__carry = b''
+        self.size = 0
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.has_backtrace = False
+
+    @classmethod
+    def from_file(cls,
+                  path: pathlib.Path,
+                  max_size: typing.Optional[int] = None) -> 'OutputScanner':
+        """Scans contents of an existing file.
+
+        Args:
+            path: Path to the file to scan.
+            max_size: If given, scan at most that many bytes from the start of
+                the file.
+        Returns:
+            The scanner which has been fed contents of the file.
+        """
+        scanner = cls()
+        with open(path, 'rb') as rd:
+            while max_size is None or scanner.size < max_size:
+                size = _PIPE_CHUNK
+                if max_size is not None:
+                    size = min(size, max_size - scanner.size)
+                chunk = rd.read(size)
+                if not chunk:
+                    break
+                scanner.feed(chunk)
+        return scanner
+
+    @classmethod
+    def from_summary(cls, summary: dict[str, typing.Any]) -> 'OutputScanner':
+        """Recreates a scanner from what summary method returned.
+
+        Raises:
+            KeyError: if the summary is missing a field.
+            ValueError: if the summary is malformed.
+        """
+        scanner = cls()
+        scanner.size = int(summary['size'])
+        scanner.head = bytearray(base64.b64decode(summary['head']))
+        scanner.tail = bytearray(base64.b64decode(summary['tail']))
+        scanner.has_backtrace = bool(summary['has_backtrace'])
+        return scanner
+
+    def summary(self) -> dict[str, typing.Any]:
+        """Returns state of the scanner as a JSON-serialisable dictionary.
+
+        The summary holds everything needed to summarise the output so that
+        it can be stored alongside the output and used later without reading
+        the output back.  See from_summary.
+        """
+        return {
+            'size': self.size,
+            'head': base64.b64encode(self.head).decode('ascii'),
+            'tail': base64.b64encode(self.tail).decode('ascii'),
+            'has_backtrace': self.has_backtrace,
+        }
+
+    def feed(self, data: bytes) -> None:
+        """Processes next chunk of output."""
+        self.size += len(data)
+        if len(self.head) < self.__limit:
+            self.head += data[:self.__limit - len(self.head)]
+        self.tail += data[-self.__limit:]
+        del self.tail[:-self.__limit]
+        if not self.has_backtrace:
+            # The pattern may straddle two chunks so keep end of the previous
+            # one around.
+            window = self.__carry + data.lower()
+            self.has_backtrace = _BACKTRACE in window
+            self.__carry = window[1 - len(_BACKTRACE):]
+
+    def contents(self) -> typing.Optional[bytes]:
+        """Returns the whole output or None if it didn’t fit in the buffers."""
+        rest = self.size - len(self.head)
+        if rest <= 0:
+            return bytes(self.head)
+        if rest <= len(self.tail):
+            return bytes(self.head + self.tail[len(self.tail) - rest:])
+        return None
+
+    def first_line(self) -> bytes:
+        """Returns the first non-empty line of the output, stripped."""
+        for line in self.head.split(b'\n'):
+            line = line.strip()
+            if line:
+                return bytes(line)
+        return b''
+
+    def last_line(self) -> bytes:
+        """Returns the last non-empty line of the output, stripped.
+
+        Only the buffered end of the output is considered so if the last line
+        is longer than the buffer, only its end is returned.
+        """
+        for line in reversed(self.tail.split(b'\n')):
+            line = line.strip()
+            if line:
+                return bytes(line)
+        return b''
+
 
 class Runner:
     """Class for running commands redirecting their output to files."""
 
+    # pylint: disable=too-many-instance-attributes
+
     def __init__(self, outdir: typing.Optional[pathlib.Path] = None) -> None:
         """Initialises the object.
 
@@ -95,6 +255,14 @@ class Runner:
 
         Otherwise, creates two temporary files and redirects output there.
 
+        Everything written to the files is also fed to `stdout_scanner` and
+        `stderr_scanner` while output of the most recent command alone is fed
+        to `last_stdout`.  If `on_output` is set, it’s called with name of the
+        file ('stdout' or 'stderr') and the data each time something is
+        written.  If `on_exit` is set, it’s called with resource usage of each
+        command which exits (see os.wait4); the usage includes all of
+        command’s descendants which it has waited for.
+
         Args:
             outdir: Optionally a directory to create "stdout" and "stderr" files
                 in.
@@ -108,7 +276,19 @@ class Runner:
         else:
             self.stdout = typing.cast(typing.BinaryIO, tempfile.TemporaryFile())
             self.stderr = typing.cast(typing.BinaryIO, tempfile.TemporaryFile())
+        self.stdout_scanner = OutputScanner()
+        self.stderr_scanner = OutputScanner()
+        self.last_stdout = OutputScanner()
+        self.on_output: typing.Optional[typing.Callable[[str, bytes],
+                                                        None]] = None
+        self.on_exit: typing.Optional[typing.Callable[[resource.struct_rusage],
+                                                      None]] = None
         self.__last_cwd: typing.Optional[pathlib.Path] = None
+        # Output of background processes may be written from pump threads
+        # while the Runner runs another command.
+        self.__lock = threading.Lock()
+        self.__closing = threading.Event()
+        self.__pumps: list[threading.Thread] = []
 
     def __call__(self,
                  cmd: _Command,
@@ -126,7 +306,9 @@ class Runner:
         command.
 
         Command’s output as well as the aforementioned log messages are
-        redirected to separate temporary files.
+        redirected to separate temporary files.  The output is passed through
+        pipes so that it can be analysed as it’s being written; see
+        OutputScanner.
 
         Args:
             cmd: Command to execute.
@@ -149,29 +331,141 @@ class Runner:
                 seconds.
         """
         cwd = self.log_command(print_cmd or cmd, cwd)
-        with subprocess.Popen(cmd,
-                              cwd=cwd,
-                              stdin=subprocess.DEVNULL,
-                              stdout=self.stdout,
-                              stderr=self.stderr,
-                              **kw) as proc:
+        self.last_stdout = OutputScanner()
+        ret: typing.Optional[int]
+        writers, exited, released = self.__start_pump()
+        try:
+            proc = subprocess.Popen(cmd,
+                                    cwd=cwd,
+                                    stdin=subprocess.DEVNULL,
+                                    stdout=writers[0],
+                                    stderr=writers[1],
+                                    **kw)
+        finally:
+            # If starting the command failed, the pump sees end of both pipes
+            # and exits.
+            os.close(writers[0])
+            os.close(writers[1])
+        with proc:
             duration = time.monotonic()
+            usage = None
             try:
-                ret = proc.wait(timeout)
+                usage = _wait(proc, timeout)
+                ret = proc.returncode
             except subprocess.TimeoutExpired:
-                self.stderr.write(b'# Command timed out\n')
                 _kill_process_tree(proc.pid)
-                raise
+                ret = None
+            finally:
+                exited.set()
+                released.wait()
             duration = time.monotonic() - duration
 
+        if usage and self.on_exit:
+            self.on_exit(usage)
+
+        if ret is None:
+            self.__write_stderr(b'# Command timed out\n')
+            raise subprocess.TimeoutExpired(cmd, timeout)
         if ret or duration >= 30:
             dur = format_duration(seconds=duration)
-            self.stderr.write((f'# command finished with exit code {ret} '
-                               f'after {dur}\n').encode('utf-8'))
+            self.__write_stderr((f'# command finished with exit code {ret} '
+                                 f'after {dur}\n').encode('utf-8'))
         if check and ret:
             raise subprocess.CalledProcessError(ret, cmd)
         return ret
 
+    def __start_pump(
+            self) -> tuple[tuple[int, int], threading.Event, threading.Event]:
+        """Creates pipes for command’s output and starts copying from them.
+
+        The pipes are created by hand rather than with subprocess.PIPE so that
+        their read ends stay open (see __pump) after Popen is closed.
+
+        Returns:
+            A (writers, exited, released) tuple where `writers` are write ends
+            of the stdout and stderr pipes which the caller must close once
+            the command starts, `exited` is an event the caller must set once
+            the command exits and `released` is an event it must then wait
+            for; see __pump.
+        """
+        stdout_rd, stdout_wr = os.pipe()
+        stderr_rd, stderr_wr = os.pipe()
+        exited = threading.Event()
+        released = threading.Event()
+        pump = threading.Thread(target=self.__pump,
+                                args=(stdout_rd, stderr_rd, exited, released),
+                                daemon=True)
+        pump.start()
+        self.__pumps = [pump for pump in self.__pumps if pump.is_alive()]
+        self.__pumps.append(pump)
+        return (stdout_wr, stderr_wr), exited, released
+
+    def __pump(self, stdout_rd: int, stderr_rd: int, exited: threading.Event,
+               released: threading.Event) -> None:
+        """Copies command’s output to the output files and scanners.
+
+        Runs until both of command’s output pipes are closed.  Once they are
+        or _PIPE_GRACE_PERIOD seconds after `exited` is set, whichever comes
+        first, sets `released` so that the caller can carry on.  Processes the
+        command left running in the background may keep writing to the pipes;
+        their output keeps being copied until the Runner is closed.  At that
+        point a note that the output was cut off is written and the pipes are
+        closed.  Takes ownership of the file descriptors.
+        """
+        stdout_scanners = (self.stdout_scanner, self.last_stdout)
+        sinks = {
+            stdout_rd: ('stdout', self.stdout, stdout_scanners),
+            stderr_rd: ('stderr', self.stderr, (self.stderr_scanner,)),
+        }
+        deadline = None
+        try:
+            with selectors.DefaultSelector() as selector:
+                for fd in sinks:
+                    selector.register(fd, selectors.EVENT_READ)
+                while selector.get_map():
+                    timeout = 1.0
+                    if deadline is None and exited.is_set():
+                        deadline = time.monotonic() + _PIPE_GRACE_PERIOD
+                    if deadline is not None and not released.is_set():
+                        timeout = deadline - time.monotonic()
+                        if timeout <= 0:
+                            released.set()
+                            timeout = 1.0
+                    if self.__closing.is_set():
+                        self.__write_stderr(b'# output of processes left '
+                                            b'running by the command was cut '
+                                            b'off\n')
+                        break
+                    for key, _ in selector.select(timeout=min(timeout, 1.0)):
+                        data = os.read(key.fd, _PIPE_CHUNK)
+                        if not data:
+                            selector.unregister(key.fd)
+                            continue
+                        self.__write(*sinks[key.fd], data)
+        finally:
+            for fd in sinks:
+                os.close(fd)
+            with self.__lock:
+                self.stdout.flush()
+                self.stderr.flush()
+            released.set()
+
+    def __write(self, name: str, wr: typing.BinaryIO,
+                scanners: typing.Iterable[OutputScanner], data: bytes) -> None:
+        """Writes output to given file, scanners and on_output callback."""
+        with self.__lock:
+            wr.write(data)
+            for scanner in scanners:
+                scanner.feed(data)
+            if self.on_output:
+                self.on_output(name, data)
+
+    def __write_stderr(self, data: bytes) -> None:
+        """Writes a message to command’s standard error file."""
+        self.__write('stderr', self.stderr, (self.stderr_scanner,), data)
+        with self.__lock:
+            self.stderr.flush()
+
     def log_command(self, cmd: _Command, cwd: pathlib.Path) -> pathlib.Path:
         """Logs information about command about to be executed.
 
@@ -185,7 +479,7 @@ class Runner:
         def log(cmd: typing.Iterable[typing.Any]) -> None:
             msg = '+ ' + ' '.join(shlex.quote(str(arg)) for arg in cmd) + '\n'
             sys.stderr.write(msg)
-            self.stderr.write(msg.encode('utf-8'))
+            self.__write_stderr(msg.encode('utf-8'))
 
         cwd = cwd.resolve()
         if self.__last_cwd != cwd:
@@ -199,53 +493,20 @@ class Runner:
         """Writes traceback to standard error and command’s standard error."""
         exc = traceback.format_exc()
         sys.stderr.write(exc)
-        self.stderr.write(exc.encode('utf-8'))
+        self.__write_stderr(exc.encode('utf-8'))
         self.stderr.flush()
 
     def __enter__(self) -> 'Runner':
         return self
 
     def __exit__(self, *_: typing.Any) -> None:
+        self.__closing.set()
+        for pump in self.__pumps:
+            pump.join()
         self.stdout.close()
         self.stderr.close()
 
 
-def checkout(sha: str, runner: Runner) -> bool:
-    """Checks out given SHA in the nearcore repository.
-
-    If the repository directory exists updates the origin remote and then checks
-    out the SHA.  If that fails, deletes the directory, clones the upstream and
-    tries to check out the commit again.
-
-    If the repository directory does not exist, clones the origin and then tries
-    to check out the commit.
-
-    The repository directory will be located in REPO_DIR.
-
-    Args:
-        sha: Commit SHA to check out.
-    Returns:
-        Whether operation succeeded.
-    """
-    if REPO_DIR.is_dir():
-        result = subprocess.run(
-            ('git', 'rev-parse', '--verify', '-q', sha + '^{commit}'),
-            stdout=subprocess.DEVNULL,
-            stdin=subprocess.DEVNULL,
-            check=False,
-            cwd=REPO_DIR)
-        # yapf: disable
-        if ((result.returncode == 0 or
-             runner(('git', 'remote', 'update', '-p'), cwd=REPO_DIR) == 0) and
-            runner(('git', 'checkout', '-f', sha), cwd=REPO_DIR) == 0):
-            return True
-        # yapf: enable
-        rmdirs(REPO_DIR)
-
-    return (runner(('git', 'clone', REPO_URL), cwd=REPO_DIR.parent) == 0 and
-            runner(('git', 'checkout', '-f', sha), cwd=REPO_DIR) == 0)
-
-
 def get_ip() -> tuple[int, str]:
     """Returns private IPv4 address of the current host as an integer.
 
@@ -326,7 +587,8 @@ class PausedFuzzers:
     idling (which is most of the time).
 
     This object is used as a context manager.  On entry the fuzzer is paused; on
-    exit it’s resumed.
+    exit it’s resumed.  The context may be entered from multiple threads at
+    once; the fuzzer is resumed only once all of them exit.
 
     If the fuzzer is not detected on the machine, this is a no-op.  Detection of
     running fuzzer is by checking whether nayduck-fuzzer systemd service is
@@ -335,6 +597,9 @@ class PausedFuzzers:
 
     SERVICE = 'nayduck-fuzzer.service'
 
+    _lock = threading.Lock()
+    _depth = 0
+
     @classmethod
     def _perform_action(cls, action: str) -> None:
         """Perform an action (pause or resume) without risking an exception."""
@@ -356,8 +621,14 @@ class PausedFuzzers:
         print(f'Failed to {action} fuzzers: {last_exception}', file=sys.stderr)
 
     def __enter__(self) -> None:
-        self._perform_action('pause')
+        with self._lock:
+            if not PausedFuzzers._depth:
+                self._perform_action('pause')
+            PausedFuzzers._depth += 1
 
     def __exit__(self, exc_type: type[BaseException], exc_value: BaseException,
                  exc_tb: types.TracebackType) -> None:
-        self._perform_action('resume')
+        with self._lock:
+            PausedFuzzers._depth -= 1
+            if not PausedFuzzers._depth:
+                self._perform_action('resume')
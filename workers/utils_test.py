@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+import pathlib
+import sys
+import time
+
+from . import utils
+
+
+def test_output_scanner():
+    scanner = utils.OutputScanner(buffer_size=16)
+    for chunk in (b'\nrunning 0 tests\n', b'...\n', b'STACK BACK', b'trace:\n',
+                  b'test result: 1 ignored\n\n'):
+        scanner.feed(chunk)
+    assert scanner.size == 62
+    assert scanner.has_backtrace
+    assert scanner.first_line() == b'running 0 tests'
+    assert scanner.last_line() == b'ult: 1 ignored'
+    assert scanner.contents() is None
+
+
+def test_output_scanner_contents():
+    data = b'0123456789' * 3
+    for size in range(len(data) + 1):
+        scanner = utils.OutputScanner(buffer_size=16)
+        for pos in range(0, size, 7):
+            scanner.feed(data[pos:min(pos + 7, size)])
+        assert not scanner.has_backtrace
+        assert scanner.contents() == data[:size]
+
+
+def test_runner_on_exit(tmp_path: pathlib.Path):
+    usages = []
+    with utils.Runner(tmp_path) as runner:
+        runner.on_exit = usages.append
+        cmd = (sys.executable, '-c',
+               'import sys; data = bytearray(64 << 20); sys.exit(3)')
+        assert runner(cmd, cwd=tmp_path) == 3
+    assert len(usages) == 1
+    assert usages[0].ru_maxrss * 1024 >= 64 << 20
+
+
+def test_runner_background_output(tmp_path: pathlib.Path, monkeypatch):
+    monkeypatch.setattr(utils, '_PIPE_GRACE_PERIOD', 0.1)
+    with utils.Runner(tmp_path) as runner:
+        # The background process keeps the pipes open past the grace period.
+        cmd = ('sh', '-c', '(sleep 0.5; echo late; sleep 3) & echo early')
+        assert runner(cmd, cwd=tmp_path) == 0
+        time.sleep(1)
+        assert runner(('echo', 'next'), cwd=tmp_path) == 0
+    assert (tmp_path / 'stdout').read_bytes() == b'early\nlate\nnext\n'
+    assert b'was cut off' in (tmp_path / 'stderr').read_bytes()
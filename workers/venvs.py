@@ -0,0 +1,135 @@
+import hashlib
+import os
+import pathlib
+import sys
+import threading
+import time
+
+import prometheus_client
+
+from . import utils
+
+VENVS_DIR = utils.WORKDIR / 'venvs'
+
+# Marker file created in a virtual environment once all packages have been
+# installed into it.  Directories without it are leftovers of an interrupted
+# setup.
+_COMPLETE = '.nayduck-complete'
+
+VENV_REQUESTS = prometheus_client.Counter(
+    'nayduck_worker_venv_requests',
+    'Number of times a Python test needed a virtual environment by whether '
+    'one with matching requirements already existed', ['result'])
+VENV_SETUP_TIME = prometheus_client.Histogram(
+    'nayduck_worker_venv_setup_seconds',
+    'Time spent creating virtual environments for Python tests',
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600))
+
+
+class VenvCache:
+    """A cache of Python virtual environments keyed by requirements hash.
+
+    Each environment lives in a directory named after SHA-256 of the
+    `pytest/requirements.txt` file its packages were installed from.  Tests
+    whose requirements match an existing environment reuse it without running
+    pip at all.  Least recently used environments are removed once there are
+    more than `capacity` of them.
+
+    Environments are created without holding the cache-wide lock so that
+    a slow pip install doesn’t hold up tests which use other environments.
+    Creation of a single environment is serialised with a per-environment lock
+    so tests with the same requirements wait for it rather than duplicate it.
+    """
+
+    def __init__(self, capacity: int, root: pathlib.Path = VENVS_DIR) -> None:
+        self.__root = root
+        self.__capacity = max(1, capacity)
+        self.__lock = threading.Lock()
+        self.__in_use: dict[pathlib.Path, int] = {}
+        self.__venv_locks: dict[pathlib.Path, threading.Lock] = {}
+        utils.mkdirs(root)
+        for path in root.iterdir():
+            if not (path / _COMPLETE).exists():
+                utils.rmdirs(path)
+
+    def get(self, requirements: pathlib.Path,
+            runner: utils.Runner) -> pathlib.Path:
+        """Returns a virtual environment with given requirements installed.
+
+        Creates the environment if necessary.  The environment must be released
+        with release() once the test finishes so that it isn’t evicted while in
+        use.
+
+        Args:
+            requirements: Path to the requirements file.
+            runner: Runner to execute pip commands with.
+        Returns:
+            Path to the virtual environment directory.
+        Raises:
+            OSError: if reading requirements file or creating environment fails.
+            subprocess.SubprocessError: if creating the environment fails.
+        """
+        digest = hashlib.sha256(requirements.read_bytes()).hexdigest()
+        venv = self.__root / digest
+        with self.__lock:
+            # Mark the environment as used before creating it so that it isn’t
+            # evicted while it’s being created.
+            self.__in_use[venv] = self.__in_use.get(venv, 0) + 1
+            venv_lock = self.__venv_locks.setdefault(venv, threading.Lock())
+        try:
+            with venv_lock:
+                if (venv / _COMPLETE).exists():
+                    VENV_REQUESTS.labels('hit').inc()
+                else:
+                    VENV_REQUESTS.labels('miss').inc()
+                    with self.__lock:
+                        self.__evict()
+                    start = time.monotonic()
+                    self.__create(venv, requirements, runner)
+                    VENV_SETUP_TIME.observe(time.monotonic() - start)
+                os.utime(venv / _COMPLETE)
+        except BaseException:
+            self.release(venv)
+            raise
+        return venv
+
+    def release(self, venv: pathlib.Path) -> None:
+        """Marks environment returned by get() as no longer used."""
+        with self.__lock:
+            self.__in_use[venv] -= 1
+            if not self.__in_use[venv]:
+                del self.__in_use[venv]
+                del self.__venv_locks[venv]
+
+    @staticmethod
+    def __create(venv: pathlib.Path, requirements: pathlib.Path,
+                 runner: utils.Runner) -> None:
+        """Creates a virtual environment and installs requirements into it."""
+        utils.rmdirs(venv)
+        try:
+            runner((sys.executable, '-m', 'venv', venv),
+                   cwd=requirements.parent,
+                   check=True)
+            runner((venv / 'bin/python', '-m', 'pip', 'install', '-q',
+                    '--disable-pip-version-check', '--no-warn-script-location',
+                    '-r', requirements.name),
+                   cwd=requirements.parent,
+                   check=True)
+            (venv / _COMPLETE).touch()
+        except BaseException:
+            utils.rmdirs(venv)
+            raise
+
+    def __evict(self) -> None:
+        """Removes least recently used environments which aren’t in use.
+
+        Environments in use include the one about to be created so it’s
+        accounted for.  Must be called with the lock held.
+        """
+        entries = sorted(((path / _COMPLETE).stat().st_mtime, path)
+                         for path in self.__root.iterdir()
+                         if path not in self.__in_use)
+        excess = len(entries) + len(self.__in_use) - self.__capacity
+        for _, path in entries[:max(0, excess)]:
+            print(f'Evicting virtual environment {path.name}', file=sys.stderr)
+            utils.rmdirs(path)
@@ -0,0 +1,75 @@
+import pathlib
+import threading
+import typing
+
+from . import utils
+from . import venvs
+
+
+class _PipRunner:
+    """Runner which fakes creating virtual environments.
+
+    Installing requirements from directory given as `slow_dir` blocks until
+    `release` is set.
+    """
+
+    def __init__(self, slow_dir: pathlib.Path) -> None:
+        self.slow_dir = slow_dir
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.created: list[str] = []
+
+    def __call__(self, cmd: typing.Sequence[typing.Any], *, cwd: pathlib.Path,
+                 **_kw: typing.Any) -> int:
+        if cmd[1:3] == ('-m', 'venv'):
+            pathlib.Path(cmd[3]).mkdir()
+            self.created.append(pathlib.Path(cmd[3]).name)
+        elif cwd == self.slow_dir:
+            self.started.set()
+            assert self.release.wait(10)
+        return 0
+
+
+def _requirements(tmp_path: pathlib.Path, name: str) -> pathlib.Path:
+    path = tmp_path / name / 'requirements.txt'
+    path.parent.mkdir()
+    path.write_text(f'{name}\n')
+    return path
+
+
+def test_creation_doesnt_block(tmp_path: pathlib.Path):
+    fast = _requirements(tmp_path, 'fast')
+    slow = _requirements(tmp_path, 'slow')
+    runner = _PipRunner(slow.parent)
+    cache = venvs.VenvCache(2, root=tmp_path / 'venvs')
+    fast_venv = cache.get(fast, typing.cast(utils.Runner, runner))
+    cache.release(fast_venv)
+
+    results: dict[str, list[pathlib.Path]] = {'fast': [], 'slow': []}
+
+    def get(name: str, requirements: pathlib.Path) -> None:
+        results[name].append(
+            cache.get(requirements, typing.cast(utils.Runner, runner)))
+
+    slow_threads = [
+        threading.Thread(target=get, args=('slow', slow)) for _ in range(2)
+    ]
+    for thread in slow_threads:
+        thread.start()
+    fast_thread = threading.Thread(target=get, args=('fast', fast))
+    try:
+        assert runner.started.wait(10)
+        # An existing environment is handed out while another one is being
+        # created.
+        fast_thread.start()
+        fast_thread.join(10)
+        assert results['fast'] == [fast_venv]
+        assert all(thread.is_alive() for thread in slow_threads)
+    finally:
+        runner.release.set()
+        for thread in slow_threads + [fast_thread]:
+            thread.join()
+    # Tests with the same requirements share a single environment.
+    assert len(set(results['slow'])) == 1
+    assert len(runner.created) == 2
+    assert (results['slow'][0] / '.nayduck-complete').exists()
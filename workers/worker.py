@@ -1,26 +1,76 @@
+# pylint: disable=too-many-lines
+import argparse
+import collections
 import concurrent.futures
-import contextlib
+import dataclasses
+import functools
 import json
 import os
 import pathlib
-import random
 import signal
 import socket
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import traceback
 import typing
 
+import prometheus_client
 from sqlalchemy import exc
 
-from lib import testspec
+from lib import common_db, testspec
 
-from . import blobs, utils, worker_db
+from . import artifact_server
+from . import artifacts
+from . import blobs
+from . import live_logs
+from . import log_queue
+from . import utils
+from . import venvs
+from . import worker_db
+from . import worktrees
 
 DEFAULT_TIMEOUT = 180
 
+# How often to look for pending tests when idle.  Normally workers are woken up
+# as soon as new tests are scheduled so this is only a fallback in case
+# a notification is lost.
+IDLE_POLL_INTERVAL = 60
+
+# How often to renew leases of tests owned by the worker.  Must be well below
+# worker_db.LEASE_DURATION.
+HEARTBEAT_INTERVAL = 10
+
+METRICS_PORT = 5508
+
+# Directory with home directories of slots other than the first one.  See Slot.
+SLOTS_DIR = utils.WORKDIR / 'slots'
+
+# Range of network ports tests in each slot may use.  Tests get the range in
+# NAYDUCK_PORT_BASE and NAYDUCK_PORT_COUNT environment variables.  Nothing in
+# nearcore reads them yet so this is advisory; see
+# worker_db.FIXED_PORT_CATEGORIES.
+PORT_RANGE_START = 20000
+PORTS_PER_SLOT = 1000
+
+TEST_SETUP_TIME = prometheus_client.Histogram(
+    'nayduck_worker_test_setup_seconds',
+    'Time from claiming a test until it starts running; includes checking out '
+    'the code, preparing build artifacts and Python environment',
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600))
+TEST_RUN_TIME = prometheus_client.Histogram(
+    'nayduck_worker_test_run_seconds',
+    'Time spent running tests excluding the setup',
+    buckets=(10, 30, 60, 180, 600, 1800, 3600, 7200, 14400))
+IDLE_GAP_TIME = prometheus_client.Histogram(
+    'nayduck_worker_idle_gap_seconds',
+    'Time between a test finishing and the next test starting to run in the '
+    'same slot while there were tests to run; includes claiming and setting '
+    'up the next test',
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+
 _Cmd = typing.Sequence[typing.Union[str, pathlib.Path]]
 _EnvB = typing.MutableMapping[bytes, bytes]
 
@@ -28,41 +78,158 @@ _EnvB = typing.MutableMapping[bytes, bytes]
 class GracefulWorkerKiller:
     worker_running = True
 
-    def __init__(self, server):
+    def __init__(self, server: worker_db.WorkerDB) -> None:
         self.server = server
-        self.test_id = None
+        self.test_ids: set[int] = set()
         signal.signal(signal.SIGINT, self.exit_gracefully)
         signal.signal(signal.SIGTERM, self.exit_gracefully)
 
-    def exit_gracefully(self, *args):
+    def exit_gracefully(self, *_: typing.Any) -> None:
+        test_ids = sorted(self.test_ids)
         print("Exiting gracefully." +
-              f"test_id is {self.test_id}" if self.test_id else "")
-        if self.test_id:
-            self.server.handle_shutdown(self.test_id)
+              f"test_ids are {test_ids}" if test_ids else "")
+        for test_id in test_ids:
+            self.server.handle_shutdown(test_id)
 
         self.worker_running = False
 
 
-def get_test_command(test: testspec.TestSpec) -> tuple[pathlib.Path, _Cmd]:
-    """Returns working directory and command to execute for given test.
+@dataclasses.dataclass(frozen=True)
+class Slot:
+    """A place on the worker host where a single test runs.
+
+    Tests running in different slots at the same time mustn’t step on each
+    other’s toes so each slot has its own home directory (tests keep node data
+    in `~/.near`) and an advisory range of network ports (see slots_needed).
+    Each test also gets a worktree for its use from worktrees.WorktreeCache.
+
+    Attributes:
+        index: Index of the slot starting from zero.
+        home_dir: Home directory of test processes.
+        port_base: First port of the range reserved for tests in the slot.
+    """
+    index: int
+    home_dir: pathlib.Path
+    port_base: int
+
+    @classmethod
+    def create(cls, index: int) -> 'Slot':
+        """Creates a slot with given index.
+
+        The first slot uses user’s home directory so that a worker running
+        a single slot behaves the same way it always has.
+        """
+        port_base = PORT_RANGE_START + index * PORTS_PER_SLOT
+        if not index:
+            return cls(index, pathlib.Path.home(), port_base)
+        home_dir = SLOTS_DIR / str(index) / 'home'
+        utils.mkdirs(home_dir)
+        return cls(index, home_dir, port_base)
+
+    def test_environ(self, tmpdir: pathlib.Path) -> _EnvB:
+        """Returns environment variables to run a test in the slot with.
+
+        Args:
+            tmpdir: Temporary directory to use for the test.
+        """
+        envb = dict(os.environb)
+        for var in (b'TMPDIR', b'TEMP', b'TMP'):
+            envb[var] = os.fsencode(tmpdir)
+        envb[b'HOME'] = os.fsencode(self.home_dir)
+        envb[b'NAYDUCK_PORT_BASE'] = str(self.port_base).encode('ascii')
+        envb[b'NAYDUCK_PORT_COUNT'] = str(PORTS_PER_SLOT).encode('ascii')
+        return envb
+
+
+class Caches(typing.NamedTuple):
+    """Local caches shared by all of worker’s slots."""
+    builds: artifacts.BuildCache
+    worktrees: worktrees.WorktreeCache
+    venvs: venvs.VenvCache
+
+
+class Capacity:
+    """Tracks how many of the worker’s slots are occupied.
+
+    A test may need more than one slot (see testspec.TestSpec.slots).  Such
+    tests are only claimed when enough slots are free; see
+    _SlotRunner.__step.  Requests are served in order so that slots take turns
+    claiming tests.
+    """
+
+    def __init__(self, total: int) -> None:
+        self.total = total
+        self.__free = total
+        self.__cond = threading.Condition()
+        self.__queue: collections.deque[object] = collections.deque()
+
+    def acquire_free(self) -> int:
+        """Waits until at least one slot is free and occupies all free slots.
+
+        This lets a slot claim a test knowing how many slots it can have (see
+        WorkerDB.get_pending_tests).  Slots the test doesn’t need should be
+        given back with release() as soon as the test is claimed.
+
+        Returns:
+            Number of slots occupied which must be later passed to release().
+        """
+        ticket = object()
+        with self.__cond:
+            self.__queue.append(ticket)
+            self.__cond.wait_for(
+                lambda: self.__queue[0] is ticket and self.__free > 0)
+            self.__queue.popleft()
+            count, self.__free = self.__free, 0
+            self.__cond.notify_all()
+        return count
+
+    def release(self, count: int) -> None:
+        """Frees slots previously occupied with acquire_free()."""
+        with self.__cond:
+            self.__free += count
+            self.__cond.notify_all()
+
+
+def slots_needed(test: testspec.TestSpec, total: int) -> int:
+    """Returns number of slots a test occupies while it runs.
+
+    Args:
+        test: The test.
+        total: Total number of worker’s slots.
+    Returns:
+        Number of slots the test asked for or, if the test listens on fixed
+        ports (see worker_db.FIXED_PORT_CATEGORIES), all slots.  Must agree
+        with the number get_pending_tests filters tests by.
+    """
+    if test.category in worker_db.FIXED_PORT_CATEGORIES:
+        return total
+    return min(test.slots, total)
+
 
-    Assumes that the repository from which the test should be run is located in
-    utils.REPO_DIR directory.
+def get_test_command(
+    test: testspec.TestSpec,
+    repo_dir: pathlib.Path,
+    *,
+    python: typing.Union[str, pathlib.Path] = sys.executable
+) -> tuple[pathlib.Path, _Cmd]:
+    """Returns working directory and command to execute for given test.
 
     Args:
         test: Test to return the command for.
+        repo_dir: Repository from which the test should be run.
+        python: Python interpreter to run pytest and mocknet tests with.
     Returns:
         A (cwd, cmd) tuple where first element is working directory in which to
         execute the command given by the second element.
     """
     if test.category in ('pytest', 'mocknet'):
-        cwd = utils.REPO_DIR / 'pytest'
-        cmd = [sys.executable, 'tests/' + test.args[0]]
+        cwd = repo_dir / 'pytest'
+        cmd = [python, 'tests/' + test.args[0]]
         cmd.extend(test.args[1:])
     elif test.category == 'expensive':
-        cwd = utils.REPO_DIR
+        cwd = repo_dir
         prefix = test.args[1] + '-'
-        for name in os.listdir(utils.REPO_DIR / 'target/expensive'):
+        for name in os.listdir(repo_dir / 'target/expensive'):
             if name.startswith(prefix):
                 name = f'target/expensive/{name}'
                 cmd = [name, test.args[2], '--exact', '--nocapture']
@@ -71,42 +238,14 @@ def get_test_command(test: testspec.TestSpec) -> tuple[pathlib.Path, _Cmd]:
     return cwd, cmd
 
 
-_LAST_PIP_REQUIREMENTS: typing.Optional[bytes] = None
-
-
-def install_new_packages(runner: utils.Runner) -> None:
-    """Makes sure all Python requirements for the pytests are satisfied.
-
-    Args:
-        runner: Runner whose standard output and error files output of the
-            command will be redirected into.
-    """
-    global _LAST_PIP_REQUIREMENTS
-
-    data = (utils.REPO_DIR / 'pytest' / 'requirements.txt').read_bytes()
-    if _LAST_PIP_REQUIREMENTS != data:
-        runner((sys.executable, '-m', 'pip', 'install', '--user', '-q',
-                '--disable-pip-version-check', '--no-warn-script-location',
-                '-r', 'requirements.txt'),
-               cwd=utils.REPO_DIR / 'pytest',
-               check=True)
-        _LAST_PIP_REQUIREMENTS = data
-
-
-def find_backtrace_line(rd: typing.BinaryIO) -> bool:
-    """Returns whether the stream contains a `stack backtrace:` pattern."""
-    return any('stack backtrace:' in line.decode('utf-8', 'replace').lower()
-               for line in rd)
-
-
 def analyse_test_outcome(test: testspec.TestSpec, ret: int,
-                         stdout: typing.BinaryIO) -> str:
+                         stdout: utils.OutputScanner) -> str:
     """Returns test's outcome based on exit code and test's output.
 
     Args:
         test: The test whose result is being analysed.
         ret: Test process exit code.
-        stdout: Test's standard output opened as binary file.
+        stdout: Scanner which has been fed test's standard output.
     Returns:
         Tests outcome as one of: 'PASSED', 'FAILED' or 'IGNORED'.
     """
@@ -115,23 +254,13 @@ def analyse_test_outcome(test: testspec.TestSpec, ret: int,
     if test.category != 'expensive':
         return 'PASSED'
 
-    last_line = b''
-    for line in stdout:
-        line = line.strip()
-        if line.decode('utf-8', 'replace') == 'running 0 tests':
-            # If user specified incorrect test name the test executable will
-            # run no tests since the filter we provide won't match anything.
-            # Report that as a failure rather than ignored test.
-            return 'FAILED'
-        if line:
-            last_line = line
-            break
-
-    for line in stdout:
-        line = line.strip()
-        if line:
-            last_line = line
+    if stdout.first_line() == b'running 0 tests':
+        # If user specified incorrect test name the test executable will
+        # run no tests since the filter we provide won't match anything.
+        # Report that as a failure rather than ignored test.
+        return 'FAILED'
 
+    last_line = stdout.last_line()
     if b'1 ignored' in last_line:
         return 'IGNORED'
     if b'1 failed' in last_line:
@@ -139,51 +268,58 @@ def analyse_test_outcome(test: testspec.TestSpec, ret: int,
     return 'PASSED'
 
 
-def execute_test_command(test: testspec.TestSpec, envb: _EnvB, timeout: int,
-                         runner: utils.Runner) -> str:
+def execute_test_command(
+        test: testspec.TestSpec,
+        repo_dir: pathlib.Path,
+        envb: _EnvB,
+        timeout: int,
+        runner: utils.Runner,
+        *,
+        python: typing.Union[str, pathlib.Path] = sys.executable) -> str:
     """Executes a test command and returns test's outcome.
 
     Args:
         test: The test to execute.  Test command is constructed based on that
             list by calling get_test_command()
+        repo_dir: Repository from which the test should be run.
         envb: Environment variables to pass to the process.
         timeout: Time in seconds to allow the test to run.  After that time
             passes, the test process will be killed and function will return
             'TIMEOUT' outcome.
         runner: Runner whose standard output and error files output of the
             command will be redirected into.
+        python: Python interpreter to run pytest and mocknet tests with.
     Returns:
         Tests outcome as one of: 'PASSED', 'FAILED', 'IGNORED' or 'TIMEOUT'.
     """
     print(f'[RUNNING] {test}', file=sys.stderr)
-    stdout_start = runner.stdout.tell()
-    stderr_start = runner.stderr.tell()
     envb[b'RUST_BACKTRACE'] = b'1'
     envb[b'NAYDUCK_TIMEOUT'] = str(timeout).encode('ascii')
     try:
-        cwd, cmd = get_test_command(test)
+        cwd, cmd = get_test_command(test, repo_dir, python=python)
         with utils.PausedFuzzers():
             ret = runner(cmd, cwd=cwd, timeout=timeout, env=envb)
     except subprocess.TimeoutExpired:
         return 'TIMEOUT'
-    try:
-        runner.stdout.seek(stdout_start)
-        runner.stderr.seek(stderr_start)
-        return analyse_test_outcome(test, ret, runner.stdout)
-    finally:
-        runner.stdout.seek(0, 2)
-        runner.stderr.seek(0, 2)
+    return analyse_test_outcome(test, ret, runner.last_stdout)
 
 
 def run_test(outdir: pathlib.Path, test: testspec.TestSpec, envb: _EnvB,
-             runner: utils.Runner) -> str:
+             runner: utils.Runner, *, slot: Slot, repo_dir: pathlib.Path,
+             venv: typing.Optional[pathlib.Path]) -> str:
     outcome = 'FAILED'
+    python = venv / 'bin/python' if venv else sys.executable
     try:
-        dot_near = pathlib.Path.home() / '.near'
+        dot_near = slot.home_dir / '.near'
         utils.rmdirs(dot_near)
         utils.mkdirs(dot_near)
 
-        outcome = execute_test_command(test, envb, test.full_timeout, runner)
+        outcome = execute_test_command(test,
+                                       repo_dir,
+                                       envb,
+                                       test.full_timeout,
+                                       runner,
+                                       python=python)
         print(f'[{outcome:<7}] {test}', file=sys.stderr)
 
         dirs = [
@@ -200,10 +336,7 @@ def run_test(outdir: pathlib.Path, test: testspec.TestSpec, envb: _EnvB,
 class LogFile:
     name: str
     path: pathlib.Path
-    stack_trace: bool = False
     size: int
-    data: typing.Optional[bytes] = None
-    url: typing.Optional[str] = None
     binary: bool
 
     def __init__(self,
@@ -264,15 +397,8 @@ def generate_nodes_state(outfile: pathlib.Path) -> bool:
     return create_tar_archive(outfile=outfile, entries=entries, cwd=directory)
 
 
-def list_logs(directory: pathlib.Path,
-              *,
-              save_state: bool = False) -> typing.Iterable[LogFile]:
-    """Yields all log files to be saved."""
-    if save_state:
-        outfile = directory / 'nodes-state.tar.xz'
-        if generate_nodes_state(outfile):
-            yield LogFile(outfile.name, outfile, binary=True)
-
+def list_logs(directory: pathlib.Path) -> typing.Iterable[LogFile]:
+    """Yields all log files to be saved other than archive of nodes’ state."""
     for entry in os.listdir(directory):
         entry_path = directory / entry
         if entry_path.is_dir():
@@ -287,18 +413,20 @@ def list_logs(directory: pathlib.Path,
 _MAX_SHORT_LOG_SIZE = 10 * 1024
 
 
-def read_short_log(  # pylint: disable=too-many-branches
-        size: int, rd: typing.BinaryIO, is_binary: bool) -> tuple[bytes, bool]:
-    """Reads a short log from given file.
+def make_short_log(  # pylint: disable=too-many-branches
+        size: int, output: utils.OutputScanner,
+        is_binary: bool) -> tuple[bytes, bool]:
+    """Returns a short log of given file.
 
     A short log it at most _MAX_SHORT_LOG_SIZE bytes long.  If the file is
-    longer than that, the function reads half of the maximum length from the
+    longer than that, the function takes half of the maximum length from the
     beginning and half from the of the file and returns those two fragments
-    concatenated with an three dots in between.
+    concatenated with an three dots in between.  Both fragments come from
+    buffers of the scanner so the file isn’t read again.
 
     Args:
         size: Actual size of the file.
-        rd: The file opened for reading.
+        output: Scanner which has been fed contents of the file.
         is_binary: Whether the file is a binary file.  If true, the function
             won’t try to do a partial read and use slightly lower limit for the
             maximum short log length.
@@ -313,15 +441,14 @@ def read_short_log(  # pylint: disable=too-many-branches
         # limit for the size we’re willing to store in the database.
         limit //= 2
     if size <= limit:
-        data = rd.read(limit + 1)
-        if len(data) <= limit:  # Sanity check
-            return data, True
-        rd.seek(0)
+        contents = output.contents()
+        if contents is not None and len(contents) <= limit:  # Sanity check
+            return contents, True
 
     if is_binary:
         return b'', False
 
-    data = rd.read(_MAX_SHORT_LOG_SIZE // 2 - 3)
+    data = bytes(output.head[:_MAX_SHORT_LOG_SIZE // 2 - 3])
     if data:
         pos = len(data)
         limit = max(pos - 6, 1)
@@ -333,8 +460,7 @@ def read_short_log(  # pylint: disable=too-many-branches
                 data[pos - 1:].decode('utf-8', 'ignore') == ''):
             data = data[:pos - 1]
 
-    rd.seek(-_MAX_SHORT_LOG_SIZE // 2 + 2, 2)
-    ending = rd.read()
+    ending = bytes(output.tail[-_MAX_SHORT_LOG_SIZE // 2 + 2:])
     if ending:
         limit = min(len(ending), 8)
         pos = 0
@@ -367,119 +493,155 @@ def read_short_log(  # pylint: disable=too-many-branches
     return b''.join(parts), False
 
 
-def save_logs(server: worker_db.WorkerDB, test_id: int, directory: pathlib.Path,
-              *, save_state: bool) -> None:
-    logs = list(list_logs(directory, save_state=save_state))
-    if not logs:
-        return
-
-    blob_client = blobs.get_client()
+def process_log(
+        blob_client: blobs.BlobClient,
+        test_id: int,
+        log: LogFile,
+        output: typing.Optional[utils.OutputScanner] = None) -> worker_db.Log:
+    """Makes short log of a log file and uploads the file if it’s long.
 
-    def process_log(log: LogFile) -> LogFile:
+    Args:
+        blob_client: Client to upload the file with.
+        test_id: Id of the test the log belongs to.
+        log: The log file.
+        output: Scanner which has been fed contents of the file, if any.
+            Otherwise, the file is scanned here.
+    Returns:
+        The log to save in the database.
+    """
+    if output is None or output.size != log.size:
+        # There’s no point scanning whole binary file since only short binary
+        # files are saved in the database.
+        output = utils.OutputScanner.from_file(
+            log.path, _MAX_SHORT_LOG_SIZE if log.binary else None)
+    data, is_full = make_short_log(log.size, output, log.binary)
+    url = ''
+    if not is_full:
         with open(log.path, 'rb') as rd:
-            if not log.binary:
-                log.stack_trace = find_backtrace_line(rd)
-                rd.seek(0)
-            log.data, is_full = read_short_log(log.size, rd, log.binary)
-            if not is_full:
-                rd.seek(0)
-                log.url = blob_client.upload_test_log(test_id, log.name, rd)
-            elif log.size:
-                log.url = blob_client.get_test_log_href(test_id, log.name)
-
-        return log
+            url = blob_client.upload_test_log(test_id, log.name, rd) or ''
+    elif log.size:
+        url = blob_client.get_test_log_href(test_id, log.name)
+    return worker_db.Log(name=log.name,
+                         size=log.size,
+                         data=data,
+                         url=url,
+                         stack_trace=output.has_backtrace and not log.binary)
+
+
+def _process_nodes_state(
+        blob_client: blobs.BlobClient, test_id: int,
+        directory: pathlib.Path) -> typing.Optional[worker_db.Log]:
+    """Archives and uploads nodes’ state; see process_log."""
+    outfile = directory / 'nodes-state.tar.xz'
+    # The archive is already there if saving the logs has been interrupted.
+    if not outfile.exists() and not generate_nodes_state(outfile):
+        return None
+    return process_log(blob_client, test_id,
+                       LogFile(outfile.name, outfile, binary=True))
+
+
+def save_logs(server: worker_db.WorkerDB, blob_client: blobs.BlobClient,
+              entry: log_queue.Entry) -> None:
+    """Saves logs of a finished test from the log queue.
+
+    Log files are processed in parallel and each is saved in the database as
+    soon as it’s ready, i.e. short logs right away and long ones once they are
+    uploaded to storage.  Test’s live logs are deleted once all of its logs are
+    saved.  Saving the same entry again is harmless.
 
+    Args:
+        server: Database to save the logs in.
+        blob_client: Client to upload long logs with.
+        entry: Log queue entry with test’s output directory.
+    """
     max_workers = len(os.sched_getaffinity(0))
     with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
-        executor.map(process_log, logs)
-
-    server.save_short_logs(test_id, logs)
-
-
-_LAST_COPIED_BUILD_ID: typing.Optional[int] = None
-_COPIED_EXPENSIVE_DEPS: list[str] = []
-
-
-def scp_build(build_id: int, builder_ip: int, test: testspec.TestSpec,
-              runner: utils.Runner) -> None:
-    if test.skip_build:
-        return
-
-    builder_addr = utils.int_to_ip(builder_ip)
-
-    def scp(src: str, dst: str) -> None:
-        src = f'{builder_addr}:{utils.BUILDS_DIR}/{build_id}/{src}'
-        path = utils.REPO_DIR / dst
-        if not path.is_dir():
-            runner.log_command(('mkdir', '-p', '--', dst), cwd=utils.REPO_DIR)
-            utils.mkdirs(path)
-        delay = 1 + random.random()
-        for retry in range(3):
-            if runner(('scp', '-oStrictHostKeyChecking=no',
-                       '-oControlMaster=auto', '-oControlPath=/dev/shm/.ssh.%C',
-                       '-oControlPersist=2', '-oBatchMode=yes', src, dst),
-                      print_cmd=('scp', src, dst),
-                      cwd=utils.REPO_DIR,
-                      check=retry == 2) == 0:
-                break
-            time.sleep(delay)
-            delay *= 2
-
-    global _LAST_COPIED_BUILD_ID
-    if _LAST_COPIED_BUILD_ID != build_id:
-        _LAST_COPIED_BUILD_ID = None
-        _COPIED_EXPENSIVE_DEPS[:] = ()
-        repo_dir = utils.REPO_DIR
-        utils.rmdirs(repo_dir / 'target')
-        for path in (repo_dir / 'runtime/near-test-contracts/res').iterdir():
-            if path.suffix == '.wasm':
-                path.unlink()
-        scp('target/*', f'target/{test.build_dir}')
-        scp('near-test-contracts/*.wasm', 'runtime/near-test-contracts/res')
-        _LAST_COPIED_BUILD_ID = build_id
-
-    if test.category == 'expensive':
-        test_name = test.args[1]
-        if test_name not in _COPIED_EXPENSIVE_DEPS:
-            scp(f'expensive/{test_name}-*', 'target/expensive')
-            _COPIED_EXPENSIVE_DEPS.append(test_name)
-
-
-@contextlib.contextmanager
-def temp_dir() -> typing.Generator[pathlib.Path, None, None]:
-    """A context manager setting a new temporary directory.
-
-    Create a new temporary directory and sets it as tempfile.tempdir as well as
-    TMPDIR, TEMP and TMP environment directories.  Once the context manager
-    exits, values of all those variables are restored and the temporary
-    directory deleted.
+        futures: list[concurrent.futures.Future[typing.Optional[
+            worker_db.Log]]] = [
+                executor.submit(process_log, blob_client, entry.test_id, log,
+                                entry.scanners.get(log.name))
+                for log in list_logs(entry.outdir)
+            ]
+        if entry.save_state:
+            futures.append(
+                executor.submit(_process_nodes_state, blob_client,
+                                entry.test_id, entry.outdir))
+        for future in concurrent.futures.as_completed(futures):
+            log = future.result()
+            if log:
+                server.save_log(entry.test_id, entry.tries, log)
+    server.delete_live_logs(entry.test_id, entry.tries)
+
+
+def keep_saving_logs(logs: log_queue.LogQueue, ipv4: int,
+                     worker_host: str) -> None:
+    """Saves logs of finished tests as they are put into the log queue.
+
+    Runs forever so it’s meant to be run in a daemon thread.  Runs with the
+    lowest CPU priority (which carries over to compression and upload threads
+    and processes it starts) so as not to slow down running tests.
     """
-    old_tempdir = tempfile.tempdir
-    old_env = {
-        var: os.environb.get(var) for var in (b'TMPDIR', b'TEMP', b'TMP')
-    }
+    _lower_priority()
+    with worker_db.WorkerDB(ipv4, worker_host) as server:
+        logs.drain(functools.partial(save_logs, server, blobs.get_client()))
+
+
+def handle_test(
+        server: worker_db.WorkerDB,
+        live_server: worker_db.WorkerDB,
+        caches: Caches,
+        slot: Slot,
+        test: worker_db.Test,
+        *,
+        logs: log_queue.LogQueue,
+        on_start: typing.Optional[typing.Callable[[], None]] = None) -> None:
+    """Sets up, runs and saves results of a single test.
+
+    Test’s status is saved right away while its logs are put into the log
+    queue to be saved in the background.
+
+    Args:
+        server: Database to report test’s status to.
+        live_server: Database connection to stream test’s output through.
+        caches: Caches of worktrees, artifacts and virtual environments.
+        slot: Slot to run the test in.
+        test: The test to run.
+        logs: Queue to put test’s logs into.
+        on_start: If given, called once the test has been set up, right before
+            it starts running.  It isn’t called if setup fails.
+    """
+    print(f'[slot {slot.index}] {test}', file=sys.stderr)
+    setup_start = time.monotonic()
     with tempfile.TemporaryDirectory() as tmpdir:
-        tempfile.tempdir = tmpdir
-        for var in old_env:
-            os.environb[var] = os.fsencode(tmpdir)
-        try:
-            yield pathlib.Path(tmpdir)
-        finally:
-            tempfile.tempdir = old_tempdir
-            for var, old_value in old_env.items():
-                if old_value is None:
-                    os.environb.pop(var, None)
-                else:
-                    os.environb[var] = old_value
-
-
-def handle_test(server: worker_db.WorkerDB, test: worker_db.Test) -> None:
-    print(test, file=sys.stderr)
-    with temp_dir() as tmpdir:
-        outdir = tmpdir / 'output'
+        outdir = pathlib.Path(tmpdir) / 'output'
         utils.mkdirs(outdir)
-        with utils.Runner(outdir) as runner:
-            __handle_test(server, outdir, runner, test)
+        with utils.Runner(outdir) as runner, \
+                live_logs.LiveLog(live_server, test.test_id) as live:
+            runner.on_output = live.feed
+            with caches.worktrees.checkout(test.sha, runner) as repo_dir:
+                if repo_dir is None:
+                    live.close()
+                    server.update_test_status(test.test_id, 'CHECKOUT FAILED')
+                    return
+                status = __handle_test(server,
+                                       caches,
+                                       slot,
+                                       pathlib.Path(tmpdir),
+                                       repo_dir=repo_dir,
+                                       runner=runner,
+                                       live=live,
+                                       test_row=test,
+                                       setup_start=setup_start,
+                                       on_start=on_start)
+        # Runner’s output files are complete only once it’s closed.
+        logs.put(outdir,
+                 test_id=test.test_id,
+                 tries=test.tries,
+                 save_state=status not in ('SCP FAILED', 'PASSED', 'IGNORED'),
+                 scanners={
+                     'stdout': runner.stdout_scanner,
+                     'stderr': runner.stderr_scanner,
+                 })
 
 
 def should_retry(test_row: worker_db.Test, status: str) -> bool:
@@ -495,73 +657,193 @@ def should_retry(test_row: worker_db.Test, status: str) -> bool:
     return test_row.tries < max_tries
 
 
-def __handle_test(server: worker_db.WorkerDB, outdir: pathlib.Path,
-                  runner: utils.Runner, test_row: worker_db.Test) -> None:
-    if not utils.checkout(test_row.sha, runner):
-        server.update_test_status(test_row.test_id, 'CHECKOUT FAILED')
-        return
-
-    utils.rmdirs(pathlib.Path.home() / '.rainbow',
-                 utils.REPO_DIR / 'test-utils/runtime-tester/fuzz/artifacts')
+def _override_config(test: testspec.TestSpec, envb: _EnvB,
+                     tmpdir: pathlib.Path) -> None:
+    """Writes pytest configuration override file if the test needs one.
 
+    Args:
+        test: The test to configure.
+        envb: Test’s environment variables.  NEAR_PYTEST_CONFIG is set to path
+            of the override file if one is written.
+        tmpdir: Directory to save the file in.
+    """
     config_override: dict[str, typing.Any] = {}
-    envb: _EnvB = typing.cast(_EnvB, os.environb)
-
-    test = testspec.TestSpec.from_row(typing.cast(testspec.TestDBRow, test_row))
-
     if test.is_remote:
         config_override.update(local=False, preexist=True)
     if test.is_release:
         config_override.update(release=True, near_root='../target/release/')
 
     if config_override:
-        fd, path = tempfile.mkstemp(prefix=b'config-', suffix=b'.json')
+        fd, path = tempfile.mkstemp(prefix=b'config-',
+                                    suffix=b'.json',
+                                    dir=os.fsencode(tmpdir))
         with os.fdopen(fd, 'w') as wr:
             json.dump(config_override, wr)
-        envb = dict(envb)
         envb[b'NEAR_PYTEST_CONFIG'] = path
 
+
+def _activate_venv(cache: venvs.VenvCache, repo_dir: pathlib.Path, envb: _EnvB,
+                   runner: utils.Runner) -> pathlib.Path:
+    """Gets virtual environment for a Python test and configures envb to use it.
+
+    Args:
+        cache: Cache to get the environment from.
+        repo_dir: Repository with requirements of the test.
+        envb: Test’s environment variables.  VIRTUAL_ENV and PATH are updated.
+        runner: Runner to execute pip commands with.
+    Returns:
+        Path to the virtual environment which must be released with
+        cache.release() once the test finishes.
+    """
+    venv = cache.get(repo_dir / 'pytest/requirements.txt', runner)
+    envb[b'VIRTUAL_ENV'] = os.fsencode(venv)
+    envb[b'PATH'] = os.fsencode(venv / 'bin') + b':' + envb.get(b'PATH', b'')
+    return venv
+
+
+def __handle_test(  # pylint: disable=too-many-locals
+        server: worker_db.WorkerDB, caches: Caches, slot: Slot,
+        tmpdir: pathlib.Path, *, repo_dir: pathlib.Path, runner: utils.Runner,
+        live: live_logs.LiveLog, test_row: worker_db.Test, setup_start: float,
+        on_start: typing.Optional[typing.Callable[[], None]]) -> str:
+    """Runs a test once its worktree is checked out; returns its status."""
+    outdir = tmpdir / 'output'
+    utils.rmdirs(slot.home_dir / '.rainbow',
+                 repo_dir / 'test-utils/runtime-tester/fuzz/artifacts')
+
+    envb = slot.test_environ(tmpdir)
+    test = testspec.TestSpec.from_row(typing.cast(testspec.TestDBRow, test_row))
+    _override_config(test, envb, tmpdir)
+
     status = None
     try:
-        scp_build(test_row.build_id, test_row.builder_ip, test, runner)
+        if not test.skip_build:
+            caches.builds.prepare(test_row.build_id,
+                                  test_row.builder_ip,
+                                  test,
+                                  runner,
+                                  repo_dir,
+                                  files=server.get_build_files(
+                                      test_row.build_id),
+                                  peers=server)
     except (OSError, subprocess.SubprocessError):
         runner.log_traceback()
         status = 'SCP FAILED'
 
     if status is None:
+        venv = None
         if test.category in ('pytest', 'mocknet'):
-            install_new_packages(runner)
+            venv = _activate_venv(caches.venvs, repo_dir, envb, runner)
+        TEST_SETUP_TIME.observe(time.monotonic() - setup_start)
         server.test_started(test_row.test_id)
-        status = run_test(outdir, test, envb, runner)
+        if on_start:
+            on_start()
+        run_start = time.monotonic()
+        try:
+            status = run_test(outdir,
+                              test,
+                              envb,
+                              runner,
+                              slot=slot,
+                              repo_dir=repo_dir,
+                              venv=venv)
+        finally:
+            if venv:
+                caches.venvs.release(venv)
+        TEST_RUN_TIME.observe(time.monotonic() - run_start)
 
+    # Stop streaming before the test is finished so that no live logs are
+    # written after save_logs replaces them with the full logs.
+    live.close()
     if should_retry(test_row, status):
         server.retry_test(test_row.test_id)
     else:
         server.update_test_status(test_row.test_id, status)
-    save_logs(server,
-              test_row.test_id,
-              outdir,
-              save_state=status not in ('SCP FAILED', 'PASSED', 'IGNORED'))
+    return status
 
 
-def main() -> None:
-    ipv4, ip_str = utils.get_ip()
-    worker_host = socket.gethostname()
-    print(f'Starting worker @ {worker_host} ({ip_str} / {ipv4})',
-          file=sys.stderr)
+def keep_renewing_leases(ipv4: int, worker_host: str,
+                         slots: typing.Sequence['_SlotRunner']) -> None:
+    """Renews leases of tests owned by the worker every HEARTBEAT_INTERVAL.
+
+    Runs forever so it’s meant to be run in a daemon thread.  Uses a separate
+    database connection so that leases are renewed even while slots are busy
+    running tests.  Only tests the slots are responsible for (see
+    _SlotRunner.owned_tests) are renewed so that a test a slot gave up on
+    because of an error goes back to PENDING once its lease expires.
+    """
     with worker_db.WorkerDB(ipv4, worker_host) as server:
-        server.handle_restart()
+        while True:
+            try:
+                server.renew_leases(
+                    set().union(*(slot.owned_tests() for slot in slots)))
+            except exc.SQLAlchemyError as ex:
+                print(f'Failed to renew leases: {ex}', file=sys.stderr)
+            time.sleep(HEARTBEAT_INTERVAL)
+
+
+def _lower_priority() -> None:
+    """Makes calling thread and processes it starts yield CPU to tests."""
+    # On Linux niceness is a property of a thread rather than of a process.
+    os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+
+
+class _SlotRunner:  # pylint: disable=too-many-instance-attributes
+    """Claims and runs tests in a single slot until the worker is stopped.
+
+    While a test runs, artifacts of the test the slot is likely to run next are
+    copied into the cache in the background (see BuildCache.prefetch).  That’s
+    the next test in slot’s queue of claimed tests or, if the queue is empty,
+    the test the slot would claim if it was idle (see
+    WorkerDB.peek_pending_test).  The copying runs with the lowest CPU priority
+    and over a single connection so as not to disturb the running test.
+    """
+
+    def __init__(self, slot: Slot, capacity: Capacity, caches: Caches,
+                 killer: GracefulWorkerKiller, logs: log_queue.LogQueue, *,
+                 ipv4: int, worker_host: str, batch: int) -> None:
+        self.__slot = slot
+        self.__capacity = capacity
+        self.__caches = caches
+        self.__killer = killer
+        self.__logs = logs
+        self.__ipv4 = ipv4
+        self.__worker_host = worker_host
+        self.__batch = max(1, batch)
+        self.__last_finish: typing.Optional[float] = None
+        self.__prefetcher: typing.Optional[threading.Thread] = None
+        # Tests the slot has claimed and hasn’t finished or handed back yet.
+        # Only their leases are renewed; see keep_renewing_leases.
+        self.__owned: set[int] = set()
+
+    def owned_tests(self) -> set[int]:
+        """Returns ids of tests the slot has claimed and is responsible for."""
+        return self.__owned.copy()
+
+    def __call__(self) -> None:
+        # Live logs are sent from a background thread so they need a separate
+        # connection.
+        host = self.__worker_host
+        with worker_db.WorkerDB(self.__ipv4, host) as server, \
+                worker_db.WorkerDB(self.__ipv4, host) as live_server, \
+                common_db.Listener(common_db.PENDING_TESTS_CHANNEL) as listener:
+            queue: collections.deque[worker_db.Test] = collections.deque()
+            try:
+                self.__loop(server, live_server, listener, queue)
+            finally:
+                # Give back tests we’ve claimed but haven’t got around to
+                # running.
+                for test_row in queue:
+                    server.handle_shutdown(test_row.test_id)
+                    self.__owned.discard(test_row.test_id)
+
+    def __loop(self, server: worker_db.WorkerDB,
+               live_server: worker_db.WorkerDB, listener: common_db.Listener,
+               queue: collections.deque[worker_db.Test]) -> None:
         db_retries = 5
-        worker_handler = GracefulWorkerKiller(server)
-        while worker_handler.worker_running:
+        while self.__killer.worker_running:
             try:
-                test_row = server.get_pending_test()
-                if test_row:
-                    worker_handler.test_id = test_row.test_id
-                    handle_test(server, test_row)
-                else:
-                    worker_handler.test_id = None
-                    time.sleep(10)
+                self.__step(server, live_server, listener, queue)
             except exc.SQLAlchemyError as e:
                 if db_retries <= 0:
                     raise
@@ -570,13 +852,187 @@ def main() -> None:
                     file=sys.stderr)
                 db_retries -= 1
                 time.sleep(5)
-            except KeyboardInterrupt:
-                print('Got SIGINT; terminating', file=sys.stderr)
-                break
             except Exception:
                 traceback.print_exc()
                 time.sleep(10)
 
+    def __step(self, server: worker_db.WorkerDB,
+               live_server: worker_db.WorkerDB, listener: common_db.Listener,
+               queue: collections.deque[worker_db.Test]) -> None:
+        """Claims and runs a single test or waits for tests to be scheduled.
+
+        Only tests which fit in slots free at the moment are claimed so that
+        a claimed test never waits (holding its lease) for other slots’ tests
+        to finish.
+        """
+        # Don’t claim tests if the host is busy running tests in other slots.
+        occupied = self.__capacity.acquire_free()
+        test_row = None
+        try:
+            if not queue:
+                queue.extend(
+                    server.get_pending_tests(self.__batch,
+                                             self.__caches.builds.build_ids(),
+                                             free_slots=occupied,
+                                             total_slots=self.__capacity.total))
+                self.__owned.update(row.test_id for row in queue)
+            if not queue:
+                self.__capacity.release(occupied)
+                occupied = 0
+                # Waiting for tests to be scheduled isn’t an idle gap.
+                self.__last_finish = None
+                listener.wait(IDLE_POLL_INTERVAL)
+                return
+            test_row = queue.popleft()
+            test = testspec.TestSpec.from_row(
+                typing.cast(testspec.TestDBRow, test_row))
+            needed = slots_needed(test, self.__capacity.total)
+            if needed > occupied:
+                # The test was claimed in a batch while more slots were free.
+                # Give it back rather than keep it until other slots finish.
+                server.handle_shutdown(test_row.test_id)
+                return
+            self.__capacity.release(occupied - needed)
+            occupied = needed
+            if not server.confirm_claim(test_row.test_id):
+                return
+            self.__killer.test_ids.add(test_row.test_id)
+            try:
+                handle_test(server,
+                            live_server,
+                            self.__caches,
+                            self.__slot,
+                            test_row,
+                            logs=self.__logs,
+                            on_start=functools.partial(self.__on_start, queue))
+            finally:
+                self.__killer.test_ids.discard(test_row.test_id)
+                self.__last_finish = time.monotonic()
+        finally:
+            # If handling the test failed, its lease expires and the backend
+            # puts it back to PENDING.
+            if test_row is not None:
+                self.__owned.discard(test_row.test_id)
+            self.__capacity.release(occupied)
+
+    def __on_start(self, queue: collections.deque[worker_db.Test]) -> None:
+        """Records idle gap and starts prefetching for the next test."""
+        if self.__last_finish is not None:
+            IDLE_GAP_TIME.observe(time.monotonic() - self.__last_finish)
+        if self.__prefetcher and self.__prefetcher.is_alive():
+            return
+        self.__prefetcher = threading.Thread(
+            target=self.__prefetch,
+            args=(queue[0] if queue else None,),
+            daemon=True)
+        self.__prefetcher.start()
+
+    def __prefetch(self, test_row: typing.Optional[worker_db.Test]) -> None:
+        """Copies artifacts of the test likely to run next into the cache."""
+        _lower_priority()
+        builds = self.__caches.builds
+        try:
+            with worker_db.WorkerDB(self.__ipv4, self.__worker_host) as server:
+                if test_row is None:
+                    test_row = server.peek_pending_test(builds.build_ids())
+                if test_row is None or test_row.skip_build:
+                    return
+                builds.prefetch(test_row.build_id,
+                                test_row.builder_ip,
+                                testspec.TestSpec.from_row(
+                                    typing.cast(testspec.TestDBRow, test_row)),
+                                files=server.get_build_files(test_row.build_id),
+                                peers=server)
+        except exc.SQLAlchemyError:
+            traceback.print_exc()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Runs NayDuck tests.')
+    parser.add_argument('--batch',
+                        type=int,
+                        default=1,
+                        help='number of tests to claim in one round trip')
+    parser.add_argument('--build-cache-size',
+                        type=int,
+                        default=4,
+                        help='number of builds to keep artifacts of locally')
+    parser.add_argument('--compressed-artifacts',
+                        action=argparse.BooleanOptionalAction,
+                        default=True,
+                        help='whether to download large artifacts from '
+                        'builders compressed; saves network bandwidth at cost '
+                        'of CPU time')
+    parser.add_argument('--worktrees',
+                        type=int,
+                        default=4,
+                        help='number of nearcore worktrees to keep; at least '
+                        'one per slot is kept regardless')
+    parser.add_argument('--venvs',
+                        type=int,
+                        default=4,
+                        help='number of Python virtual environments to keep')
+    parser.add_argument('--log-queue-size',
+                        type=int,
+                        default=log_queue.DEFAULT_CAPACITY,
+                        help='number of finished tests whose logs may wait to '
+                        'be saved before slots stop claiming new tests')
+    parser.add_argument('--slots',
+                        type=int,
+                        default=1,
+                        help='number of tests to run concurrently; tests may '
+                        'occupy more than one slot with --slots=<count> flag '
+                        'while Python tests, which listen on fixed ports, '
+                        'occupy all slots and are only claimed when all slots '
+                        'are free')
+    args = parser.parse_args()
+
+    ipv4, ip_str = utils.get_ip()
+    worker_host = socket.gethostname()
+    print(f'Starting worker @ {worker_host} ({ip_str} / {ipv4})',
+          file=sys.stderr)
+    prometheus_client.start_http_server(METRICS_PORT)
+    artifact_server.ArtifactServer(artifacts.CACHE_DIR,
+                                   utils.PEER_ARTIFACT_PORT).start()
+    capacity = Capacity(max(1, args.slots))
+    caches = Caches(
+        artifacts.BuildCache(args.build_cache_size,
+                             compressed=args.compressed_artifacts),
+        worktrees.WorktreeCache(max(args.worktrees, capacity.total)),
+        venvs.VenvCache(args.venvs))
+    caches.worktrees.start_fetcher()
+    logs = log_queue.LogQueue(capacity=args.log_queue_size)
+    threading.Thread(target=keep_saving_logs,
+                     args=(logs, ipv4, worker_host),
+                     daemon=True).start()
+    with worker_db.WorkerDB(ipv4, worker_host) as server:
+        server.handle_restart()
+        for build_id in caches.builds.build_ids():
+            server.advertise_build(build_id)
+        worker_handler = GracefulWorkerKiller(server)
+        slots = [
+            _SlotRunner(Slot.create(index),
+                        capacity,
+                        caches,
+                        worker_handler,
+                        logs,
+                        ipv4=ipv4,
+                        worker_host=worker_host,
+                        batch=args.batch) for index in range(capacity.total)
+        ]
+        threading.Thread(target=keep_renewing_leases,
+                         args=(ipv4, worker_host, slots),
+                         daemon=True).start()
+        with concurrent.futures.ThreadPoolExecutor(capacity.total) as executor:
+            futures = [executor.submit(slot) for slot in slots]
+            done, _ = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+            # If one of the slots gave up (e.g. database is unreachable), let
+            # the others finish their tests and exit.
+            worker_handler.worker_running = False
+            for future in done:
+                future.result()
+
 
 if __name__ == '__main__':
     utils.setup_environ()
@@ -1,10 +1,94 @@
+import datetime
 import typing
 
 from lib import common_db
 
+# How long a test stays owned by a worker without the worker renewing the
+# lease.  Once it expires, the backend puts the test back to PENDING.
+LEASE_DURATION = datetime.timedelta(seconds=30)
+
+# Number of bytes of each output stream of a running test kept in the live_logs
+# table.  Older chunks are deleted as new ones arrive so that a noisy test
+# can’t flood the database.
+LIVE_LOG_LIMIT = 1024 * 1024
+
+# Maximum number of workers downloading artifacts of a build from the same peer
+# and from the builder at the same time; see WorkerDB.acquire_source.  Peers
+# run tests while they serve artifacts so they are given less.
+PEER_MAX_TRANSFERS = 2
+BUILDER_MAX_TRANSFERS = 4
+
+# Transfers count of a peer which hasn’t been acquired for that long is
+# considered zero.  This makes up for workers which crashed in the middle of
+# a download and never released their peers.
+STALE_TRANSFERS = datetime.timedelta(minutes=15)
+
+# A (type, start, data) chunk of output of a running test.
+LiveChunk = tuple[str, int, bytes]
+
+# Categories of tests which start nodes listening on nearcore’s fixed default
+# ports (24567 and up for network, 3030 and up for RPC).  Two such tests can’t
+# run on the same host at the same time so they occupy all of worker’s slots.
+# Rust tests pick free ports themselves and can share the host.
+FIXED_PORT_CATEGORIES = ('pytest', 'mocknet')
+
+# Number of worker’s slots a test occupies; see worker.slots_needed.  Expects
+# parameters returned by _slots_params.  The count is taken from --slots=<count>
+# category flag in test’s name (see testspec.TestSpec.short_name).
+_SLOTS_NEEDED_SQL = '''CASE WHEN tests.category::text = ANY(:fixed) THEN :total
+                            ELSE LEAST(:total, COALESCE(
+                                SUBSTRING(tests.name FROM :slots_re)::integer,
+                                1))
+                        END'''
+_SLOTS_RE = r'^\S+(?: --\S+)* --slots=([0-9]+)'
+
+# Order in which pending tests should be claimed in; see
+# WorkerDB.get_pending_tests.  Refers to columns of _PENDING_TESTS_SQL.
+_PENDING_TESTS_ORDER = '''low_priority, running, cached DESC,
+                          expected_duration DESC, test_id'''
+
+# Pending tests which can run now in the order they should be claimed in along
+# with columns they are ordered by.  Expects a `cached` parameter and parameters
+# returned by _slots_params.
+_PENDING_TESTS_SQL = f'''SELECT test_id, builds.low_priority,
+                               COALESCE(running, 0) AS running,
+                               COALESCE(artifact_id, build_id) = ANY(:cached)
+                                   AS cached,
+                               expected_duration
+                          FROM tests
+                          JOIN builds USING (build_id)
+                          LEFT JOIN (SELECT run_id, COUNT(*) AS running
+                                       FROM tests
+                                      WHERE status = 'RUNNING'
+                                      GROUP BY run_id) AS busy
+                                 ON busy.run_id = tests.run_id
+                         WHERE tests.status = 'PENDING'
+                           AND (skip_build OR
+                                (builds.status = 'BUILD DONE' AND
+                                 builder_ip != 0))
+                           AND {_SLOTS_NEEDED_SQL} <= :free
+                         ORDER BY {_PENDING_TESTS_ORDER}'''
+
+
+def _slots_params(free: int, total: int) -> dict[str, typing.Any]:
+    """Returns parameters limiting _PENDING_TESTS_SQL to tests fitting in slots.
+
+    Args:
+        free: Number of worker’s slots which are free.
+        total: Total number of worker’s slots.
+    """
+    return {
+        'fixed': list(FIXED_PORT_CATEGORIES),
+        'total': total,
+        'free': free,
+        'slots_re': _SLOTS_RE,
+    }
+
 
 class Test:
     test_id: int
+    # Build whose artifacts the test uses.  This is the test’s own build unless
+    # the build reused artifacts of an identical build.
     build_id: int
     name: str
     timeout: int
@@ -14,6 +98,24 @@ class Test:
     tries: int
 
 
+class Log(typing.NamedTuple):
+    """A final log of a test (i.e. a row in the logs table).
+
+    Attributes:
+        name: Name of the log, e.g. 'stdout' or 'test0' for stderr of a node.
+        size: Size of the whole log in bytes.
+        data: Short log; see worker.make_short_log.
+        url: URL of the whole log or empty if there’s none (e.g. if the log
+            is empty or uploading it failed).
+        stack_trace: Whether the log contains a stack backtrace.
+    """
+    name: str
+    size: int
+    data: bytes
+    url: str
+    stack_trace: bool
+
+
 class WorkerDB(common_db.DB):
 
     def __init__(self, ipv4: int, worker_hostname: str) -> None:
@@ -28,37 +130,273 @@ class WorkerDB(common_db.DB):
         self._ipv4 = ipv4
         self.hostname = worker_hostname
 
-    def get_pending_test(self) -> typing.Optional[Test]:
-        """Returns a pending test to process or None if none found."""
-        sql = '''SELECT test_id
-                   FROM tests
-                   JOIN builds USING (build_id)
-                  WHERE tests.status = 'PENDING'
-                    AND (skip_build OR
-                         (builds.status = 'BUILD DONE' AND builder_ip != 0))
-                  ORDER BY low_priority
-                  LIMIT 1'''
-        sql = f'''UPDATE tests
-                     SET started = NOW(),
-                         finished = NULL,
-                         status = 'RUNNING',
-                         worker_ip = :ip,
-                         worker_hostname = :hostname,
-                         tries = tries + 1
-                   WHERE test_id IN ({sql})
-               RETURNING test_id, build_id, run_id, name, timeout, skip_build,
-                         tries'''
-        sql = f'''WITH test AS ({sql})
-                  SELECT test_id, build_id, name, timeout, skip_build,
-                         builder_ip, ENCODE(sha, 'hex') AS sha, tries
+    def get_pending_tests(self,
+                          count: int,
+                          cached_builds: typing.Sequence[int] = (),
+                          *,
+                          free_slots: int = 1,
+                          total_slots: int = 1) -> typing.Sequence[Test]:
+        """Claims up to `count` pending tests and returns them.
+
+        Candidate rows are locked with `FOR UPDATE SKIP LOCKED` so that workers
+        polling at the same time each get a disjoint set of tests rather than
+        all queueing on the lock of the first pending row.  All returned tests
+        are marked as RUNNING and owned by this worker.
+
+        Within the same priority, tests are picked from runs which have the
+        fewest tests running at the moment so that a big run doesn’t starve
+        the ones scheduled after it.  After that, tests of builds whose
+        artifacts the worker already has are preferred so that it doesn’t have
+        to copy them again.  Finally, tests expected to take the longest go
+        first so that a long test started at the end doesn’t delay the whole
+        run.  The expected duration is estimated when the run is scheduled
+        (see BackendDB.update_test_durations).  Claimed tests are returned in
+        that same order.
+
+        Only tests which fit in `free_slots` slots are claimed so that
+        a worker running several tests at a time never holds a test while
+        waiting for its other tests to finish.  In particular, tests listening
+        on fixed ports (see FIXED_PORT_CATEGORIES) are claimed only when all
+        slots are free.
+
+        Args:
+            count: Maximum number of tests to claim.
+            cached_builds: Ids of builds whose artifacts the worker has locally.
+            free_slots: Number of worker’s slots which are free.
+            total_slots: Total number of worker’s slots.
+        Returns:
+            Claimed tests in the order they should run in; empty if no pending
+            tests were found.
+        """
+        claim_sql = f'''{_PENDING_TESTS_SQL}
+                         LIMIT :count
+                           FOR UPDATE OF tests SKIP LOCKED'''
+        update_sql = '''UPDATE tests
+                           SET started = NOW(),
+                               finished = NULL,
+                               status = 'RUNNING',
+                               worker_ip = :ip,
+                               worker_hostname = :hostname,
+                               tries = tries + 1,
+                               lease_expires = NOW() + :lease
+                         WHERE test_id IN (SELECT test_id FROM claimed)
+                     RETURNING test_id, build_id, run_id, name, timeout,
+                               skip_build, tries'''
+        # Window functions can’t be used with FOR UPDATE so claimed tests are
+        # numbered in a separate step.
+        sql = f'''WITH claimed AS MATERIALIZED ({claim_sql}),
+                       ranked AS (SELECT test_id,
+                                         ROW_NUMBER() OVER (
+                                             ORDER BY {_PENDING_TESTS_ORDER})
+                                             AS position
+                                    FROM claimed),
+                       test AS ({update_sql})
+                  SELECT test_id, COALESCE(artifact_id, build_id) AS build_id,
+                         name, timeout, skip_build, builder_ip,
+                         ENCODE(sha, 'hex') AS sha, tries
                     FROM test
+                    JOIN ranked USING (test_id)
+                    JOIN runs USING (run_id)
+                    JOIN builds USING (build_id)
+                   ORDER BY position'''
+        rows = self._exec(sql,
+                          count=count,
+                          cached=list(cached_builds),
+                          lease=LEASE_DURATION,
+                          ip=self._ipv4,
+                          hostname=self.hostname,
+                          **_slots_params(free_slots, total_slots)).fetchall()
+        tests = typing.cast(typing.Sequence[Test], rows)
+        retried = ','.join(
+            str(int(test.test_id)) for test in tests if test.tries > 1)
+        if retried:
+            self._exec(f'DELETE FROM logs WHERE test_id IN ({retried})')
+            self._exec(f'DELETE FROM live_logs WHERE test_id IN ({retried})')
+        return tests
+
+    def peek_pending_test(
+        self,
+        cached_builds: typing.Sequence[int] = ()) -> typing.Optional[Test]:
+        """Returns test get_pending_tests would claim next without claiming it.
+
+        This lets a busy worker prepare for the test it’s likely to run next
+        (see BuildCache.prefetch) without taking the test away from idle
+        workers.  There’s no guarantee the worker will get the test but
+        pending tests usually share builds so preparing for any of them is
+        rarely wasted.
+
+        Args:
+            cached_builds: Ids of builds whose artifacts the worker has locally.
+        Returns:
+            The test or None if there are no pending tests.
+        """
+        sql = f'''WITH next AS (SELECT test_id
+                                FROM ({_PENDING_TESTS_SQL} LIMIT 1) AS pending)
+                  SELECT test_id, COALESCE(artifact_id, build_id) AS build_id,
+                         name, timeout, skip_build, builder_ip,
+                         ENCODE(sha, 'hex') AS sha, tries
+                    FROM next
+                    JOIN tests USING (test_id)
                     JOIN runs USING (run_id)
                     JOIN builds USING (build_id)'''
-        row = self._exec(sql, ip=self._ipv4, hostname=self.hostname).first()
-        test = typing.cast(typing.Optional[Test], row)
-        if test and test.tries > 1:
-            self._exec('DELETE FROM logs WHERE test_id = :id', id=test.test_id)
-        return test
+        row = self._exec(sql, cached=list(cached_builds),
+                         **_slots_params(1, 1)).first()
+        return typing.cast(typing.Optional[Test], row)
+
+    def confirm_claim(self, test_id: int) -> bool:
+        """Checks that a previously claimed test is still owned by the worker.
+
+        Tests claimed in a batch wait in worker’s local queue before they are
+        run.  In the meantime they may have been reset (e.g. as stale tests) and
+        handed over to another worker.  This method verifies that’s not the case
+        and resets the start time so that time spent in the queue doesn’t count
+        towards test’s timeout.
+
+        Args:
+            test_id: Id of the test to check.
+        Returns:
+            Whether the test is still RUNNING and assigned to this worker.
+        """
+        sql = '''UPDATE tests
+                    SET started = NOW(), lease_expires = NOW() + :lease
+                  WHERE test_id = :id
+                    AND status = 'RUNNING'
+                    AND worker_ip = :ip'''
+        return bool(
+            self._exec(sql, id=test_id, ip=self._ipv4,
+                       lease=LEASE_DURATION).rowcount)
+
+    def renew_leases(self, test_ids: typing.Collection[int]) -> int:
+        """Extends leases of given tests owned by the worker.
+
+        Tests are owned by a worker as long as it keeps renewing their leases.
+        If it stops (e.g. because it crashed or gave up on a test after an
+        error), the backend puts the tests back to PENDING once their leases
+        expire so that other workers can pick them up.  The worker should pass
+        tests which are running as well as ones which have been claimed but
+        are still waiting in its queue.
+
+        Args:
+            test_ids: Tests to renew leases of.  Tests which aren’t RUNNING or
+                aren’t owned by this worker are ignored.
+        Returns:
+            Number of tests whose leases have been renewed.
+        """
+        if not test_ids:
+            return 0
+        sql = '''UPDATE tests
+                    SET lease_expires = NOW() + :lease
+                  WHERE test_id = ANY(:ids)
+                    AND status = 'RUNNING'
+                    AND worker_ip = :ip'''
+        return int(
+            self._exec(
+                sql, ids=list(test_ids), ip=self._ipv4,
+                lease=LEASE_DURATION).rowcount or 0)
+
+    def get_build_files(
+            self, build_id: int) -> typing.Sequence[common_db.ArtifactFile]:
+        """Returns manifest of given build.
+
+        Args:
+            build_id: Id of the build whose artifacts are to be fetched.
+        Returns:
+            Files in build’s directory on the builder sorted by path.  Empty if
+            the builder hasn’t stored a manifest for the build.
+        """
+        sql = '''SELECT path, size, sha256, executable
+                   FROM build_files
+                  WHERE build_id = :id
+                  ORDER BY path'''
+        return tuple(
+            common_db.ArtifactFile(row.path, int(row.size), bytes(row.sha256),
+                                   bool(row.executable))
+            for row in self._exec(sql, id=build_id))
+
+    def advertise_build(self, build_id: int) -> None:
+        """Lets other workers download artifacts of given build from this one.
+
+        Args:
+            build_id: Build whose artifacts (except for expensive tests) the
+                worker has in its cache.
+        """
+        sql = '''INSERT INTO build_peers (build_id, worker_ip)
+                 SELECT build_id, :ip FROM builds WHERE build_id = :id
+                     ON CONFLICT DO NOTHING'''
+        self._exec(sql, id=build_id, ip=self._ipv4)
+
+    def withdraw_builds(self, build_ids: typing.Sequence[int]) -> None:
+        """Stops offering artifacts of given builds to other workers."""
+        if build_ids:
+            sql = '''DELETE FROM build_peers
+                      WHERE build_id IN :ids AND worker_ip = :ip'''
+            self._exec(sql, ids=tuple(build_ids), ip=self._ipv4)
+
+    def acquire_source(self, build_id: int) -> typing.Optional[int]:
+        """Picks host to download artifacts of given build from.
+
+        Candidates are the builder the build is stored on and workers which
+        have advertised the build (see advertise_build).  The one with the
+        fewest transfers in progress is chosen, peers before the builder when
+        tied, so that once a few workers have the build the rest get it from
+        them rather than all from the builder.  Hosts already serving
+        PEER_MAX_TRANSFERS (BUILDER_MAX_TRANSFERS for the builder) aren’t
+        considered.  The chosen host’s transfer count is increased and must be
+        decreased with release_source once the download finishes.
+
+        Args:
+            build_id: Build whose artifacts are going to be downloaded.
+        Returns:
+            IP address (as an integer) of the acquired host, zero if all
+            candidates are busy or None if there are no candidates at all.
+        """
+        sql = '''WITH candidates AS (
+                     SELECT peers.worker_ip,
+                            CASE WHEN peers.updated < NOW() - :stale THEN 0
+                                 ELSE peers.transfers END AS load,
+                            CASE WHEN peers.worker_ip = builds.builder_ip
+                                 THEN :builder_max
+                                 ELSE :peer_max END AS max_load
+                       FROM build_peers AS peers
+                       JOIN builds USING (build_id)
+                      WHERE build_id = :id AND peers.worker_ip != :ip
+                 ), chosen AS MATERIALIZED (
+                     SELECT worker_ip, max_load
+                       FROM candidates
+                      WHERE load < max_load
+                      ORDER BY load, max_load, RANDOM()
+                      LIMIT 1
+                 ), acquired AS (
+                     UPDATE build_peers AS peers
+                        SET transfers = CASE
+                                WHEN updated < NOW() - :stale THEN 1
+                                ELSE transfers + 1 END,
+                            updated = NOW()
+                       FROM chosen
+                      WHERE peers.build_id = :id
+                        AND peers.worker_ip = chosen.worker_ip
+                        AND (peers.updated < NOW() - :stale OR
+                             peers.transfers < chosen.max_load)
+                  RETURNING peers.worker_ip
+                 )
+                 SELECT (SELECT worker_ip FROM acquired),
+                        EXISTS (SELECT 1 FROM candidates)'''
+        acquired, exists = self._exec(sql,
+                                      id=build_id,
+                                      ip=self._ipv4,
+                                      stale=STALE_TRANSFERS,
+                                      peer_max=PEER_MAX_TRANSFERS,
+                                      builder_max=BUILDER_MAX_TRANSFERS).one()
+        if acquired is not None:
+            return int(acquired)
+        return 0 if exists else None
+
+    def release_source(self, build_id: int, source_ip: int) -> None:
+        """Marks download acquired with acquire_source as finished."""
+        sql = '''UPDATE build_peers
+                    SET transfers = GREATEST(transfers - 1, 0)
+                  WHERE build_id = :id AND worker_ip = :source'''
+        self._exec(sql, id=build_id, source=source_ip)
 
     def test_started(self, test_id: int) -> None:
         sql = '''UPDATE tests
@@ -67,16 +405,28 @@ class WorkerDB(common_db.DB):
         self._exec(sql, id=test_id)
 
     def update_test_status(self, test_id: int, status: str) -> None:
+        """Sets final status of a test.
+
+        Does nothing if the worker no longer owns the test, e.g. because its
+        lease expired and the test has been handed over to another worker.
+        """
         sql = '''UPDATE tests
-                    SET finished = NOW(), status = :status
-                  WHERE test_id = :id'''
-        self._exec(sql, status=status, id=test_id)
+                    SET finished = NOW(), status = :status, lease_expires = NULL
+                  WHERE test_id = :id
+                    AND status = 'RUNNING'
+                    AND worker_ip = :ip'''
+        self._exec(sql, status=status, id=test_id, ip=self._ipv4)
 
     def retry_test(self, test_id: int) -> None:
         sql = '''UPDATE tests
-                    SET started = NULL, status = 'PENDING'
-                  WHERE test_id = :id'''
-        self._exec(sql, id=test_id)
+                    SET started = NULL, status = 'PENDING', lease_expires = NULL
+                  WHERE test_id = :id
+                    AND status = 'RUNNING'
+                    AND worker_ip = :ip'''
+        self._in_transaction(self.__update_and_notify,
+                             sql,
+                             id=test_id,
+                             ip=self._ipv4)
 
     def handle_shutdown(self, test_id: int) -> None:
         sql = '''UPDATE tests
@@ -84,23 +434,94 @@ class WorkerDB(common_db.DB):
                         status = 'PENDING',
                         worker_ip = 0,
                         worker_hostname = NULL,
-                        tries = GREATEST(tries - 1, 0)
-                  WHERE test_id = :id'''
-        self._exec(sql, id=test_id)
+                        tries = GREATEST(tries - 1, 0),
+                        lease_expires = NULL
+                  WHERE test_id = :id
+                    AND status = 'RUNNING'
+                    AND worker_ip = :ip'''
+        self._in_transaction(self.__update_and_notify,
+                             sql,
+                             id=test_id,
+                             ip=self._ipv4)
+
+    def __update_and_notify(self, sql: str, **kw: typing.Any) -> None:
+        """Executes a query putting tests back to PENDING and notifies workers."""
+        self._exec(sql, **kw)
+        self._notify(common_db.PENDING_TESTS_CHANNEL)
+
+    def append_live_logs(self, test_id: int,
+                         chunks: typing.Sequence[LiveChunk]) -> None:
+        """Stores chunks of output of a running test.
+
+        Only the last LIVE_LOG_LIMIT bytes of each stream are kept; chunks
+        entirely before that are deleted.
+
+        Args:
+            test_id: Id of the running test.
+            chunks: (type, start, data) tuples where type is 'stdout' or
+                'stderr', start is offset of the chunk in the output and data is
+                the chunk itself.
+        """
+
+        def execute() -> None:
+            self._multi_insert('live_logs',
+                               ('test_id', 'type', 'start', 'data'),
+                               [(test_id, *chunk) for chunk in chunks],
+                               on_conflict='DO NOTHING')
+            sql = '''DELETE FROM live_logs AS old
+                      USING (SELECT type, MAX(start + LENGTH(data)) AS size
+                               FROM live_logs
+                              WHERE test_id = :id
+                              GROUP BY type) AS cur
+                      WHERE old.test_id = :id
+                        AND old.type = cur.type
+                        AND old.start + LENGTH(old.data) <= cur.size - :limit'''
+            self._exec(sql, id=test_id, limit=LIVE_LOG_LIMIT)
 
-    def save_short_logs(self, test_id: int,
-                        logs: typing.Collection[typing.Any]) -> None:
-        columns = ('test_id', 'type', 'size', 'log', 'storage', 'stack_trace')
-        self._multi_insert(
-            'logs',
-            columns,
-            [(test_id, log.name, log.size, self._blob_from_data(
-                log.data or b''), log.url or '', log.stack_trace)
-             for log in logs],
-            on_conflict=('(test_id, type) DO UPDATE'
-                         ' SET size = excluded.size, log = excluded.log,'
-                         '     storage = excluded.storage,'
-                         '     stack_trace = excluded.stack_trace'))
+        self._in_transaction(execute)
+
+    def save_log(self, test_id: int, tries: int, log: Log) -> None:
+        """Saves a final log of a test.
+
+        Does nothing if the test has been tried again since it produced the log
+        so that logs of different tries never mix.  Saving the same log again
+        replaces it.
+
+        Args:
+            test_id: Id of the test.
+            tries: Test’s number of tries at the time it produced the log.
+            log: The log.
+        """
+        sql = '''INSERT INTO logs (test_id, type, size, log, storage,
+                                   stack_trace)
+                 SELECT test_id, :type, :size, :log, :storage, :stack_trace
+                   FROM tests
+                  WHERE test_id = :id AND tries = :tries
+                     ON CONFLICT (test_id, type) DO UPDATE
+                    SET size = excluded.size, log = excluded.log,
+                        storage = excluded.storage,
+                        stack_trace = excluded.stack_trace'''
+        self._exec(sql,
+                   id=test_id,
+                   tries=tries,
+                   type=log.name,
+                   size=log.size,
+                   log=self._blob_from_data(log.data),
+                   storage=log.url,
+                   stack_trace=log.stack_trace)
+
+    def delete_live_logs(self, test_id: int, tries: int) -> None:
+        """Deletes live logs of a test once all of its final logs are saved.
+
+        Does nothing if the test has been tried again in the meantime since live
+        logs then belong to the new try.
+        """
+        sql = '''DELETE FROM live_logs
+                  WHERE test_id = :id
+                    AND EXISTS (SELECT 1
+                                  FROM tests
+                                 WHERE test_id = :id AND tries = :tries)'''
+        self._exec(sql, id=test_id, tries=tries)
 
     def handle_restart(self) -> None:
         sql = '''UPDATE tests
@@ -108,6 +529,9 @@ class WorkerDB(common_db.DB):
                         status = 'PENDING',
                         worker_ip = 0,
                         worker_hostname = NULL,
-                        tries = GREATEST(tries - 1, 0)
+                        tries = GREATEST(tries - 1, 0),
+                        lease_expires = NULL
                   WHERE status = 'RUNNING' AND worker_ip = :ip'''
         self._exec(sql, ip=self._ipv4)
+        self._exec('DELETE FROM build_peers WHERE worker_ip = :ip',
+                   ip=self._ipv4)
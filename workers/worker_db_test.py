@@ -0,0 +1,98 @@
+import os
+import typing
+
+import pytest
+
+# The tests write to the database configured in ~/.nayduck/database.json so
+# they only run when it’s explicitly marked as a scratch database.  This is
+# checked before importing the database module so that collecting the tests
+# doesn’t need database configuration.
+if not os.environ.get('NAYDUCK_SCRATCH_DB'):
+    pytest.skip('set NAYDUCK_SCRATCH_DB=1 to run against a scratch database',
+                allow_module_level=True)
+
+# pylint: disable=wrong-import-position
+from sqlalchemy import exc
+
+from . import worker_db
+
+
+class _TestDB(worker_db.WorkerDB):
+
+    def create_tests(self,
+                     durations: list[int],
+                     names: typing.Optional[list[str]] = None
+                    ) -> tuple[int, int, list[int]]:
+        """Creates a run with a finished build and its pending tests.
+
+        Tests are named `names` if given and are pytests otherwise.
+
+        Returns:
+            A (run_id, build_id, test_ids) tuple.
+        """
+        if names is None:
+            names = [f'pytest sanity/{duration}.py' for duration in durations]
+        run_id = self._insert('runs',
+                              'run_id',
+                              requester='worker-db-test',
+                              title='Worker database test',
+                              branch='test',
+                              sha=os.urandom(20))
+        build_id = self._insert('builds',
+                                'build_id',
+                                run_id=run_id,
+                                builder_ip=0x7F000001,
+                                status='BUILD DONE')
+        rows = self._multi_insert(
+            'tests', ('run_id', 'build_id', 'category', 'name', 'branch',
+                      'expected_duration'),
+            [(run_id, build_id, name.split()[0], name, 'test', duration)
+             for name, duration in zip(names, durations)],
+            returning=('test_id',))
+        return run_id, build_id, [row.test_id for row in rows]
+
+    def delete_run(self, run_id: int) -> None:
+        self._exec('DELETE FROM runs WHERE run_id = :id', id=run_id)
+
+
+def test_batch_order():
+    try:
+        db = _TestDB(0x7F000001, 'worker-db-test')
+        run_id, build_id, test_ids = db.create_tests([60, 600, 10, 300])
+    except exc.OperationalError as ex:
+        pytest.skip(f'database unavailable: {ex}')
+    with db:
+        try:
+            # The build is cached so that its tests are claimed before any
+            # other pending tests in the database.
+            tests = db.get_pending_tests(4, [build_id])
+        finally:
+            db.delete_run(run_id)
+    # Longest tests go first.
+    assert [test.test_id for test in tests
+           ] == [test_ids[1], test_ids[3], test_ids[0], test_ids[2]]
+
+
+def test_slots():
+    names = [
+        'pytest sanity/fixed_ports.py',
+        'expensive --slots=3 nearcore test_three three',
+        'expensive --slots=2 nearcore test_two two',
+        'expensive nearcore test_one one',
+    ]
+    try:
+        db = _TestDB(0x7F000001, 'worker-db-test')
+        run_id, build_id, test_ids = db.create_tests([400, 300, 200, 100],
+                                                     names)
+    except exc.OperationalError as ex:
+        pytest.skip(f'database unavailable: {ex}')
+    with db:
+        try:
+            # Python tests need all slots and other tests as many as they ask
+            # for.
+            tests = db.get_pending_tests(4, [build_id],
+                                         free_slots=2,
+                                         total_slots=4)
+        finally:
+            db.delete_run(run_id)
+    assert [test.test_id for test in tests] == [test_ids[2], test_ids[3]]
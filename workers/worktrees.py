@@ -0,0 +1,213 @@
+import contextlib
+import dataclasses
+import pathlib
+import subprocess
+import sys
+import threading
+import time
+import typing
+
+import prometheus_client
+
+from . import utils
+
+STORE_DIR = utils.WORKDIR / 'nearcore.git'
+WORKTREES_DIR = utils.WORKDIR / 'worktrees'
+
+# How often the background fetcher updates the object store.
+FETCH_INTERVAL = 60
+
+CHECKOUTS = prometheus_client.Counter(
+    'nayduck_worker_checkouts',
+    'Number of times a test needed a nearcore checkout by whether it reused '
+    'a worktree at the right commit, switched an existing worktree, created '
+    'a new one or failed', ['result'])
+
+
+@dataclasses.dataclass
+class _Worktree:
+    path: pathlib.Path
+    sha: typing.Optional[str]
+    last_used: float = 0.0
+    busy: bool = False
+
+
+class WorktreeCache:
+    """A bounded cache of nearcore worktrees keyed by commit SHA.
+
+    All worktrees share a single bare repository in STORE_DIR which is kept
+    up to date by a background fetcher.  A test running on a commit some idle
+    worktree is already at gets that worktree without running any git commands.
+    Otherwise the least recently used idle worktree is switched to the commit
+    or, if there are fewer than `capacity` worktrees, a new one is created.
+
+    Worktrees are used exclusively, i.e. two tests never run in the same
+    worktree at the same time even if they are at the same commit, since tests
+    put their build artifacts inside the worktree.
+
+    A failure to check out a commit never deletes the object store.  At worst,
+    the failing worktree is removed and created anew.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.__capacity = capacity
+        self.__lock = threading.Lock()
+        self.__admin_lock = threading.Lock()
+        self.__fetch_lock = threading.Lock()
+        self.__worktrees: list[_Worktree] = []
+        self.__initialise()
+
+    def __initialise(self) -> None:
+        """Creates the object store and adopts existing worktrees."""
+        if not (STORE_DIR / 'HEAD').is_file():
+            utils.rmdirs(STORE_DIR)
+            _git('clone',
+                 '--bare',
+                 utils.REPO_URL,
+                 STORE_DIR,
+                 cwd=utils.WORKDIR)
+            _git('config',
+                 'remote.origin.fetch',
+                 '+refs/heads/*:refs/heads/*',
+                 cwd=STORE_DIR)
+        _git('worktree', 'prune', cwd=STORE_DIR)
+        utils.mkdirs(WORKTREES_DIR)
+        for path in sorted(WORKTREES_DIR.iterdir()):
+            result = subprocess.run(('git', 'rev-parse', '--verify', 'HEAD'),
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL,
+                                    stdin=subprocess.DEVNULL,
+                                    check=False,
+                                    cwd=path)
+            if result.returncode or len(self.__worktrees) >= self.__capacity:
+                self.__remove(path)
+            else:
+                sha = result.stdout.decode('ascii').strip()
+                self.__worktrees.append(_Worktree(path, sha))
+
+    def start_fetcher(self, interval: float = FETCH_INTERVAL) -> None:
+        """Starts a daemon thread periodically fetching from upstream."""
+
+        def run() -> None:
+            while True:
+                time.sleep(interval)
+                with self.__fetch_lock:
+                    try:
+                        _git('fetch', '--prune', 'origin', cwd=STORE_DIR)
+                    except subprocess.CalledProcessError as ex:
+                        print(f'Background fetch failed: {ex}', file=sys.stderr)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    @contextlib.contextmanager
+    def checkout(
+        self, sha: str, runner: utils.Runner
+    ) -> typing.Generator[typing.Optional[pathlib.Path], None, None]:
+        """A context manager providing a worktree at given commit.
+
+        The worktree is reserved for the caller until the context manager
+        exits.
+
+        Args:
+            sha: Commit to check out.
+            runner: Runner to execute git commands with.
+        Yields:
+            Path to the worktree or None if the commit couldn’t be checked out.
+        """
+        worktree = self.__acquire(sha)
+        try:
+            if worktree.sha != sha:
+                if self.__switch(worktree, sha, runner):
+                    worktree.sha = sha
+                else:
+                    worktree.sha = None
+                    CHECKOUTS.labels('failed').inc()
+            yield worktree.path if worktree.sha == sha else None
+        finally:
+            with self.__lock:
+                worktree.last_used = time.monotonic()
+                worktree.busy = False
+
+    def __acquire(self, sha: str) -> _Worktree:
+        """Reserves a worktree to check out given commit in."""
+        with self.__lock:
+            idle = [wt for wt in self.__worktrees if not wt.busy]
+            worktree = next((wt for wt in idle if wt.sha == sha), None)
+            if worktree:
+                CHECKOUTS.labels('hit').inc()
+            elif len(self.__worktrees) < self.__capacity or not idle:
+                CHECKOUTS.labels('new').inc()
+                worktree = _Worktree(self.__new_path(), None)
+                self.__worktrees.append(worktree)
+            else:
+                CHECKOUTS.labels('switch').inc()
+                worktree = min(idle, key=lambda wt: wt.last_used)
+            worktree.busy = True
+            return worktree
+
+    def __new_path(self) -> pathlib.Path:
+        """Returns path for a new worktree which isn’t used yet."""
+        used = {wt.path.name for wt in self.__worktrees}
+        index = 0
+        while str(index) in used:
+            index += 1
+        return WORKTREES_DIR / str(index)
+
+    def __switch(self, worktree: _Worktree, sha: str,
+                 runner: utils.Runner) -> bool:
+        """Checks out given commit in a worktree.
+
+        Fetches from upstream if the commit is missing from the object store.
+        If checking out fails in an existing worktree, recreates it.
+
+        Returns:
+            Whether the commit has been checked out.
+        """
+        if not self.__has_commit(sha):
+            with self.__fetch_lock:
+                if not self.__has_commit(sha):
+                    runner(('git', 'fetch', '--prune', 'origin'), cwd=STORE_DIR)
+                if not self.__has_commit(sha):
+                    runner(('git', 'fetch', 'origin', sha), cwd=STORE_DIR)
+            if not self.__has_commit(sha):
+                return False
+
+        path = worktree.path
+        if (path / '.git').exists() and runner(
+            ('git', 'checkout', '-f', '--detach', sha), cwd=path) == 0:
+            return True
+        with self.__admin_lock:
+            self.__remove(path)
+            return runner(('git', 'worktree', 'add', '--detach', path, sha),
+                          cwd=STORE_DIR) == 0
+
+    @staticmethod
+    def __has_commit(sha: str) -> bool:
+        """Returns whether the object store contains given commit."""
+        return subprocess.run(
+            ('git', 'rev-parse', '--verify', '-q', sha + '^{commit}'),
+            stdout=subprocess.DEVNULL,
+            stdin=subprocess.DEVNULL,
+            check=False,
+            cwd=STORE_DIR).returncode == 0
+
+    @staticmethod
+    def __remove(path: pathlib.Path) -> None:
+        """Removes a worktree directory and its administrative files."""
+        if path.exists():
+            print(f'Removing worktree {path}', file=sys.stderr)
+            utils.rmdirs(path)
+        _git('worktree', 'prune', cwd=STORE_DIR, check=False)
+
+
+def _git(*args: typing.Union[str, pathlib.Path],
+         cwd: pathlib.Path,
+         check: bool = True) -> None:
+    """Runs a git command outside of any test.
+
+    Raises:
+        subprocess.CalledProcessError: if the command fails and `check` is true.
+    """
+    cmd = ('git', *args)
+    print('+ ' + ' '.join(str(arg) for arg in cmd), file=sys.stderr)
+    subprocess.run(cmd, check=check, stdin=subprocess.DEVNULL, cwd=cwd)